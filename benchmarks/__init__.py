@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Recommendation service
+
+These are not part of the unit tests. Run them against a scratch database
+because they delete every recommendation.
+"""
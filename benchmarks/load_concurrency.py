@@ -0,0 +1,111 @@
+"""
+Concurrency Load Test
+
+Finds how many concurrent clients a running server can take. Each level
+keeps that many clients sending GET requests for a fixed time and reports
+the throughput, latency percentiles and errors. The concurrency limit is
+the highest level whose 99th percentile stays under the latency budget
+without errors.
+
+Start the server in one mode, seed it, and point the load test at it:
+
+  SERVER_MODE=sync gunicorn --bind 0.0.0.0:8080 --workers 1
+  SERVER_MODE=async gunicorn --bind 0.0.0.0:8080 --workers 1
+  python -m benchmarks.load_concurrency http://localhost:8080 --seconds 10
+
+Run both modes against the same database with the same worker count to
+compare them. When the server, the database and this load test share a
+CPU, the requests are CPU-bound. Async then shows a wider latency tail than
+sync, because its event loop shares the CPU between every request in
+progress, so only a run against the deployed database tells the two apart.
+
+Save the results with --save and check a later build with --baseline, as
+with benchmarks/load_api.py.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import httpx
+from benchmarks.stats import add_report_arguments, report, summarize
+
+BASE_URL = "/api/recommendations"
+LEVELS = (1, 8, 32, 64, 128, 256)
+LATENCY_BUDGET = 0.5  # seconds at the 99th percentile
+SEED_COUNT = 100
+
+
+async def seed(client: httpx.AsyncClient) -> list:
+    """Creates recommendations to read and returns their ids"""
+    ids = []
+    for i in range(SEED_COUNT):
+        response = await client.post(BASE_URL, json={
+            "name": f"prod{i % 10}", "recommendation_id": i, "recommendation_name": f"prod{i}",
+            "type": "UPSELL", "number_of_likes": i,
+        })
+        response.raise_for_status()
+        ids.append(response.json()["id"])
+    return ids
+
+
+async def client_loop(client: httpx.AsyncClient, ids: list, deadline: float, latencies: list, errors: list):
+    """Sends requests one after another until the deadline"""
+    i = 0
+    while time.perf_counter() < deadline:
+        url = f"{BASE_URL}/{ids[i % len(ids)]}" if i % 2 else f"{BASE_URL}?name=prod{i % 10}&limit=20"
+        start = time.perf_counter()
+        try:
+            response = await client.get(url)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            errors.append(url)
+        else:
+            latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+async def run_level(base_url: str, ids: list, concurrency: int, seconds: float) -> dict:
+    """Runs one concurrency level and returns its statistics"""
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=10) as client:
+        start = time.perf_counter()
+        deadline = start + seconds
+        await asyncio.gather(*[client_loop(client, ids, deadline, latencies, errors) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return summarize(latencies, elapsed, len(errors))
+
+
+async def run(base_url: str, seconds: float) -> dict:
+    """Seeds the server and returns the statistics of each level"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=10) as client:
+        ids = await seed(client)
+    results = {}
+    for concurrency in LEVELS:
+        results[f"clients_{concurrency}"] = await run_level(base_url, ids, concurrency, seconds)
+    async with httpx.AsyncClient(base_url=base_url, timeout=10) as client:
+        for reco_id in ids:
+            await client.delete(f"{BASE_URL}/{reco_id}")
+    return results
+
+
+def main() -> int:
+    """Runs every level and reports the results and the concurrency limit"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("base_url", nargs="?", default="http://localhost:8080", help="the server to load")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to run each level for")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+    results = asyncio.run(run(args.base_url, args.seconds))
+    code = report(results, args)
+    limit = max([
+        concurrency for concurrency in LEVELS
+        if results[f"clients_{concurrency}"]["errors"] == 0
+        and results[f"clients_{concurrency}"]["p99"] <= LATENCY_BUDGET * 1000
+    ], default=0)
+    print(f"concurrency limit at p99 <= {LATENCY_BUDGET * 1000:.0f} ms: {limit} clients")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Benchmark Statistics
+
+Summarizes latencies into throughput and percentiles, prints them as a
+table, and compares them with a saved baseline so that a slower build can
+fail before it is deployed.
+"""
+import json
+import statistics
+
+PERCENTILES = (50, 95, 99)
+
+
+def summarize(latencies: list, seconds: float, errors: int = 0) -> dict:
+    """Returns the throughput and latency percentiles in milliseconds of a run"""
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        quantiles = [latencies[0] if latencies else 0] * 99
+    result = {"count": len(latencies), "rps": len(latencies) / seconds if seconds else 0, "errors": errors}
+    for percentile in PERCENTILES:
+        result[f"p{percentile}"] = quantiles[percentile - 1] * 1000
+    return result
+
+
+def print_table(results: dict):
+    """Prints one row of statistics for each named result"""
+    width = max([len(name) for name in results] + [4])
+    print(f"{'name':<{width}} {'count':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, result in results.items():
+        print(f"{name:<{width}} {result['count']:>8} {result['rps']:>10.1f} {result['p50']:>9.3f} "
+              f"{result['p95']:>9.3f} {result['p99']:>9.3f} {result['errors']:>7}")
+
+
+def save(results: dict, path: str):
+    """Writes the results to a JSON file to use as the next baseline"""
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def regressions(results: dict, baseline_path: str, tolerance: float) -> list:
+    """Returns a message for each result that is slower than its baseline
+
+    A result regresses when its p99 grows, or its throughput drops, by more
+    than the tolerance, e.g. 0.2 for 20%, or when it has errors the baseline
+    did not. Results missing from the baseline are not compared.
+    """
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    messages = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p99"] > before["p99"] * (1 + tolerance):
+            messages.append(f"{name}: p99 {result['p99']:.2f} ms, was {before['p99']:.2f} ms")
+        if result["rps"] < before["rps"] * (1 - tolerance):
+            messages.append(f"{name}: {result['rps']:.1f} req/s, was {before['rps']:.1f} req/s")
+        if result["errors"] > before["errors"]:
+            messages.append(f"{name}: {result['errors']} errors, was {before['errors']}")
+    return messages
+
+
+def add_report_arguments(parser):
+    """Adds the options to save results and to compare them with a baseline"""
+    parser.add_argument("--save", metavar="PATH", help="write the results to a JSON file to use as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="exit with 1 if the results are slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the fraction p99 or throughput may worsen before it is a regression (default 0.2)")
+
+
+def report(results: dict, args) -> int:
+    """Prints, saves and checks the results and returns the exit status"""
+    print_table(results)
+    if args.save:
+        save(results, args.save)
+    if not args.baseline:
+        return 0
+    messages = regressions(results, args.baseline, args.tolerance)
+    for message in messages:
+        print("REGRESSION " + message)
+    return 1 if messages else 0
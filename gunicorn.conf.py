@@ -0,0 +1,54 @@
+"""
+Gunicorn configuration
+
+Gunicorn loads this file from the working directory by default
+"""
+import os
+import glob
+
+# SERVER_MODE=async serves the ASGI app in service/asgi.py on uvicorn workers
+# instead of the Flask app on sync workers
+if os.getenv("SERVER_MODE", "sync") == "async":
+    wsgi_app = "service.asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "service:create_app()"
+
+# Load the app once in the master and fork the workers from it, which
+# holds no database connections to share since the app connects lazily
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def prepare_metrics_directory():
+    """Creates the directory of the metrics and clears those left behind by
+    the workers of a previous run
+
+    The app writes its metrics there as soon as it is loaded, which with
+    preload_app is before any server hook runs, so this is done when the
+    config is read. A reload reads the config again while the workers are
+    still writing their metrics, so they are only cleared the first time.
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory or os.getenv("GUNICORN_METRICS_PREPARED"):
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+    os.environ["GUNICORN_METRICS_PREPARED"] = "true"
+
+
+prepare_metrics_directory()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Stops counting the live gauges of a worker that has gone away"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Flushes the buffered likes before a worker goes away"""
+    from service.likes import like_buffer  # pylint: disable=import-outside-toplevel
+    if like_buffer.enabled:
+        like_buffer.stop()
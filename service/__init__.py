@@ -1,24 +1,17 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module has the create_app() factory that creates and configures the
+Flask app and sets up the logging and SQL database. Creating the app does
+not connect to the database, the tables are created by the create-db
+command, e.g. flask create-db
 """
-import os
-import sys
-import logging
 from flask import Flask
 from flask_restx import Api
 from service import config
-from .common import log_handlers
+from .common import log_handlers, metrics
 
-
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object(config)
-
-api = Api(app,
-          version='1.0.0',
+api = Api(version='1.0.0',
           title='Recommendation REST API Service',
           description='This is a Recommendation server.',
           default='recommendations',
@@ -27,24 +20,51 @@ api = Api(app,
           prefix='/api'
           )
 
-# Dependencies require we import the routes AFTER the Flask app is created
+# Dependencies require we import the routes AFTER the Api is created
 # pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models         # noqa: E402, E261
+from service import routes, models, commands  # noqa: E402, E261
+from service.likes import like_buffer  # noqa: E402
+from service.snapshot import snapshot_server  # noqa: E402
 # pylint: disable=wrong-import-position
-from .common import error_handlers  # noqa: F401 E402
+from .common import error_handlers, representations  # noqa: F401 E402
+
+
+def create_app(settings: dict = None) -> Flask:
+    """Creates and configures the Flask app
+
+    The database is only connected to when it is first used, so that
+    gunicorn --preload can fork the workers from a parent that has
+    imported everything but holds no connections.
+
+    :param settings: config values that override the ones in service/config.py
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(settings or {})
+    api.init_app(app)
+    app.register_blueprint(routes.site)
+    app.cli.add_command(commands.create_db)
+    app.cli.add_command(commands.db)
+
+    # Set up logging for production
+    log_handlers.init_logging(app, "gunicorn.error")
+
+    app.logger.info(70 * "*")
+    app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
 
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+    metrics.init_metrics(app)
+    models.init_app(app)
+    like_buffer.init_app(app)
+    snapshot_server.init_app(app)
 
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    app.logger.info("Service initialized!")
+    return app
 
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service initialized!")
+def __getattr__(name: str):
+    """Creates service.app the first time it is used, e.g. by FLASK_APP=service:app"""
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    app = globals()["app"] = create_app()
+    return app
@@ -0,0 +1,479 @@
+"""
+Async Recommendation Service
+
+An ASGI app that serves the /api/recommendations routes of service/routes.py
+through asyncpg and an AsyncSession, so each worker keeps serving requests
+while others wait on PostgreSQL. Select it at deploy time with
+SERVER_MODE=async, which makes gunicorn.conf.py run this app on uvicorn
+workers instead of the Flask app on sync workers.
+
+The responses and errors match the Flask app. Bulk create, bulk likes, the
+like buffer, the read-through cache, read replicas and the snapshot serving
+mode are only available in sync mode; writes made here still invalidate the
+cache so both modes can share it.
+"""
+import json
+import logging
+from flask import Flask
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import parse_etags
+from service import app as flask_app
+from service.models import Recommendation, RecommendationList, RecommendationType, DataValidationError, cache, list_cache
+from service.routes import compute_etag
+from service.common import status
+
+logger = logging.getLogger("flask.app")
+
+BASE_URL = "/api/recommendations"
+
+
+class AsyncDatabase:
+    """Async engine and session factory, created when the app starts"""
+
+    def __init__(self):
+        self.engine = None
+        self.session = None
+
+    def init_app(self, app: Flask):
+        """Creates the engine with the database and pool settings of the Flask app"""
+        uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        self.engine = create_async_engine(async_uri(uri), **engine_options(app))
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def dispose(self):
+        """Closes every connection in the pool"""
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
+def async_uri(uri: str) -> str:
+    """Returns the URI with the asyncpg driver for a PostgreSQL URI"""
+    scheme, rest = uri.split("://", 1)
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        return "postgresql+asyncpg://" + rest
+    return uri
+
+
+def engine_options(app: Flask) -> dict:
+    """Returns the pool settings of the Flask app for the async engine"""
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return {}
+    options = {
+        "pool_size": app.config["DB_POOL_SIZE"],
+        "max_overflow": app.config["DB_MAX_OVERFLOW"],
+        "pool_timeout": app.config["DB_POOL_TIMEOUT"],
+        "pool_recycle": app.config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": app.config["DB_POOL_PRE_PING"],
+    }
+    if app.config["DB_STATEMENT_TIMEOUT"]:
+        # asyncpg does not take libpq options, so set the timeout as a server setting
+        timeout = str(app.config["DB_STATEMENT_TIMEOUT"])
+        options["connect_args"] = {"server_settings": {"statement_timeout": timeout}}
+    return options
+
+
+# The database used by the routes, configured when the app starts
+database = AsyncDatabase()
+
+
+######################################################################
+# GET HEALTH CHECK
+######################################################################
+async def healthcheck(request: Request):  # pylint: disable=unused-argument
+    """Let them know our heart is still beating"""
+    return JSONResponse({"status": 200, "message": "Healthy"})
+
+
+######################################################################
+#  PATH: /recommendations/{recommendation_id}
+######################################################################
+async def get_recommendation(request: Request):
+    """Retrieve a single recommendation"""
+    reco_id = request.path_params["recommendation_id"]
+    logger.info("Request for recommendations with id: %s", reco_id)
+    fields_requested = get_fields(request)
+    async with database.session() as session:
+        recommendation = await session.get(Recommendation, reco_id)
+    if recommendation is None:
+        abort(status.HTTP_404_NOT_FOUND, f"recommendations with id '{reco_id}' was not found.")
+    message = recommendation.serialize()
+    if fields_requested:
+        message = {field: message[field] for field in fields_requested}
+    etag = compute_etag(message)
+    return not_modified(request, etag) or JSONResponse(message, headers={"ETag": f'"{etag}"'})
+
+
+async def update_recommendation(request: Request):
+    """Update a recommendation"""
+    reco_id = request.path_params["recommendation_id"]
+    logger.info("Request to update recommendation with id: %s", reco_id)
+    check_content_type(request, "application/json")
+    data = await get_json(request)
+    if_match = parse_etags(request.headers.get("If-Match"))
+    async with database.session() as session:
+        # lock the row so it cannot change between the check and the update
+        recommendation = await session.get(
+            Recommendation, reco_id, with_for_update=bool(if_match), populate_existing=True)
+        if recommendation is None:
+            abort(status.HTTP_404_NOT_FOUND, f"Recommendation id {reco_id} does not exist")
+        if if_match and not if_match.contains(compute_etag(recommendation.serialize())):
+            abort(status.HTTP_412_PRECONDITION_FAILED, f"Recommendation id {reco_id} was changed by someone else")
+        old_name = recommendation.name
+        recommendation.deserialize(data)
+        await session.commit()
+        await refresh_lists(session, old_name, recommendation.name)
+    cache.invalidate(reco_id)
+    message = recommendation.serialize()
+    headers = {"Location": str(request.url_for("recommendation", recommendation_id=reco_id)),
+               "ETag": f'"{compute_etag(message)}"'}
+    return JSONResponse(message, headers=headers)
+
+
+async def delete_recommendation(request: Request):
+    """Delete a recommendation"""
+    reco_id = request.path_params["recommendation_id"]
+    logger.info("Request to delete recommendation with id: %s", reco_id)
+    table = Recommendation.__table__
+    async with database.session() as session:
+        names = (await session.execute(delete(table).where(table.c.id == reco_id).returning(table.c.name))).scalars().all()
+        await session.commit()
+        await refresh_lists(session, *names)
+    cache.invalidate(reco_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+#  PATH: /recommendations
+######################################################################
+async def list_recommendations(request: Request):
+    """Returns all of the Recommendations, or the ones with the given ids"""
+    logger.info("Request for Recommendations list")
+    fields = get_fields(request) or Recommendation.FIELDS
+    ids = get_ids(request)
+    if ids:
+        return await get_batch(request, ids, fields)
+    filters = Recommendation.parse_filters(request.query_params)
+    return await get_page(request, fields, request.query_params.get("sort") or "id", **filters)
+
+
+async def get_page(request: Request, fields: list, sort: str, **filters):
+    """Returns a page of the Recommendations that match the filters, with a Link to the next one"""
+    limit = get_page_limit(request)
+    statement = Recommendation.keyset(
+        Recommendation.select_serialized(fields, sort, **filters), request.query_params.get("cursor"), limit, sort)
+    async with database.session() as session:
+        rows = (await session.execute(statement)).all()
+    rows, next_cursor = Recommendation.next_page(rows, limit, sort)
+    headers = {}
+    if next_cursor:
+        next_url = request.url.include_query_params(cursor=next_cursor, limit=limit)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    results = [dict(zip(fields, row)) for row in rows]
+    logger.info("Returning %d recommendations", len(results))
+    etag = compute_etag(results)
+    headers["ETag"] = f'"{etag}"'
+    return not_modified(request, etag) or JSONResponse(results, headers=headers)
+
+
+async def get_batch(request: Request, ids: list, fields: list):
+    """Returns the recommendations with the given ids in the order they were asked for"""
+    logger.info("Request for %d Recommendations by id", len(ids))
+    statement = Recommendation.select_serialized(fields).where(Recommendation.id.in_(ids))
+    async with database.session() as session:
+        found = {row.id: dict(zip(fields, row)) for row in await session.execute(statement)}
+    results = [found[reco_id] for reco_id in ids if reco_id in found]
+    missing = [str(reco_id) for reco_id in ids if reco_id not in found]
+    etag = compute_etag(results)
+    headers = {"ETag": f'"{etag}"'}
+    if missing:
+        headers["X-Missing-Ids"] = ",".join(missing)
+    return not_modified(request, etag) or JSONResponse(results, headers=headers)
+
+
+async def create_recommendation(request: Request):
+    """Creates a Recommendation"""
+    logger.info("Request to create a recommendation")
+    check_content_type(request, "application/json")
+    recommendation = Recommendation().deserialize(await get_json(request))
+    async with database.session() as session:
+        session.add(recommendation)
+        await session.commit()
+        await refresh_lists(session, recommendation.name)
+    logger.info("Recommendation with ID [%s] created.", recommendation.id)
+    location_url = str(request.url_for("recommendation", recommendation_id=recommendation.id))
+    return JSONResponse(recommendation.serialize(), status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+#  PATH: /recommendations/top
+######################################################################
+async def top_recommendations(request: Request):
+    """Returns the most liked Recommendations"""
+    logger.info("Request for the top Recommendations")
+    statement = select(Recommendation)
+    name = request.query_params.get("name")
+    type_string = request.query_params.get("type")
+    if name:
+        statement = statement.where(Recommendation.name == name)
+    if type_string:
+        statement = statement.where(Recommendation.type == get_type(type_string))
+    limit = get_int(request, "n", flask_app.config["DEFAULT_TOP_SIZE"])
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "n must be a positive integer")
+    statement = statement.order_by(Recommendation.number_of_likes.desc().nullslast(), Recommendation.id)
+    async with database.session() as session:
+        recs = (await session.execute(statement.limit(min(limit, flask_app.config["MAX_PAGE_SIZE"])))).scalars().all()
+    return JSONResponse([rec.serialize() for rec in recs])
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+async def export_recommendations(request: Request):
+    """Exports the Recommendations as newline delimited JSON"""
+    logger.info("Request to export recommendations")
+    filters = Recommendation.parse_filters(request.query_params)
+    statement = Recommendation.select_serialized(Recommendation.FIELDS, **filters)
+
+    async def generate():
+        async with database.session() as session:
+            result = await session.stream(statement)
+            async for rows in result.partitions(flask_app.config["EXPORT_CHUNK_SIZE"]):
+                yield "".join(json.dumps(dict(zip(Recommendation.FIELDS, row))) + "\n" for row in rows)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+######################################################################
+#  PATH: /recommendations/{recommendation_id}/like and /dislike
+######################################################################
+async def like_recommendation(request: Request):
+    """Like a single Recommendation"""
+    return await add_likes(request, 1)
+
+
+async def dislike_recommendation(request: Request):
+    """Dislike a single Recommendation"""
+    return await add_likes(request, -1)
+
+
+async def add_likes(request: Request, amount: int):
+    """Atomically adds amount to the likes of the recommendation in the path"""
+    reco_id = request.path_params["recommendation_id"]
+    logger.info("Request to add %s likes to recommendation with id: %s", amount, reco_id)
+    async with database.session() as session:
+        patch_lists = RecommendationList.patches_likes(session)
+        row = (await session.execute(Recommendation.add_likes_statement(reco_id, amount, patch_lists))).first()
+        await session.commit()
+        if row is None and await session.get(Recommendation, reco_id) is not None:
+            raise DataValidationError("Recommendation already has 0 likes")
+        if row is not None and not patch_lists:
+            await refresh_lists(session, row.name)
+    if row is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Recommendation id {reco_id} does not exist")
+    cache.invalidate(reco_id)
+    if patch_lists:
+        list_cache.invalidate(row.name)
+    location_url = str(request.url_for("recommendation", recommendation_id=reco_id))
+    return JSONResponse(Recommendation(**row._mapping).serialize(), headers={"Location": location_url})
+
+
+######################################################################
+#  PATH: /products/{name}/recommendations
+######################################################################
+async def product_recommendations(request: Request):
+    """Returns the Recommendations for a product"""
+    name = request.path_params["name"]
+    logger.info("Request for the recommendation list of %s", name)
+    async with database.session() as session:
+        product_list = await session.get(RecommendationList, name)
+    results = product_list.recommendations if product_list else []
+    etag = compute_etag(results)
+    return not_modified(request, etag) or JSONResponse(results, headers={"ETag": f'"{etag}"'})
+
+
+######################################################################
+#  PATH: /products/{product_id}/recommended-by
+######################################################################
+async def product_recommended_by(request: Request):
+    """Returns the Recommendations of the products that recommend a product"""
+    product_id = request.path_params["product_id"]
+    logger.info("Request for the products that recommend %s", product_id)
+    fields = get_fields(request) or Recommendation.FIELDS
+    sort = request.query_params.get("sort") or Recommendation.RECOMMENDED_BY_SORT
+    return await get_page(request, fields, sort, recommendation_id=product_id)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def refresh_lists(session: AsyncSession, *names):
+    """Recomputes the lists of the products a write changed, like RecommendationList.refresh"""
+    names = sorted({name for name in names if name is not None})
+    try:
+        await session.run_sync(RecommendationList.refresh_in, names)
+        await session.commit()
+    except SQLAlchemyError as error:
+        await session.rollback()
+        logger.error("Could not refresh the recommendation lists of %s: %s", names, error)
+    list_cache.invalidate(*names)
+
+
+def abort(error_code: int, message: str):
+    """Logs errors before aborting"""
+    logger.error(message)
+    raise HTTPException(error_code, message)
+
+
+def check_content_type(request: Request, content_type: str):
+    """Checks that the media type is correct"""
+    if request.headers.get("Content-Type") != content_type:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"Content-Type must be {content_type}")
+
+
+async def get_json(request: Request):
+    """Returns the JSON body of the request"""
+    try:
+        return await request.json()
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "The browser (or proxy) sent a request that this server could not understand.")
+    return None
+
+
+def get_fields(request: Request):
+    """Returns the fields requested with the fields query argument, or None for all of them"""
+    fields_string = request.query_params.get("fields")
+    if not fields_string:
+        return None
+    return Recommendation.check_fields([field.strip() for field in fields_string.split(",")])
+
+
+def get_ids(request: Request):
+    """Returns the distinct ids asked for with the ids query argument, or None"""
+    ids_string = request.query_params.get("ids")
+    if not ids_string:
+        return None
+    try:
+        ids = list(dict.fromkeys(int(reco_id) for reco_id in ids_string.split(",")))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid ids {ids_string}")
+    if len(ids) > flask_app.config["MAX_BATCH_SIZE"]:
+        abort(status.HTTP_400_BAD_REQUEST, f"No more than {flask_app.config['MAX_BATCH_SIZE']} ids can be requested at once")
+    return ids
+
+
+def get_type(type_string: str) -> RecommendationType:
+    """Returns the RecommendationType with the given name"""
+    if type_string not in RecommendationType.__members__:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid type {type_string}")
+    return RecommendationType[type_string]
+
+
+def get_int(request: Request, name: str, default: int = None) -> int:
+    """Returns an integer query argument"""
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid {name} {value}")
+    return None
+
+
+def get_page_limit(request: Request) -> int:
+    """Returns the requested page size capped at the server maximum"""
+    limit = get_int(request, "limit", flask_app.config["DEFAULT_PAGE_SIZE"])
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+    return min(limit, flask_app.config["MAX_PAGE_SIZE"])
+
+
+def not_modified(request: Request, etag: str):
+    """Returns 304 Not Modified if the client sent a matching If-None-Match"""
+    if parse_etags(request.headers.get("If-None-Match")).contains(etag):
+        logger.info("Returning 304 for ETag %s", etag)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": f'"{etag}"'})
+    return None
+
+
+######################################################################
+#  E R R O R   H A N D L E R S
+######################################################################
+async def http_error(request: Request, error: HTTPException):  # pylint: disable=unused-argument
+    """Returns HTTP errors as JSON like flask-restx does"""
+    return JSONResponse({"message": error.detail}, error.status_code)
+
+
+async def request_validation_error(request: Request, error: DataValidationError):  # pylint: disable=unused-argument
+    """Handles Value Errors from bad data"""
+    message = str(error)
+    logger.error(message)
+    return JSONResponse({
+        "status_code": status.HTTP_400_BAD_REQUEST,
+        "error": "Bad Request",
+        "message": message,
+    }, status.HTTP_400_BAD_REQUEST)
+
+
+async def conflict_error(request: Request, error: IntegrityError):  # pylint: disable=unused-argument
+    """Handles writes that break a constraint, like the natural key of a recommendation"""
+    logger.error(str(error))
+    if Recommendation.duplicates_natural_key(error):
+        message = "A recommendation with this name, recommendation_id and type already exists"
+    else:
+        message = "The request conflicts with the data already stored"
+    return JSONResponse({
+        "status_code": status.HTTP_409_CONFLICT,
+        "error": "Conflict",
+        "message": message,
+    }, status.HTTP_409_CONFLICT)
+
+
+async def database_unavailable_error(request: Request, error: Exception):  # pylint: disable=unused-argument
+    """Handles pool exhaustion, lost connections and statement timeouts"""
+    logger.error(str(error))
+    return JSONResponse({
+        "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
+        "error": "Service Unavailable",
+        "message": "The database could not complete the request, please retry later",
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": "1"})
+
+
+routes = [
+    Route("/health", healthcheck),
+    Route(BASE_URL, list_recommendations, methods=["GET"]),
+    Route(BASE_URL, create_recommendation, methods=["POST"]),
+    Route(f"{BASE_URL}/top", top_recommendations, methods=["GET"]),
+    Route(f"{BASE_URL}/export", export_recommendations, methods=["GET"]),
+    Route(f"{BASE_URL}/{{recommendation_id:int}}", get_recommendation, methods=["GET"], name="recommendation"),
+    Route(f"{BASE_URL}/{{recommendation_id:int}}", update_recommendation, methods=["PUT"]),
+    Route(f"{BASE_URL}/{{recommendation_id:int}}", delete_recommendation, methods=["DELETE"]),
+    Route(f"{BASE_URL}/{{recommendation_id:int}}/like", like_recommendation, methods=["PUT"]),
+    Route(f"{BASE_URL}/{{recommendation_id:int}}/dislike", dislike_recommendation, methods=["PUT"]),
+    Route("/api/products/{name}/recommendations", product_recommendations, methods=["GET"]),
+    Route("/api/products/{product_id:int}/recommended-by", product_recommended_by, methods=["GET"]),
+]
+
+exception_handlers = {
+    HTTPException: http_error,
+    DataValidationError: request_validation_error,
+    IntegrityError: conflict_error,
+    PoolTimeoutError: database_unavailable_error,
+    OperationalError: database_unavailable_error,
+}
+
+app = Starlette(
+    routes=routes,
+    exception_handlers=exception_handlers,
+    on_startup=[lambda: database.init_app(flask_app)],
+    on_shutdown=[database.dispose],
+)
@@ -0,0 +1,68 @@
+"""
+Flask CLI commands
+
+Run them with the flask command, e.g. flask create-db or flask db upgrade
+"""
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from service import models, migrations
+
+
+@click.command("create-db")
+@with_appcontext
+def create_db():
+    """Creates or upgrades the database tables by running the migrations"""
+    models.create_schema()
+    click.echo("Database tables created")
+
+
+# flask db <command> runs the Alembic migrations in service/migrations
+db = AppGroup("db", help="Runs the database migrations")
+
+online_safe_option = click.option(
+    "--online-safe/--blocking", default=None,
+    help="Build indexes concurrently and backfill in batches, MIGRATION_ONLINE_SAFE by default")
+
+
+@db.command("upgrade")
+@click.argument("revision", default="head")
+@online_safe_option
+def upgrade(revision, online_safe):
+    """Runs the migrations up to a revision, the latest by default"""
+    migrations.upgrade(revision, online_safe)
+
+
+@db.command("downgrade")
+@click.argument("revision")
+@online_safe_option
+def downgrade(revision, online_safe):
+    """Reverts the migrations down to a revision, e.g. -1 or base"""
+    migrations.downgrade(revision, online_safe)
+
+
+@db.command("stamp")
+@click.argument("revision")
+def stamp(revision):
+    """Records a revision as applied without running any migration"""
+    migrations.stamp(revision)
+
+
+@db.command("revision")
+@click.option("-m", "--message", required=True, help="What the migration does")
+@click.option("--autogenerate", is_flag=True, help="Fill it in from the differences with the models")
+def revision(message, autogenerate):
+    """Creates a new migration script"""
+    migrations.revision(message, autogenerate)
+
+
+@db.command("current")
+def current():
+    """Prints the revision the database is at"""
+    click.echo(migrations.current_revision(models.db.get_engine(current_app)) or "none")
+
+
+@db.command("history")
+def history():
+    """Prints the migrations from the first to the latest"""
+    migrations.history()
@@ -0,0 +1,158 @@
+"""
+Cache
+
+Read-through caching with pluggable backends. Entries expire after a TTL,
+which bounds how stale a value can be when an invalidation is missed, for
+example when another worker process wrote the row.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-process cache that evicts the least recently used entries"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores value under key"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes everything from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Cache shared by all workers that stores JSON values in Redis
+
+    Any client with the redis-py interface can be used.
+    """
+
+    def __init__(self, client, ttl: float = 60, prefix: str = "cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """Returns the value for key, or None if missing or expired"""
+        value = self.client.get(self.prefix + str(key))
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        """Stores value under key"""
+        self.client.set(self.prefix + str(key), json.dumps(value), ex=max(1, int(self.ttl)))
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        if keys:
+            self.client.delete(*[self.prefix + str(key) for key in keys])
+
+    def clear(self):
+        """Removes everything with our prefix from the cache"""
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class Cache:
+    """Read-through cache in front of a backend that counts hits and misses
+
+    With no backend every lookup goes straight to the loader.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, prefix: str = "cache:"):
+        """Configures the backend from the Flask app config"""
+        backend = app.config["CACHE_BACKEND"]
+        ttl = app.config["CACHE_TTL"]
+        if backend == "memory":
+            self.backend = LRUCache(app.config["CACHE_MAX_SIZE"], ttl)
+        elif backend == "redis":
+            import redis  # pylint: disable=import-outside-toplevel
+            self.backend = RedisCache(redis.Redis.from_url(app.config["CACHE_REDIS_URL"]), ttl, prefix)
+        elif backend == "none":
+            self.backend = None
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND {backend}")
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for key, calling loader on a miss
+
+        Values of None are never cached.
+        """
+        if self.backend is None:
+            return loader()
+        value = self.backend.get(key)
+        if value is not None:
+            self._count(hit=True)
+            return value
+        self._count(hit=False)
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        """Removes keys from the cache after their values have changed"""
+        if self.backend is not None:
+            self.backend.delete(*keys)
+
+    def clear(self):
+        """Removes everything from the cache and resets the counters"""
+        if self.backend is not None:
+            self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters"""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__ if self.backend else None,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
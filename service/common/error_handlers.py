@@ -19,8 +19,10 @@ Error handlers
 Handles all of the HTTP Error Codes returning JSON messages
 """
 
-from service import app, api
-from service.models import DataValidationError
+from flask import current_app as app
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
+from service import api
+from service.models import DataValidationError, Recommendation, db
 from . import status
 
 ######################################################################
@@ -38,3 +40,44 @@ def request_validation_error(error):
         'error': 'Bad Request',
         'message': message
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(IntegrityError)
+def conflict_error(error):
+    """ Handles writes that break a constraint, like the natural key of a recommendation """
+    message = str(error)
+    app.logger.error(message)
+    db.session.rollback()
+    if Recommendation.duplicates_natural_key(error):
+        message = 'A recommendation with this name, recommendation_id and type already exists'
+    else:
+        message = 'The request conflicts with the data already stored'
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
+
+@api.errorhandler(PoolTimeoutError)
+def pool_timeout_error(error):
+    """ Handles requests that could not get a database connection in time """
+    message = str(error)
+    app.logger.error(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': 'The database is busy, please retry later'
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'}
+
+
+@api.errorhandler(OperationalError)
+def database_unavailable_error(error):
+    """ Handles lost connections and statements that hit the statement timeout """
+    message = str(error)
+    app.logger.error(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': 'The database could not complete the request, please retry later'
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'}
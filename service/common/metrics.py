@@ -0,0 +1,102 @@
+"""
+Metrics
+
+Prometheus metrics for the HTTP requests, the SQL statements and the
+connection pool. When PROMETHEUS_MULTIPROC_DIR is set every gunicorn worker
+writes its samples there and /metrics adds them up across the workers.
+"""
+import os
+import time
+from flask import Flask, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests", ["method", "endpoint"]
+)
+REQUEST_COUNT = Counter(
+    "http_requests_total", "HTTP requests handled", ["method", "endpoint", "status"]
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", multiprocess_mode="livesum"
+)
+SQL_DURATION = Histogram(
+    "sql_statement_duration_seconds", "Time spent executing SQL statements", ["statement"]
+)
+SQL_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool"
+)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - start)
+
+
+def init_metrics(app: Flask):
+    """Hooks the metrics into the Flask app and SQLAlchemy"""
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.teardown_request(_finish_request)
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        options.setdefault("poolclass", TimedQueuePool)
+    if not event.contains(Engine, "before_cursor_execute", _start_statement):
+        event.listen(Engine, "before_cursor_execute", _start_statement)
+        event.listen(Engine, "after_cursor_execute", _record_statement)
+
+
+def export_metrics():
+    """Returns the metrics in the Prometheus text format and its content type"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def _start_timer():
+    REQUESTS_IN_FLIGHT.inc()
+    g.metrics_start = time.perf_counter()
+
+
+def _record_request(response):
+    # label by route pattern so the number of label values stays bounded
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - g.metrics_start)
+    REQUEST_COUNT.labels(request.method, endpoint, response.status_code).inc()
+    return response
+
+
+def _finish_request(error=None):  # pylint: disable=unused-argument
+    if "metrics_start" in g:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+# the start time is kept on the execution context rather than the connection,
+# so nothing is left behind when a statement raises and its after event never
+# fires, and the statements run without a context are not timed
+def _start_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    start = getattr(context, "metrics_start", None)
+    if start is None:
+        return
+    kind = statement.lstrip()[:6].upper()
+    if kind not in SQL_STATEMENTS:
+        kind = "OTHER"
+    SQL_DURATION.labels(kind).observe(time.perf_counter() - start)
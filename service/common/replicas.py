@@ -0,0 +1,169 @@
+"""
+Read Replicas
+
+Routes the SELECT statements of GET requests to read replicas. Everything
+else stays on the primary: writes, SELECT ... FOR UPDATE, work done outside
+of a request, and every statement of a request that changes data. A client
+that has to read its own writes can send Cache-Control: no-cache to have a
+GET answered by the primary.
+"""
+import os
+import atexit
+import logging
+import threading
+from flask import Flask, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger("flask.app")
+
+
+class Replica:
+    """A read replica engine and its health"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+
+    def check(self) -> bool:
+        """Returns True if the replica answers a trivial query"""
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Read replica %s is down: %s", self.engine.url, error)
+            self.healthy = False
+        else:
+            self.healthy = True
+        return self.healthy
+
+
+class ReplicaSet:
+    """Hands out healthy replicas in round-robin order
+
+    A replica that fails its health check, or loses a connection, is skipped
+    until it passes a check again. The checks run every check_interval
+    seconds on a background thread, so that a replica that is slow to
+    connect never holds up a request.
+    """
+
+    def __init__(self, check_interval: float = 10):
+        self.check_interval = check_interval
+        self.replicas = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.stop)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def init_app(self, app: Flask, engine_options: dict = None):
+        """Creates an engine for each of the DATABASE_REPLICA_URIS"""
+        self.check_interval = app.config["DATABASE_REPLICA_CHECK_INTERVAL"]
+        self.replicas = []
+        self._next = 0
+        for uri in app.config["DATABASE_REPLICA_URIS"]:
+            options = {} if uri.startswith("sqlite") else dict(engine_options or {})
+            self.add(create_engine(uri, **options))
+
+    def add(self, engine):
+        """Adds a replica engine to the set"""
+        replica = Replica(engine)
+        event.listen(engine, "handle_error", lambda context: self._handle_error(replica, context))
+        self.replicas.append(replica)
+
+    def choose(self):
+        """Returns the engine of the next healthy replica, or None if there is none
+
+        Only the health found by the last checks is read, nothing is checked here.
+        """
+        if not self.replicas:
+            return None
+        self._start()
+        with self._lock:
+            candidates = self.replicas[self._next:] + self.replicas[:self._next]
+            self._next = (self._next + 1) % len(self.replicas)
+        for replica in candidates:
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def check(self):
+        """Checks the health of every replica"""
+        for replica in list(self.replicas):
+            replica.check()
+
+    def dispose(self):
+        """Stops the health checks and closes the connections to the replicas"""
+        self.stop()
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def stop(self):
+        """Stops the background health checks"""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+
+    def _start(self):
+        """Starts the background health checks in this process if needed"""
+        if self.check_interval <= 0:
+            return
+        # a thread does not survive a fork so each worker starts its own
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="replica-check", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.check_interval)
+
+    @staticmethod
+    def _handle_error(replica, context):
+        if context.is_disconnect:
+            replica.healthy = False
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of GET requests to a replica"""
+
+    def __init__(self, db, replicas: ReplicaSet = None, **options):
+        self.replicas = replicas
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replicas and self._can_use_replica(clause):
+            engine = self.replicas.choose()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def _can_use_replica(self, clause) -> bool:
+        if self._flushing or not isinstance(clause, Select):
+            return False
+        if clause._for_update_arg is not None:  # pylint: disable=protected-access
+            return False
+        if not has_request_context() or request.method not in ("GET", "HEAD"):
+            return False
+        return "no-cache" not in request.headers.get("Cache-Control", "")
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions route reads to a ReplicaSet"""
+
+    def __init__(self, *args, replicas: ReplicaSet = None, **kwargs):
+        self.replicas = replicas
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, replicas=self.replicas, **options)
@@ -0,0 +1,34 @@
+"""
+Representations
+
+Encodes the API responses as JSON with orjson when it is installed
+"""
+import json
+from flask import current_app, make_response
+from service import api
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Encodes data as JSON, falling back to the json module for types orjson does not know"""
+    if orjson is not None and not current_app.debug:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            pass
+    settings = dict(current_app.config.get("RESTX_JSON", {}))
+    if current_app.debug:
+        settings.setdefault("indent", 4)
+    return json.dumps(data, **settings).encode("utf-8")
+
+
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body"""
+    response = make_response(dumps(data) + b"\n", code)
+    response.headers.extend(headers or {})
+    return response
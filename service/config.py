@@ -12,5 +12,77 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Optional read replicas as a comma separated list of URIs
+# The SELECTs of GET requests are spread over the replicas, so a GET may not
+# see a write until the replica has caught up unless it sends Cache-Control: no-cache.
+# The replicas are checked every DATABASE_REPLICA_CHECK_INTERVAL seconds in the
+# background, and one that fails is skipped until it passes a check again.
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+DATABASE_REPLICA_CHECK_INTERVAL = float(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", "10"))
+
+# Connection pool and query limits, applied to the engine by init_db
+# A request that waits DB_POOL_TIMEOUT seconds for a connection gets a 503
+# instead of queueing behind a saturated pool. DB_POOL_RECYCLE is in seconds
+# and DB_STATEMENT_TIMEOUT in milliseconds; 0 disables the statement timeout.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "30000"))
+
+# Pagination for list queries
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Largest number of ids accepted by a batch get with ids=
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))
+
+# Read-through cache for single recommendation lookups
+# CACHE_BACKEND is one of "none", "memory" or "redis". The memory cache is
+# per worker, so other workers may serve a stale copy for up to CACHE_TTL seconds.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Number of recommendations returned by the top query
+DEFAULT_TOP_SIZE = int(os.getenv("DEFAULT_TOP_SIZE", "10"))
+
+# Number of rows written by each INSERT of a bulk create
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Number of rows fetched from the database at once by an export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Write-behind buffering of likes and dislikes
+# Likes are held in memory (or in Redis when LIKE_BUFFER_REDIS_URL is set)
+# for at most LIKE_FLUSH_INTERVAL seconds, which is how much could be lost
+# if a worker is killed without a chance to flush.
+LIKE_BUFFER_ENABLED = os.getenv("LIKE_BUFFER_ENABLED", "false").lower() in ("true", "1", "yes")
+LIKE_BUFFER_REDIS_URL = os.getenv("LIKE_BUFFER_REDIS_URL")
+LIKE_FLUSH_INTERVAL = float(os.getenv("LIKE_FLUSH_INTERVAL", "5"))
+LIKE_FLUSH_THRESHOLD = int(os.getenv("LIKE_FLUSH_THRESHOLD", "1000"))
+
+# In-memory snapshot serving mode for read-only replicas of the service
+# Each worker answers the GET requests from a copy of the recommendation
+# table that it refreshes every SNAPSHOT_REFRESH_INTERVAL seconds with the
+# rows written since SNAPSHOT_REFRESH_OVERLAP seconds before the last one it
+# saw, so reads can be that many seconds behind the writes. An interval of
+# 0 turns the background refresh off, to refresh with snapshot_server.refresh().
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "false").lower() in ("true", "1", "yes")
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "10"))
+SNAPSHOT_REFRESH_OVERLAP = float(os.getenv("SNAPSHOT_REFRESH_OVERLAP", "30"))
+
+# Schema migrations, run with flask db upgrade or flask create-db
+# Online-safe migrations build indexes concurrently, backfill in batches of
+# MIGRATION_BATCH_SIZE rows with a pause of MIGRATION_BATCH_PAUSE seconds
+# after each, and give up on a lock after MIGRATION_LOCK_TIMEOUT
+# milliseconds instead of queueing the writes behind them.
+MIGRATION_ONLINE_SAFE = os.getenv("MIGRATION_ONLINE_SAFE", "true").lower() in ("true", "1", "yes")
+MIGRATION_LOCK_TIMEOUT = int(os.getenv("MIGRATION_LOCK_TIMEOUT", "5000"))
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.1"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
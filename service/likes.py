@@ -0,0 +1,203 @@
+"""
+Like Buffer
+
+Write-behind aggregation of likes and dislikes. Instead of committing a
+transaction for every like, the increments are coalesced per recommendation
+id and flushed to the database in one batched UPDATE, either every
+LIKE_FLUSH_INTERVAL seconds or as soon as LIKE_FLUSH_THRESHOLD
+recommendations have pending likes.
+"""
+import os
+import atexit
+import logging
+import threading
+from flask import Flask
+from service.models import Recommendation, DataValidationError, db
+
+logger = logging.getLogger("flask.app")
+
+
+class MemoryLikeStore:
+    """Keeps the pending like deltas in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deltas = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._deltas)
+
+    def incr(self, reco_id: int, amount: int) -> int:
+        """Adds amount to the pending likes of a recommendation"""
+        with self._lock:
+            pending = self._deltas.get(reco_id, 0) + amount
+            self._deltas[reco_id] = pending
+            return pending
+
+    def pending(self, reco_id: int) -> int:
+        """Returns the likes of a recommendation that are not flushed yet"""
+        with self._lock:
+            return self._deltas.get(reco_id, 0)
+
+    def drain(self) -> dict:
+        """Removes and returns all of the pending deltas"""
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        return deltas
+
+    def restore(self, deltas: dict):
+        """Puts back deltas that could not be flushed"""
+        for reco_id, amount in deltas.items():
+            self.incr(reco_id, amount)
+
+
+class RedisLikeStore:
+    """Keeps the pending like deltas in a Redis hash shared by all workers
+
+    Any client with the redis-py interface can be used.
+    """
+
+    def __init__(self, client, key: str = "recommendation:likes"):
+        self.client = client
+        self.key = key
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+    def incr(self, reco_id: int, amount: int) -> int:
+        """Adds amount to the pending likes of a recommendation"""
+        return self.client.hincrby(self.key, reco_id, amount)
+
+    def pending(self, reco_id: int) -> int:
+        """Returns the likes of a recommendation that are not flushed yet"""
+        return int(self.client.hget(self.key, reco_id) or 0)
+
+    def drain(self) -> dict:
+        """Removes and returns all of the pending deltas"""
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(self.key)
+        pipeline.delete(self.key)
+        deltas, _ = pipeline.execute()
+        return {int(reco_id): int(amount) for reco_id, amount in deltas.items()}
+
+    def restore(self, deltas: dict):
+        """Puts back deltas that could not be flushed"""
+        for reco_id, amount in deltas.items():
+            self.incr(reco_id, amount)
+
+
+class LikeBuffer:
+    """Absorbs likes in a store and flushes them to the database in batches"""
+
+    def __init__(self, store=None):
+        self.app = None
+        self.store = store or MemoryLikeStore()
+        self.enabled = False
+        self.interval = 5.0
+        self.threshold = 1000
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        """Configures the buffer from the Flask app config"""
+        self.app = app
+        self.enabled = app.config["LIKE_BUFFER_ENABLED"]
+        self.interval = app.config["LIKE_FLUSH_INTERVAL"]
+        self.threshold = app.config["LIKE_FLUSH_THRESHOLD"]
+        if app.config["LIKE_BUFFER_REDIS_URL"]:
+            import redis  # pylint: disable=import-outside-toplevel
+            self.store = RedisLikeStore(redis.Redis.from_url(app.config["LIKE_BUFFER_REDIS_URL"]))
+        if self.enabled:
+            atexit.register(self.stop)
+
+    def like(self, reco_id: int):
+        """Buffers a like for the Recommendation with the given id
+
+        :return: the recommendation with its likes including the pending
+            ones, or None if not found
+        :rtype: Recommendation
+        """
+        return self._add(reco_id, 1)
+
+    def dislike(self, reco_id: int):
+        """Buffers a dislike for the Recommendation with the given id
+
+        :return: the recommendation with its likes including the pending
+            ones, or None if not found
+        :rtype: Recommendation
+        :raises DataValidationError: if the recommendation has 0 likes
+        """
+        return self._add(reco_id, -1)
+
+    def _add(self, reco_id: int, amount: int):
+        recommendation = Recommendation.find(reco_id)
+        if recommendation is None:
+            return None
+        # detach it so the adjusted count below is never written back
+        db.session.expunge(recommendation)
+        likes = recommendation.number_of_likes or 0
+        if likes + self.store.pending(reco_id) + amount < 0:
+            raise DataValidationError("Recommendation already has 0 likes")
+        pending = self.store.incr(reco_id, amount)
+        recommendation.number_of_likes = likes + pending
+        self._start()
+        if len(self.store) >= self.threshold:
+            self._wakeup.set()
+        return recommendation
+
+    def flush(self) -> dict:
+        """Writes all of the pending deltas to the database
+
+        :return: the new number of likes keyed by recommendation id
+        :rtype: dict
+        """
+        deltas = {reco_id: amount for reco_id, amount in self.store.drain().items() if amount}
+        if not deltas:
+            return {}
+        logger.info("Flushing likes for %d recommendations", len(deltas))
+        try:
+            with self.app.app_context():
+                return Recommendation.add_likes_in_bulk(deltas)
+        except Exception:
+            self.store.restore(deltas)
+            raise
+
+    def stop(self):
+        """Stops the background flusher and flushes what is left"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+        if self.app is not None:
+            self.flush()
+
+    def _start(self):
+        """Starts the background flusher in this process if needed"""
+        # a thread does not survive a fork so each worker starts its own
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="like-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Could not flush likes: %s", error)
+
+
+# The buffer used by the routes, configured from the app in service/__init__.py
+like_buffer = LikeBuffer()
@@ -0,0 +1,64 @@
+"""
+Database Migrations
+
+Alembic migrations for the tables of the service. They run on the database
+of the Flask app with the flask db commands, or with flask create-db which
+upgrades to the latest revision.
+
+With MIGRATION_ONLINE_SAFE on, the migrations are meant to run while the
+service is taking writes: they give up on a lock after MIGRATION_LOCK_TIMEOUT
+instead of queueing every write behind it, and the operations in
+service/migrations/online.py build indexes concurrently and backfill in
+small batches.
+"""
+import os
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from flask import current_app
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def alembic_config(online_safe: bool = None) -> Config:
+    """Returns the Alembic config for the migrations of the current app
+
+    :param online_safe: overrides MIGRATION_ONLINE_SAFE when not None
+    """
+    config = Config()
+    config.set_main_option("script_location", DIRECTORY)
+    if online_safe is None:
+        online_safe = current_app.config["MIGRATION_ONLINE_SAFE"]
+    config.attributes["online_safe"] = online_safe
+    return config
+
+
+def upgrade(revision: str = "head", online_safe: bool = None):
+    """Runs the migrations up to the revision"""
+    command.upgrade(alembic_config(online_safe), revision)
+
+
+def downgrade(revision: str, online_safe: bool = None):
+    """Reverts the migrations down to the revision"""
+    command.downgrade(alembic_config(online_safe), revision)
+
+
+def stamp(revision: str):
+    """Records the revision as applied without running any migration"""
+    command.stamp(alembic_config(), revision)
+
+
+def revision(message: str, autogenerate: bool = False):
+    """Creates a new migration script in service/migrations/versions"""
+    command.revision(alembic_config(), message=message, autogenerate=autogenerate)
+
+
+def history():
+    """Prints the migrations from the first to the latest"""
+    command.history(alembic_config())
+
+
+def current_revision(engine) -> str:
+    """Returns the revision the database is at, or None if it has none"""
+    with engine.connect() as connection:
+        return MigrationContext.configure(connection).get_current_revision()
@@ -0,0 +1,59 @@
+"""
+Alembic environment
+
+Runs the migrations on the database of the current Flask app, each one in
+its own transaction so that online-safe operations can step out of it.
+"""
+from alembic import context
+from flask import current_app
+from sqlalchemy import text
+from service.models import db
+
+config = context.config
+settings = current_app.config
+
+
+def options() -> dict:
+    """Returns the settings that service/migrations/online.py reads from the context"""
+    return {
+        "target_metadata": db.metadata,
+        "transaction_per_migration": True,
+        "online_safe": config.attributes.get("online_safe", settings["MIGRATION_ONLINE_SAFE"]),
+        "batch_size": settings["MIGRATION_BATCH_SIZE"],
+        "batch_pause": settings["MIGRATION_BATCH_PAUSE"],
+    }
+
+
+def run_migrations_offline():
+    """Prints the SQL of the migrations instead of running them"""
+    context.configure(url=settings["SQLALCHEMY_DATABASE_URI"], literal_binds=True, **options())
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Runs the migrations on a connection of the app's engine"""
+    opts = options()
+    with db.engine.connect() as connection:
+        postgresql = connection.dialect.name == "postgresql"
+        if postgresql:
+            # no statement timeout for index builds and backfills, but a lock
+            # timeout so a blocked migration fails instead of blocking writes
+            lock_timeout = settings["MIGRATION_LOCK_TIMEOUT"] if opts["online_safe"] else 0
+            with connection.begin():
+                connection.execute(text(f"SET statement_timeout = 0; SET lock_timeout = {int(lock_timeout)}"))
+        try:
+            context.configure(connection=connection, **opts)
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            if postgresql:
+                # the connection goes back to the pool of the app
+                with connection.begin():
+                    connection.execute(text("RESET statement_timeout; RESET lock_timeout"))
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
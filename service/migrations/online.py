@@ -0,0 +1,111 @@
+"""
+Online-safe migration operations
+
+Use these in the migration scripts instead of the plain op calls for the
+recommendation tables, which take writes all the time. When the migrations
+run with online_safe on:
+
+  create_index and drop_index use CREATE/DROP INDEX CONCURRENTLY on
+  PostgreSQL, outside of the migration's transaction, so writes go on while
+  the index is built
+  backfill updates the rows in batches of ids, each batch in a transaction
+  of its own and followed by a pause, so that only a few rows are locked
+  at a time and the replicas keep up
+
+With online_safe off, or on other databases, they are the plain operations
+in the migration's transaction. They all skip work that is already done, so
+a migration that failed halfway can be run again.
+"""
+import time
+import logging
+import sqlalchemy as sa
+from alembic import op
+
+logger = logging.getLogger("flask.app")
+
+
+def online_safe() -> bool:
+    """Returns True if the migrations run while the service is taking writes"""
+    return op.get_context().opts.get("online_safe", False)
+
+
+def _concurrently() -> bool:
+    return online_safe() and op.get_bind().dialect.name == "postgresql"
+
+
+def has_index(table: str, name: str) -> bool:
+    """Returns True if the table has an index with the name"""
+    return any(index["name"] == name for index in sa.inspect(op.get_bind()).get_indexes(table))
+
+
+def create_index(name: str, table: str, columns: list, **kwargs):
+    """Creates an index unless it exists, without blocking writes on PostgreSQL
+
+    A concurrent build that fails leaves an invalid index behind, which is
+    dropped and built again.
+
+    :param columns: column names or sa.text() expressions, e.g.
+        sa.text("number_of_likes DESC NULLS LAST")
+    """
+    if not _concurrently():
+        if not has_index(table, name):
+            op.create_index(name, table, columns, **kwargs)
+        return
+    with op.get_context().autocommit_block():
+        invalid = op.get_bind().execute(
+            sa.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+        ).scalar()
+        if invalid:
+            logger.warning("Dropping the invalid index %s left by a failed build", name)
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+        elif invalid is not None:
+            return  # it exists and is valid
+        logger.info("Building index %s concurrently", name)
+        op.create_index(name, table, columns, postgresql_concurrently=True, **kwargs)
+
+
+def drop_index(name: str, table: str):
+    """Drops an index if it exists, without blocking writes on PostgreSQL"""
+    if not has_index(table, name):
+        return
+    if not _concurrently():
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+
+def backfill(table: str, values: dict, where=None, batch_size: int = None, pause: float = None) -> int:
+    """Sets column values on the rows of a table, in batches of ids when online
+
+    :param table: the name of a table with an integer id primary key
+    :param values: the new value of each column, e.g. {"number_of_likes": 0}
+        or {"name": sa.text("lower(name)")}
+    :param where: a clause the rows must match, e.g. sa.text("number_of_likes IS NULL")
+    :param batch_size: the most ids updated by each batch, MIGRATION_BATCH_SIZE by default
+    :param pause: the seconds to sleep between batches, MIGRATION_BATCH_PAUSE by default
+    :return: the number of rows updated
+    """
+    opts = op.get_context().opts
+    rows = sa.table(table, sa.column("id"), *[sa.column(name) for name in values])
+    statement = sa.update(rows).values(values)
+    if where is not None:
+        statement = statement.where(where)
+    if not online_safe():
+        return op.get_bind().execute(statement).rowcount
+    batch_size = batch_size or opts.get("batch_size", 1000)
+    pause = opts.get("batch_pause", 0) if pause is None else pause
+    lowest, highest = op.get_bind().execute(sa.select(sa.func.min(rows.c.id), sa.func.max(rows.c.id))).one()
+    if lowest is None:
+        return 0
+    updated = 0
+    with op.get_context().autocommit_block():
+        # the block has its own connection, each statement commits on its own
+        bind = op.get_bind()
+        for start in range(lowest - 1, highest, batch_size):
+            batch = statement.where(rows.c.id > start, rows.c.id <= start + batch_size)
+            updated += bind.execute(batch).rowcount
+            logger.info("Backfilled %s up to id %d, %d rows so far", table, min(start + batch_size, highest), updated)
+            if pause:
+                time.sleep(pause)
+    return updated
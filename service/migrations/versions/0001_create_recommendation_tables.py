@@ -0,0 +1,85 @@
+"""Create the recommendation tables
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+The tables were made by db.create_all() before there were migrations, so
+this only creates the tables and indexes that do not exist yet, and builds
+the product lists when their table is new.
+"""
+from alembic import op
+import sqlalchemy as sa
+from service.migrations import online
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+RECOMMENDATION_TYPE = sa.Enum("CROSSSELL", "UPSELL", "ACCESSORY", name="recommendationtype")
+
+# the lists as the service built them when this was written, kept here so
+# that later changes to the models do not change what the migration does
+ENTRY = """
+    'id', id, 'name', name, 'recommendation_id', recommendation_id,
+    'recommendation_name', recommendation_name, 'type', type, 'number_of_likes', number_of_likes
+"""
+BUILD_LISTS = {
+    "postgresql": f"""
+        INSERT INTO recommendation_list (name, recommendations)
+        SELECT name, json_agg(json_build_object({ENTRY}) ORDER BY type, number_of_likes DESC NULLS LAST, id)
+        FROM recommendation WHERE name IS NOT NULL GROUP BY name
+        ON CONFLICT (name) DO UPDATE SET recommendations = excluded.recommendations
+    """,
+    # SQLite aggregates the rows in the order of the subquery
+    "sqlite": f"""
+        INSERT INTO recommendation_list (name, recommendations)
+        SELECT name, json_group_array(json_object({ENTRY})) FROM (
+            SELECT * FROM recommendation WHERE name IS NOT NULL
+            ORDER BY name, type, number_of_likes DESC NULLS LAST, id
+        ) WHERE true GROUP BY name
+        ON CONFLICT (name) DO UPDATE SET recommendations = excluded.recommendations
+    """,
+}
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if "recommendation" not in tables:
+        op.create_table(
+            "recommendation",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("name", sa.String(63)),
+            sa.Column("recommendation_id", sa.Integer),
+            sa.Column("recommendation_name", sa.String(63)),
+            sa.Column("type", RECOMMENDATION_TYPE, nullable=False, server_default="UPSELL"),
+            sa.Column("number_of_likes", sa.Integer),
+        )
+    if "recommendation_list" not in tables:
+        op.create_table(
+            "recommendation_list",
+            sa.Column("name", sa.String(63), primary_key=True),
+            sa.Column("recommendations", sa.JSON, nullable=False),
+        )
+        build_lists()
+    likes = sa.text("number_of_likes DESC NULLS LAST")
+    online.create_index("ix_recommendation_name_type_likes", "recommendation", ["name", "type", likes])
+    online.create_index("ix_recommendation_name_likes", "recommendation", ["name", likes])
+    online.create_index("ix_recommendation_type", "recommendation", ["type"])
+    online.create_index("ix_recommendation_recommendation_id", "recommendation", ["recommendation_id"])
+    online.create_index("ix_recommendation_recommendation_name", "recommendation", ["recommendation_name"])
+    online.create_index("ix_recommendation_number_of_likes", "recommendation", [likes])
+
+
+def build_lists():
+    """Builds the list of every product that already has recommendations"""
+    bind = op.get_bind()
+    bind.execute(sa.text(BUILD_LISTS[bind.dialect.name]))
+
+
+def downgrade():
+    op.drop_table("recommendation_list")
+    op.drop_table("recommendation")
+    RECOMMENDATION_TYPE.drop(op.get_bind(), checkfirst=True)
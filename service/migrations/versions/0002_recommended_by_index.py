@@ -0,0 +1,31 @@
+"""Index the recommendations by recommended product and likes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 00:00:00
+
+The reverse lookup of the products that recommend a product pages through
+the recommendations with its recommendation_id, most liked first. The new
+index answers it without a sort, and replaces the recommendation_id index
+which is its leading column.
+"""
+import sqlalchemy as sa
+from service.migrations import online
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    online.create_index(
+        "ix_recommendation_recommendation_id_likes", "recommendation",
+        ["recommendation_id", sa.text("number_of_likes DESC NULLS LAST"), sa.text("id DESC")])
+    online.drop_index("ix_recommendation_recommendation_id", "recommendation")
+
+
+def downgrade():
+    online.create_index("ix_recommendation_recommendation_id", "recommendation", ["recommendation_id"])
+    online.drop_index("ix_recommendation_recommendation_id_likes", "recommendation")
@@ -0,0 +1,85 @@
+"""Make the natural key of the recommendations unique
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 00:00:00
+
+A recommendation is identified by its name, recommendation_id and type.
+The duplicates that were created before this are merged into the oldest
+one, which gets the likes of all of them, and then the unique index that
+the upserts use is built. If duplicates are created while the index is
+built concurrently the build fails, and running the migration again merges
+them and builds it again.
+"""
+from alembic import op
+import sqlalchemy as sa
+from service.migrations import online
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# the oldest recommendation of each natural key that has more than one,
+# rows with a NULL in the key are never duplicates of one another
+KEPT = """
+    SELECT MIN(id) FROM recommendation
+    WHERE name IS NOT NULL AND recommendation_id IS NOT NULL
+    GROUP BY name, recommendation_id, type HAVING COUNT(*) > 1
+"""
+SAME_KEY = "d.name = k.name AND d.recommendation_id = k.recommendation_id AND d.type = k.type"
+
+# the lists as the service built them when this was written, kept here so
+# that later changes to the models do not change what the migration does
+ENTRY = """
+    'id', id, 'name', name, 'recommendation_id', recommendation_id,
+    'recommendation_name', recommendation_name, 'type', type, 'number_of_likes', number_of_likes
+"""
+BUILD_LISTS = {
+    "postgresql": f"""
+        INSERT INTO recommendation_list (name, recommendations)
+        SELECT name, json_agg(json_build_object({ENTRY}) ORDER BY type, number_of_likes DESC NULLS LAST, id)
+        FROM recommendation WHERE name IN :names GROUP BY name
+        ON CONFLICT (name) DO UPDATE SET recommendations = excluded.recommendations
+    """,
+    # SQLite aggregates the rows in the order of the subquery
+    "sqlite": f"""
+        INSERT INTO recommendation_list (name, recommendations)
+        SELECT name, json_group_array(json_object({ENTRY})) FROM (
+            SELECT * FROM recommendation WHERE name IN :names
+            ORDER BY name, type, number_of_likes DESC NULLS LAST, id
+        ) WHERE true GROUP BY name
+        ON CONFLICT (name) DO UPDATE SET recommendations = excluded.recommendations
+    """,
+}
+
+
+def upgrade():
+    merge_duplicates()
+    online.create_index(
+        "uq_recommendation_natural_key", "recommendation", ["name", "recommendation_id", "type"], unique=True)
+
+
+def merge_duplicates():
+    """Merges the recommendations with the same natural key into the oldest one"""
+    bind = op.get_bind()
+    names = bind.execute(sa.text(f"SELECT name FROM recommendation WHERE id IN ({KEPT})")).scalars().all()
+    if not names:
+        return
+    bind.execute(sa.text(f"""
+        UPDATE recommendation AS k SET number_of_likes = (
+            SELECT SUM(COALESCE(d.number_of_likes, 0)) FROM recommendation d WHERE {SAME_KEY}
+        ) WHERE k.id IN ({KEPT})
+    """))
+    bind.execute(sa.text(f"""
+        DELETE FROM recommendation AS d WHERE EXISTS (
+            SELECT 1 FROM recommendation k WHERE {SAME_KEY} AND k.id < d.id
+        )
+    """))
+    statement = sa.text(BUILD_LISTS[bind.dialect.name]).bindparams(sa.bindparam("names", expanding=True))
+    bind.execute(statement, {"names": sorted(set(names))})
+
+
+def downgrade():
+    online.drop_index("uq_recommendation_natural_key", "recommendation")
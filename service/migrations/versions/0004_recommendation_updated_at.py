@@ -0,0 +1,33 @@
+"""Record when each recommendation was last written
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 00:00:00
+
+The snapshots read the rows written since their last refresh through the
+index on updated_at. Adding a column with a default does not rewrite the
+table on PostgreSQL 11 and later, the rows that already exist get the time
+of the migration.
+"""
+from alembic import op
+import sqlalchemy as sa
+from service.migrations import online
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = [column["name"] for column in sa.inspect(op.get_bind()).get_columns("recommendation")]
+    if "updated_at" not in columns:
+        op.add_column("recommendation", sa.Column(
+            "updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()))
+    online.create_index("ix_recommendation_updated_at", "recommendation", ["updated_at"])
+
+
+def downgrade():
+    online.drop_index("ix_recommendation_updated_at", "recommendation")
+    op.drop_column("recommendation", "updated_at")
@@ -3,22 +3,95 @@ Models for YourResourceModel
 
 All of the models are stored in this module
 """
+import json
+import base64
+import binascii
+import itertools
 import logging
+import operator
 from enum import Enum
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, column, inspect, literal_column, or_, select, tuple_, values
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import CreateIndex
+from service.common.cache import Cache
+from service.common.replicas import ReplicaSet, RoutingSQLAlchemy
+from service import migrations
 
 logger = logging.getLogger("flask.app")
 
+# Read replicas for GET requests, configured in init_db()
+replicas = ReplicaSet()
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy(replicas=replicas)
+
+# Cache of serialized recommendations keyed by id, configured in init_db()
+cache = Cache()
+
+# Cache of the precomputed recommendation lists keyed by product name
+list_cache = Cache()
 
 
 def init_db(app):
-    """Initialize the SQLAlchemy app"""
+    """Initialize the SQLAlchemy app and create the tables"""
     Recommendation.init_db(app)
 
 
+def init_app(app: Flask):
+    """Configures the database, the replicas and the caches without connecting"""
+    configure_engine(app)
+    replicas.init_app(app, app.config.get("SQLALCHEMY_ENGINE_OPTIONS"))
+    # This is where we initialize SQLAlchemy from the Flask app
+    db.init_app(app)
+    cache.init_app(app, prefix="recommendation:")
+    list_cache.init_app(app, prefix="recommendation-list:")
+
+
+def dialect_insert(table):
+    """Returns an INSERT that can take an ON CONFLICT clause in the dialect of the session"""
+    if db.session.bind.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+def create_schema():
+    """Runs the migrations up to the latest revision, in an app context"""
+    logger.info("Migrating the database to the latest revision")
+    migrations.upgrade()
+
+
+def configure_engine(app: Flask):
+    """Adds the pool and statement timeout settings to the engine options"""
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if uri.startswith("sqlite"):
+        return  # sqlite does not use a QueuePool
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    options.update(
+        pool_size=app.config["DB_POOL_SIZE"],
+        max_overflow=app.config["DB_MAX_OVERFLOW"],
+        pool_timeout=app.config["DB_POOL_TIMEOUT"],
+        pool_recycle=app.config["DB_POOL_RECYCLE"],
+        pool_pre_ping=app.config["DB_POOL_PRE_PING"],
+    )
+    if uri.startswith("postgres") and app.config["DB_STATEMENT_TIMEOUT"]:
+        connect_args = options.setdefault("connect_args", {})
+        connect_args["options"] = f"-c statement_timeout={app.config['DB_STATEMENT_TIMEOUT']}"
+
+
+@compiles(CreateIndex, "sqlite")
+def create_sqlite_index(create, compiler, **kwargs):
+    """Drops NULLS LAST from the indexes, which SQLite rejects
+
+    SQLite already sorts NULLs last in a descending index, which is the only
+    way the indexes use it.
+    """
+    return compiler.visit_create_index(create, **kwargs).replace(" NULLS LAST", "")
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
@@ -34,9 +107,25 @@ class Recommendation(db.Model):
     """
     Class that represents a Recommendation
     """
+    # Indexes for the find_by_* and find_top queries, the name index is the
+    # leading column of the (name, type, number_of_likes) index and the
+    # recommendation_id one of the index for find_recommended_by
+    __table_args__ = (
+        db.Index("ix_recommendation_name_type_likes", "name", "type", db.desc("number_of_likes").nullslast()),
+        db.Index("ix_recommendation_name_likes", "name", db.desc("number_of_likes").nullslast()),
+        db.Index("ix_recommendation_type", "type"),
+        db.Index("ix_recommendation_recommendation_id_likes", "recommendation_id",
+                 db.desc("number_of_likes").nullslast(), db.desc("id")),
+        db.Index("ix_recommendation_recommendation_name", "recommendation_name"),
+        db.Index("ix_recommendation_number_of_likes", db.desc("number_of_likes").nullslast()),
+        db.Index("uq_recommendation_natural_key", "name", "recommendation_id", "type", unique=True),
+        db.Index("ix_recommendation_updated_at", "updated_at"),
+    )
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
+    # the old name is loaded before a rename so both product lists are refreshed
+    name = db.column_property(db.Column(db.String(63)), active_history=True)
     recommendation_id = db.Column(db.Integer)
     recommendation_name = db.Column(db.String(63))
     type = db.Column(
@@ -44,6 +133,38 @@ class Recommendation(db.Model):
         nullable=False, server_default=(RecommendationType.UPSELL.name)
     )
     number_of_likes = db.Column(db.Integer, default=0)
+    # when the row was last written, for the snapshots to read the changes
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, server_default=db.func.now(), onupdate=db.func.now())
+
+    # The fields of a serialized Recommendation
+    FIELDS = ("id", "name", "recommendation_id", "recommendation_name", "type", "number_of_likes")
+
+    # The filters of the list and export queries: the column each one is
+    # compared to, the comparison, and the type of its query string value
+    FILTERS = {
+        "id": ("id", operator.eq, int),
+        "name": ("name", operator.eq, str),
+        "recommendation_id": ("recommendation_id", operator.eq, int),
+        "recommendation_name": ("recommendation_name", operator.eq, str),
+        "type": ("type", operator.eq, RecommendationType),
+        "number_of_likes": ("number_of_likes", operator.eq, int),
+        "min_likes": ("number_of_likes", operator.ge, int),
+        "max_likes": ("number_of_likes", operator.le, int),
+    }
+
+    # The columns pages can be sorted by, a leading - sorts them descending
+    SORTS = ("id", "name", "recommendation_id", "recommendation_name", "number_of_likes")
+
+    # The order of the recommendations that point at a product
+    RECOMMENDED_BY_SORT = "-number_of_likes"
+
+    # The columns that identify a recommendation, and the index that makes them unique
+    NATURAL_KEY = ("name", "recommendation_id", "type")
+    NATURAL_KEY_INDEX = "uq_recommendation_natural_key"
+
+    # The values that fit in the Integer columns
+    INTEGER_RANGE = range(-2**31, 2**31)
 
     def create(self):
         """
@@ -54,6 +175,7 @@ class Recommendation(db.Model):
         self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
         db.session.commit()
+        RecommendationList.refresh(self.name)
 
     def update(self):
         """
@@ -62,7 +184,12 @@ class Recommendation(db.Model):
         logger.info("Updating %s", self.name)
         if self.id is None:
             raise DataValidationError("Recommendation id is not provided!")
+        reco_id = self.id
+        # a rename moves the recommendation from one product list to another
+        names = [self.name, *inspect(self).attrs.name.history.deleted]
         db.session.commit()
+        cache.invalidate(reco_id)
+        RecommendationList.refresh(*names)
 
     def like(self):
         """
@@ -71,8 +198,10 @@ class Recommendation(db.Model):
         logger.info("Updating %s", self.name)
         if self.id is None:
             raise DataValidationError("Recommendation id is not provided!")
-        self.number_of_likes += 1
-        db.session.commit()
+        row = self._add_likes(self.id, 1)
+        if row is None:
+            raise DataValidationError(f"Recommendation {self.id} no longer exists")
+        set_committed_value(self, "number_of_likes", row.number_of_likes)
 
     def dislike(self):
         """
@@ -81,16 +210,19 @@ class Recommendation(db.Model):
         logger.info("Updating %s", self.name)
         if self.id is None:
             raise DataValidationError("Recommendation id is not provided!")
-        if self.number_of_likes == 0:
+        row = self._add_likes(self.id, -1)
+        if row is None:
             raise DataValidationError("Recommendation already has 0 likes")
-        self.number_of_likes -= 1
-        db.session.commit()
+        set_committed_value(self, "number_of_likes", row.number_of_likes)
 
     def delete(self):
         """ Removes a Recommendation from the data store """
         logger.info("Deleting %s", self.name)
+        reco_id, name = self.id, self.name
         db.session.delete(self)
         db.session.commit()
+        cache.invalidate(reco_id)
+        RecommendationList.refresh(name)
 
     def serialize(self):
         """ Serializes a Recommendation into a dictionary """
@@ -112,14 +244,14 @@ class Recommendation(db.Model):
             data (dict): A dictionary containing the resource data
         """
         try:
-            self.name = data["name"]
-            self.recommendation_id = data["recommendation_id"]
-            self.recommendation_name = data["recommendation_name"]
+            self.name = self._check_value("name", data["name"])
+            self.recommendation_id = self._check_value("recommendation_id", data["recommendation_id"])
+            self.recommendation_name = self._check_value("recommendation_name", data["recommendation_name"])
             self.type = getattr(RecommendationType, data["type"])
             if ("number_of_likes" not in data or data["number_of_likes"] == ''):
                 self.number_of_likes = 0
             else:
-                self.number_of_likes = data["number_of_likes"]
+                self.number_of_likes = self._check_value("number_of_likes", data["number_of_likes"])
         except AttributeError as error:
             raise DataValidationError(
                                         "Invalid attribute "
@@ -135,15 +267,67 @@ class Recommendation(db.Model):
             ) from error
         return self
 
+    @classmethod
+    def _check_value(cls, name: str, value):
+        """Returns a value that fits in the column, so that one bad value
+        is rejected on its own instead of failing the INSERT it is part of
+
+        Integers can be sent as strings, as the forms of the UI do
+
+        :raises DataValidationError: if it is not a string that fits in a
+            String column or an integer in the INTEGER_RANGE
+        """
+        if value is None:
+            return None
+        column_type = cls.__table__.c[name].type
+        if isinstance(column_type, db.String):
+            if not isinstance(value, str) or len(value) > column_type.length:
+                raise DataValidationError(
+                    f"Invalid {name}: must be a string of at most {column_type.length} characters")
+            return value
+        try:
+            if isinstance(value, (bool, float)):
+                raise ValueError(value)
+            value = int(value)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid {name}: must be an integer") from error
+        if value not in cls.INTEGER_RANGE:
+            raise DataValidationError(f"Invalid {name}: {value} is out of range")
+        return value
+
+    def natural_key(self) -> tuple:
+        """Returns the values of the NATURAL_KEY columns"""
+        return tuple(getattr(self, name) for name in self.NATURAL_KEY)
+
+    def check_natural_key(self):
+        """Checks that the natural key is set, as one with a None in it matches no other
+
+        :raises DataValidationError: if one of the NATURAL_KEY columns is None
+        """
+        if None in self.natural_key():
+            raise DataValidationError("Invalid Recommendation: name, recommendation_id and type must be set")
+
+    def upsert(self) -> bool:
+        """
+        Creates a Recommendation, or updates the one with the same natural key
+
+        :return: True if it was created, False if it was updated
+        """
+        logger.info("Upserting %s", self.name)
+        return self.upsert_in_bulk([self])[0]
+
     @classmethod
     def init_db(cls, app: Flask):
-        """ Initializes the database session """
+        """ Initializes the database session and creates the tables
+
+        Used by the tests and scripts, it leaves an app context pushed so
+        that the database can be used outside of a request.
+        """
         logger.info("Initializing database")
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        create_schema()
 
     @classmethod
     def all(cls) -> list:
@@ -162,6 +346,51 @@ class Recommendation(db.Model):
         logger.info("Processing lookup for id %s ...", reco_id)
         return cls.query.get(reco_id)
 
+    @classmethod
+    def find_for_update(cls, reco_id: int):
+        """Finds a recommendation by it's ID and locks it until the next commit
+        :param reco_id: the id of the recommendation to find
+        :type reco_id: int
+        :return: an instance with the reco_id, or None if not found
+        :rtype: Recommendation
+        """
+        logger.info("Processing locking lookup for id %s ...", reco_id)
+        return cls.query.filter(cls.id == reco_id).with_for_update().populate_existing().first()
+
+    @classmethod
+    def find_serialized(cls, reco_id: int):
+        """Finds a serialized recommendation by it's ID, reading through the cache
+        :param reco_id: the id of the recommendation to find
+        :type reco_id: int
+        :return: the serialized recommendation, or None if not found
+        :rtype: dict
+        """
+        logger.info("Processing cached lookup for id %s ...", reco_id)
+
+        def load():
+            recommendation = cls.find(reco_id)
+            return recommendation.serialize() if recommendation else None
+
+        return cache.get_or_load(reco_id, load)
+
+    @classmethod
+    def find_many(cls, ids: list, fields: list = None):
+        """Finds serialized recommendations by their IDs with a single query
+
+        :param ids: the ids of the recommendations to find
+        :param fields: the fields to include in each recommendation, or None for all
+        :return: the recommendations in the order of ids and the ids that
+            were not found
+        :rtype: tuple
+        """
+        logger.info("Processing batch lookup for %d ids ...", len(ids))
+        fields = cls.check_fields(fields or cls.FIELDS)
+        statement = cls.select_serialized(fields).where(cls.id.in_(ids))
+        found = {row.id: dict(zip(fields, row)) for row in db.session.execute(statement)}
+        results = [found[reco_id] for reco_id in ids if reco_id in found]
+        missing = [reco_id for reco_id in ids if reco_id not in found]
+        return results, missing
+
     @classmethod
     def find_or_404(cls, recommendation_id: int):
         """Finds a recmmendation by it's ID
@@ -195,3 +424,784 @@ class Recommendation(db.Model):
         logger.info("Processing type query for %s ...",
                     recommendation_type.name)
         return cls.query.filter(cls.type == recommendation_type)
+
+    @classmethod
+    def find_recommended_by(cls, product_id: int):
+        """Returns a query for the recommendations of the products that recommend a product
+
+        This is the reverse of the product lists, the name of each one is a
+        product that recommends product_id. Paged in RECOMMENDED_BY_SORT order
+        it is read straight from ix_recommendation_recommendation_id_likes.
+
+        :param product_id: the id of the recommended product
+        """
+        logger.info("Processing reverse lookup query for %s ...", product_id)
+        return cls.query.filter(cls.recommendation_id == product_id)
+
+    @classmethod
+    def find_by_filters(cls, **filters):
+        """Returns a query for the recommendations that match all of the filters
+
+        Every filter becomes a clause of the WHERE of a single query, so any
+        combination of them is answered by the database from its indexes.
+
+        :param filters: values for the FILTERS, e.g. name="shoe", min_likes=10
+        :raises DataValidationError: if a filter is not one of the FILTERS
+        """
+        logger.info("Processing query with filters %s ...", filters)
+        return cls.query.filter(*cls.filter_clauses(filters))
+
+    @classmethod
+    def filter_clauses(cls, filters: dict) -> list:
+        """Returns the WHERE clauses for the filters
+
+        :raises DataValidationError: if a filter is not one of the FILTERS
+        """
+        table = cls.__table__
+        clauses = []
+        for name, value in filters.items():
+            if name not in cls.FILTERS:
+                raise DataValidationError("Invalid filter " + name)
+            column_name, compare, _ = cls.FILTERS[name]
+            clauses.append(compare(table.c[column_name], value))
+        return clauses
+
+    @classmethod
+    def parse_filters(cls, args) -> dict:
+        """Converts the FILTERS found in query string arguments to their types
+
+        :param args: a mapping of query string arguments, other arguments are ignored
+        :raises DataValidationError: if a value cannot be converted
+        """
+        filters = {}
+        for name, (_, _, value_type) in cls.FILTERS.items():
+            value = args.get(name)
+            if value is None or value == "":
+                continue
+            try:
+                filters[name] = value_type[value] if value_type is RecommendationType else value_type(value)
+            except (KeyError, ValueError) as error:
+                raise DataValidationError(f"Invalid {name} {value}") from error
+        return filters
+
+    @classmethod
+    def check_sort(cls, sort: str) -> tuple:
+        """Returns the column name of a sort and whether it is descending
+
+        :raises DataValidationError: if it is not one of the SORTS
+        """
+        descending = sort.startswith("-")
+        name = sort[1:] if descending else sort
+        if name not in cls.SORTS:
+            raise DataValidationError("Invalid sort " + sort)
+        return name, descending
+
+    @classmethod
+    def duplicates_natural_key(cls, error: IntegrityError) -> bool:
+        """Returns whether an IntegrityError is a write into the natural key of another recommendation
+
+        psycopg2 gives the name of the violated constraint, asyncpg and SQLite
+        only give it, or its columns, in their message.
+        """
+        constraint = getattr(getattr(error.orig, "diag", None), "constraint_name", None)
+        if constraint:
+            return constraint == cls.NATURAL_KEY_INDEX
+        columns = ", ".join(f"{cls.__tablename__}.{name}" for name in cls.NATURAL_KEY)
+        message = str(error.orig)
+        return f'"{cls.NATURAL_KEY_INDEX}"' in message or f"UNIQUE constraint failed: {columns}" in message
+
+    @classmethod
+    def create_in_bulk(cls, recommendations: list) -> list:
+        """Creates many Recommendations with a single multi-row INSERT
+
+        The generated ids are set on the recommendations that were passed in.
+        The ones with the natural key of an existing recommendation are not
+        created and their id is left as None. The dialects that cannot compile
+        INSERT ... RETURNING, like SQLite, insert them one at a time instead.
+
+        :param recommendations: the recommendations to create
+        :type recommendations: list
+        :return: the created recommendations
+        :rtype: list
+        """
+        logger.info("Creating %d recommendations", len(recommendations))
+        if not recommendations:
+            return recommendations
+        if db.session.bind.dialect.full_returning:
+            cls._insert_returning_ids(recommendations)
+        else:
+            cls._insert_one_by_one(recommendations)
+        db.session.commit()
+        RecommendationList.refresh(*[recommendation.name for recommendation in recommendations])
+        return [recommendation for recommendation in recommendations if recommendation.id is not None]
+
+    @classmethod
+    def _insert_returning_ids(cls, recommendations: list):
+        """Inserts the recommendations with one INSERT ... RETURNING and sets their ids"""
+        table = cls.__table__
+        key_columns = [table.c[name] for name in cls.NATURAL_KEY]
+        statement = (
+            dialect_insert(table).values(cls._insert_rows(recommendations))
+            .on_conflict_do_nothing(index_elements=key_columns)
+            .returning(table.c.id, *key_columns)
+        )
+        rows = iter(db.session.execute(statement).all())
+        # PostgreSQL returns the rows of a single VALUES list in order, without
+        # the ones that were skipped, so they are matched up by natural key
+        row = next(rows, None)
+        for recommendation in recommendations:
+            recommendation.id = None
+            if row is not None and tuple(row[1:]) == recommendation.natural_key():
+                recommendation.id = row.id
+                row = next(rows, None)
+
+    @classmethod
+    def _insert_one_by_one(cls, recommendations: list):
+        """Inserts the recommendations one INSERT at a time and sets their ids"""
+        table = cls.__table__
+        key_columns = [table.c[name] for name in cls.NATURAL_KEY]
+        for recommendation, row in zip(recommendations, cls._insert_rows(recommendations)):
+            statement = dialect_insert(table).values(row).on_conflict_do_nothing(index_elements=key_columns)
+            result = db.session.execute(statement)
+            recommendation.id = result.inserted_primary_key[0] if result.rowcount else None
+
+    @classmethod
+    def upsert_in_bulk(cls, recommendations: list) -> list:
+        """Creates or updates many Recommendations with a single INSERT ... ON CONFLICT
+
+        The dialects that cannot compile INSERT ... RETURNING, like SQLite,
+        insert or update them one at a time instead. A recommendation with the natural key of an existing one replaces
+        its recommendation_name and number_of_likes, like a PUT. When the
+        same key is given more than once the last one wins, and the ones
+        before it count as created then updated. The ids are set on the
+        recommendations that were passed in.
+
+        :param recommendations: the recommendations to create or update
+        :type recommendations: list
+        :return: whether each recommendation was created rather than updated
+        :rtype: list
+        :raises DataValidationError: if the natural key of one is not set
+        """
+        logger.info("Upserting %d recommendations", len(recommendations))
+        if not recommendations:
+            return []
+        for recommendation in recommendations:
+            recommendation.check_natural_key()
+        # one statement cannot update the same row twice
+        latest = {recommendation.natural_key(): recommendation for recommendation in recommendations}
+        if db.session.bind.dialect.full_returning:
+            rows = cls._upsert_returning_ids(list(latest.values()))
+        else:
+            rows = cls._upsert_one_by_one(list(latest.values()))
+        db.session.commit()
+        ids = {}
+        created = []
+        for recommendation in recommendations:
+            key = recommendation.natural_key()
+            new = False
+            if key in rows:
+                ids[key], new = rows.pop(key)
+            recommendation.id = ids[key]
+            created.append(new)
+        cache.invalidate(*[recommendation.id for recommendation, new in zip(recommendations, created) if not new])
+        RecommendationList.refresh(*[recommendation.name for recommendation in recommendations])
+        return created
+
+    @classmethod
+    def _upsert_returning_ids(cls, recommendations: list) -> dict:
+        """Upserts the recommendations with one INSERT ... ON CONFLICT DO UPDATE
+
+        :return: the id and whether it was created keyed by natural key
+        """
+        table = cls.__table__
+        key_columns = [table.c[name] for name in cls.NATURAL_KEY]
+        statement = dialect_insert(table).values(cls._insert_rows(recommendations))
+        statement = (
+            statement.on_conflict_do_update(
+                index_elements=key_columns,
+                set_=dict(
+                    {name: statement.excluded[name] for name in ("recommendation_name", "number_of_likes")},
+                    updated_at=db.func.now()))
+            # xmax is only set on the rows that were updated
+            .returning(table.c.id, *key_columns, literal_column("xmax = 0", db.Boolean).label("created"))
+        )
+        return {tuple(row[1:-1]): (row.id, row.created) for row in db.session.execute(statement)}
+
+    @classmethod
+    def _upsert_one_by_one(cls, recommendations: list) -> dict:
+        """Upserts the recommendations one at a time, for dialects without RETURNING
+
+        A recommendation is inserted unless its natural key exists, and the
+        existing one is updated otherwise.
+
+        :return: the id and whether it was created keyed by natural key
+        """
+        table = cls.__table__
+        key_columns = [table.c[name] for name in cls.NATURAL_KEY]
+        rows = {}
+        for recommendation, row in zip(recommendations, cls._insert_rows(recommendations)):
+            key = recommendation.natural_key()
+            result = db.session.execute(dialect_insert(table).values(row).on_conflict_do_nothing(index_elements=key_columns))
+            if result.rowcount:
+                rows[key] = (result.inserted_primary_key[0], True)
+                continue
+            same_key = and_(*[column == value for column, value in zip(key_columns, key)])
+            db.session.execute(
+                table.update().where(same_key).values(
+                    recommendation_name=row["recommendation_name"],
+                    number_of_likes=row["number_of_likes"],
+                    updated_at=db.func.now())
+            )
+            rows[key] = (db.session.execute(select(table.c.id).where(same_key)).scalar_one(), False)
+        return rows
+
+    @classmethod
+    def _insert_rows(cls, recommendations) -> list:
+        """Returns the column values of recommendations for a multi-row INSERT"""
+        columns = [cls.__table__.c[name] for name in cls.FIELDS if name != "id"]
+        return [
+            {column.name: cls._value_or_default(recommendation, column) for column in columns}
+            for recommendation in recommendations
+        ]
+
+    @staticmethod
+    def _value_or_default(recommendation, column):
+        """Returns the value of a column, falling back to its default like the ORM does"""
+        value = getattr(recommendation, column.name)
+        if value is None and column.default is not None:
+            return column.default.arg
+        return value
+
+    @classmethod
+    def _add_likes(cls, reco_id: int, amount: int):
+        """Atomically adds amount to the likes of a Recommendation
+
+        The increment and the check that the likes never go below zero are
+        done by a single UPDATE ... RETURNING statement, so concurrent likes
+        are never lost and no SELECT is needed beforehand. On PostgreSQL the
+        same statement patches the likes into the list of the product. The
+        dialects that cannot compile UPDATE ... RETURNING, like SQLite, read
+        the row back after the UPDATE in the same transaction instead.
+
+        :return: the updated row, or None if no recommendation with reco_id
+            exists or the update would leave it with negative likes
+        """
+        patch_lists = RecommendationList.patches_likes(db.session)
+        if db.session.bind.dialect.full_returning:
+            row = db.session.execute(cls.add_likes_statement(reco_id, amount, patch_lists)).first()
+        elif db.session.execute(cls._add_likes_update(reco_id, amount)).rowcount:
+            row = db.session.execute(select(cls.__table__).where(cls.__table__.c.id == reco_id)).first()
+        else:
+            row = None
+        db.session.commit()
+        cache.invalidate(reco_id)
+        if row and patch_lists:
+            list_cache.invalidate(row.name)
+        elif row:
+            RecommendationList.refresh(row.name)
+        return row
+
+    @classmethod
+    def add_likes_statement(cls, reco_id: int, amount: int, patch_lists: bool = False):
+        """Returns the UPDATE ... RETURNING statement used by _add_likes
+
+        :param patch_lists: whether the statement also patches the list of
+            the product, see RecommendationList.patch_likes
+        """
+        statement = cls._add_likes_update(reco_id, amount).returning(*cls.__table__.c)
+        return RecommendationList.patch_likes(statement) if patch_lists else statement
+
+    @classmethod
+    def _add_likes_update(cls, reco_id: int, amount: int):
+        """Returns the UPDATE that adds amount to the likes unless they would go below zero"""
+        table = cls.__table__
+        likes = db.func.coalesce(table.c.number_of_likes, 0)
+        return (
+            table.update()
+            .where(table.c.id == reco_id)
+            .where(likes + amount >= 0)
+            .values(number_of_likes=likes + amount)
+        )
+
+    @classmethod
+    def like_by_id(cls, reco_id: int):
+        """Increments the likes of the Recommendation with the given id
+
+        :param reco_id: the id of the recommendation to like
+        :type reco_id: int
+        :return: the liked recommendation, or None if not found
+        :rtype: Recommendation
+        """
+        logger.info("Processing like for id %s ...", reco_id)
+        row = cls._add_likes(reco_id, 1)
+        return cls(**row._mapping) if row else None
+
+    @classmethod
+    def dislike_by_id(cls, reco_id: int):
+        """Decrements the likes of the Recommendation with the given id
+
+        :param reco_id: the id of the recommendation to dislike
+        :type reco_id: int
+        :return: the disliked recommendation, or None if not found
+        :rtype: Recommendation
+        :raises DataValidationError: if the recommendation has 0 likes
+        """
+        logger.info("Processing dislike for id %s ...", reco_id)
+        row = cls._add_likes(reco_id, -1)
+        if row:
+            return cls(**row._mapping)
+        # only pay for a lookup when we have to tell the two failures apart
+        if cls.find(reco_id) is None:
+            return None
+        raise DataValidationError("Recommendation already has 0 likes")
+
+    @classmethod
+    def add_likes_in_bulk(cls, deltas: dict, clamp: bool = True) -> dict:
+        """Applies many like deltas with a single UPDATE ... FROM (VALUES ...)
+
+        Dialects without UPDATE ... FROM, such as SQLite, run one UPDATE per
+        recommendation in the same transaction instead.
+
+        By default likes are clamped at zero and at the largest Integer
+        instead of being rejected, for deltas that were accepted earlier and
+        can no longer be refused.
+
+        :param deltas: the amount to add to the likes keyed by recommendation
+            id, each one in the INTEGER_RANGE
+        :type deltas: dict
+        :param clamp: whether to clamp, otherwise a delta that would leave a
+            recommendation with negative likes or more than the column holds
+            is not applied
+        :return: the new number of likes keyed by recommendation id for every
+            recommendation that exists and was updated
+        :rtype: dict
+        """
+        logger.info("Processing like deltas for %d recommendations ...", len(deltas))
+        if not deltas:
+            return {}
+        patch_lists = RecommendationList.patches_likes(db.session)
+        if db.session.bind.dialect.full_returning:
+            statement = cls._add_likes_from_values(deltas, clamp)
+            if patch_lists:
+                statement = RecommendationList.patch_likes(statement)
+            rows = db.session.execute(statement).all()
+        else:
+            rows = cls._add_likes_one_by_one(deltas, clamp)
+        db.session.commit()
+        cache.invalidate(*deltas)
+        if patch_lists:
+            list_cache.invalidate(*{row.name for row in rows if row.name is not None})
+        else:
+            RecommendationList.refresh(*[row.name for row in rows])
+        return {row.id: row.number_of_likes for row in rows}
+
+    @classmethod
+    def _add_likes_from_values(cls, deltas: dict, clamp: bool):
+        """Returns the UPDATE ... FROM (VALUES ...) that applies all of the like deltas"""
+        table = cls.__table__
+        data = values(
+            column("id", db.Integer), column("delta", db.Integer), name="deltas"
+        ).data(list(deltas.items()))
+        statement = cls._add_likes_clamped(table.update().where(table.c.id == data.c.id), data.c.delta, clamp)
+        return statement.returning(table.c.id, table.c.number_of_likes, table.c.name)
+
+    @classmethod
+    def _add_likes_one_by_one(cls, deltas: dict, clamp: bool) -> list:
+        """Applies the like deltas one UPDATE at a time, for dialects without UPDATE ... FROM"""
+        table = cls.__table__
+        statement = cls._add_likes_clamped(
+            table.update().where(table.c.id == db.bindparam("reco_id")),
+            db.bindparam("delta", type_=db.BigInteger),
+            clamp,
+        )
+        updated = [
+            reco_id for reco_id, delta in deltas.items()
+            if db.session.execute(statement, {"reco_id": reco_id, "delta": delta}).rowcount
+        ]
+        if not updated:
+            return []
+        query = select(table.c.id, table.c.number_of_likes, table.c.name).where(table.c.id.in_(updated))
+        return db.session.execute(query).all()
+
+    @classmethod
+    def _add_likes_clamped(cls, statement, delta, clamp: bool):
+        """Sets the likes of an UPDATE to the likes plus delta, clamped or bounded"""
+        table = cls.__table__
+        # added up as bigint so that a sum past the Integer column is caught
+        # here rather than raising NumericValueOutOfRange
+        likes = db.cast(db.func.coalesce(table.c.number_of_likes, 0), db.BigInteger) + delta
+        most = cls.INTEGER_RANGE[-1]
+        if clamp:
+            return statement.values(number_of_likes=db.case((likes < 0, 0), (likes > most, most), else_=likes))
+        return statement.where(likes.between(0, most)).values(number_of_likes=likes)
+
+    @classmethod
+    def export(cls, chunk_size: int = 1000, **filters):
+        """Yields every Recommendation as a dictionary, one chunk at a time
+
+        Rows are read through a server-side cursor without building ORM
+        objects, so memory use does not grow with the size of the table.
+
+        :param chunk_size: the number of rows fetched from the cursor at once
+        :param filters: column values that the recommendations must match
+        :return: lists of serialized recommendations ordered by id
+        :rtype: generator
+        """
+        logger.info("Processing export with filters %s ...", filters)
+        statement = cls.select_serialized(cls.FIELDS, **filters)
+        result = db.session.execute(statement.execution_options(stream_results=True))
+        for rows in result.yield_per(chunk_size).partitions():
+            yield [dict(zip(cls.FIELDS, row)) for row in rows]
+
+    @classmethod
+    def select_serialized(cls, fields, sort: str = "id", **filters):
+        """Returns a SELECT of the serialized columns for the fields ordered by id
+
+        :param fields: the fields to include in each row
+        :param sort: the sort the rows will be paginated with by keyset()
+        :param filters: values for the FILTERS that the recommendations must match
+        :raises DataValidationError: if a filter is not one of the FILTERS
+        """
+        statement = select(*cls._serialized_columns(fields, sort)).order_by(cls.__table__.c.id)
+        return statement.where(*cls.filter_clauses(filters))
+
+    @classmethod
+    def encode_cursor(cls, last_id: int, sort: str = "id", key=None) -> str:
+        """Encodes the last row of a page into an opaque cursor
+
+        Pages sorted by anything but the id also need the value of the sort
+        column of the last row to know where the next page starts.
+        """
+        payload = {"id": last_id}
+        if sort != "id":
+            payload.update(sort=sort, key=key)
+        return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+    @classmethod
+    def decode_cursor(cls, cursor: str, sort: str = "id") -> tuple:
+        """Decodes an opaque cursor back into the id and sort key of the last row seen
+
+        :raises DataValidationError: if the cursor was not issued by us for this sort
+        """
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            last_id, key = payload["id"], payload.get("key")
+            cursor_sort = payload.get("sort", "id")
+        except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError, AttributeError) as error:
+            raise DataValidationError("Invalid cursor: " + cursor) from error
+        if not isinstance(last_id, int) or cursor_sort != sort:
+            raise DataValidationError("Invalid cursor: " + cursor)
+        return last_id, key
+
+    @classmethod
+    def find_top(cls, limit: int = 10, name: str = None,
+                 recommendation_type: RecommendationType = None):
+        """Returns a query for the most liked recommendations
+
+        The ordering matches the number_of_likes indexes so the database
+        reads only the first rows of an index instead of sorting the table.
+
+        :param limit: the number of recommendations to return
+        :param name: only return recommendations for the product with this name
+        :param recommendation_type: only return recommendations of this type
+        :return: a query for the recommendations with the most likes first
+        """
+        logger.info("Processing top %s query for name %s type %s ...", limit, name, recommendation_type)
+        query = cls.query
+        if name is not None:
+            query = query.filter(cls.name == name)
+        if recommendation_type is not None:
+            query = query.filter(cls.type == recommendation_type)
+        return query.order_by(cls.number_of_likes.desc().nullslast(), cls.id).limit(limit)
+
+    @classmethod
+    def check_fields(cls, fields: list) -> list:
+        """Checks that every one of the fields can be serialized
+
+        :raises DataValidationError: if one of them is not a Recommendation field
+        """
+        for field in fields:
+            if field not in cls.FIELDS:
+                raise DataValidationError("Invalid field " + field)
+        return fields
+
+    @classmethod
+    def paginate(cls, query=None, cursor: str = None, limit: int = 100, sort: str = "id"):
+        """Returns one page of recommendations using keyset pagination
+
+        Rows are ordered by the sort column and then by id, and the page
+        starts after the row the cursor points at, so pages stay stable while
+        new rows are being inserted.
+
+        :param query: a query from one of the find_by_* methods, or None for all
+        :param cursor: the opaque cursor returned with the previous page
+        :param limit: the maximum number of recommendations to return
+        :param sort: one of the SORTS, e.g. -number_of_likes
+        :return: the recommendations on this page and the cursor for the
+            next page, or None if this is the last page
+        :rtype: tuple
+        """
+        logger.info("Processing page query after cursor %s limit %s sort %s ...", cursor, limit, sort)
+        if query is None:
+            query = cls.query
+        rows = cls.keyset(query, cursor, limit, sort).all()
+        return cls.next_page(rows, limit, sort)
+
+    @classmethod
+    def paginate_fields(cls, fields: list, query=None, cursor: str = None, limit: int = 100, sort: str = "id"):
+        """Returns one page of serialized recommendations with only some fields
+
+        Only the columns for the fields are read from the database and no
+        ORM objects are built.
+
+        :param fields: the fields to include in each recommendation
+        :return: the serialized recommendations on this page and the cursor
+            for the next page, or None if this is the last page
+        :rtype: tuple
+        """
+        logger.info("Processing page query of %s after cursor %s limit %s ...", fields, cursor, limit)
+        columns = cls._serialized_columns(cls.check_fields(fields), sort)
+        if query is None:
+            query = cls.query
+        rows = cls.keyset(query.with_entities(*columns), cursor, limit, sort).all()
+        rows, next_cursor = cls.next_page(rows, limit, sort)
+        return [dict(zip(fields, row)) for row in rows], next_cursor
+
+    @classmethod
+    def keyset(cls, query, cursor: str, limit: int, sort: str = "id"):
+        """Limits a query or SELECT to the page after the cursor in the sort order
+
+        Rows with no value in the sort column come last in both directions
+        and ties are broken by id, so that every row has a single place.
+        One extra row is fetched to find out if there is a next page.
+
+        :raises DataValidationError: if the sort or the cursor is invalid
+        """
+        name, descending = cls.check_sort(sort)
+        table = cls.__table__
+        key_column = table.c[name]
+        if cursor:
+            query = query.filter(cls._after_cursor(key_column, descending, *cls.decode_cursor(cursor, sort)))
+        id_order = table.c.id.desc() if descending else table.c.id.asc()
+        if name == "id":
+            order = [id_order]
+        else:
+            key_order = key_column.desc() if descending else key_column.asc()
+            order = [key_order.nullslast(), id_order]
+        return query.order_by(None).order_by(*order).limit(limit + 1)
+
+    @classmethod
+    def next_page(cls, rows: list, limit: int, sort: str = "id") -> tuple:
+        """Returns the rows of a page from keyset() and the cursor for the next page"""
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        name, _ = cls.check_sort(sort)
+        key = None if name == "id" else getattr(rows[-1], name)
+        return rows, cls.encode_cursor(rows[-1].id, sort, key)
+
+    @classmethod
+    def _after_cursor(cls, key_column, descending: bool, last_id: int, key):
+        """Returns the clause for the rows that come after the cursor"""
+        id_column = cls.__table__.c.id
+        after = operator.lt if descending else operator.gt
+        if key_column is id_column:
+            return after(id_column, last_id)
+        if key is None:
+            # the cursor is already in the rows without a sort key
+            return and_(key_column.is_(None), after(id_column, last_id))
+        return or_(after(tuple_(key_column, id_column), tuple_(key, last_id)), key_column.is_(None))
+
+    @classmethod
+    def _serialized_columns(cls, fields, sort: str = "id") -> list:
+        """Returns the columns to select for rows that are already serialized
+
+        The columns are in the order of the fields so that dict(zip(fields, row))
+        serializes a row. The type is cast to its name by the database, and
+        the id and the sort column are selected last, when not asked for, to
+        build cursors from.
+        """
+        table = cls.__table__
+        columns = [
+            db.cast(table.c.type, db.String).label("type") if field == "type" else table.c[field]
+            for field in fields
+        ]
+        for name in dict.fromkeys(("id", cls.check_sort(sort)[0])):
+            if name not in fields:
+                columns.append(table.c[name])
+        return columns
+
+
+class RecommendationList(db.Model):
+    """
+    Class that represents the precomputed list of recommendations for a product
+
+    The list holds the serialized recommendations with the product name,
+    ordered by type and then by most likes, so that reading it is a single
+    primary key lookup. Recommendation refreshes the lists of the products
+    it changes after every write, except for likes on PostgreSQL, which
+    patch the lists in the statement that updates the likes.
+    """
+    name = db.Column(db.String(63), primary_key=True)
+    recommendations = db.Column(db.JSON, nullable=False)
+
+    @classmethod
+    def statement(cls, names: list):
+        """Returns the SELECT of the serialized recommendations for products in list order
+
+        The order matches ix_recommendation_name_type_likes so no sort is needed.
+        """
+        table = Recommendation.__table__
+        return (
+            Recommendation.select_serialized(Recommendation.FIELDS)
+            .where(table.c.name.in_(names))
+            .order_by(None)
+            .order_by(table.c.name, *cls.list_order())
+        )
+
+    @staticmethod
+    def list_order() -> list:
+        """Returns the order of the recommendations within a list"""
+        table = Recommendation.__table__
+        return [table.c.type, table.c.number_of_likes.desc().nullslast(), table.c.id]
+
+    @classmethod
+    def refresh(cls, *names):
+        """Recomputes the lists of the products with the given names
+
+        A failure is logged rather than raised because the change to the
+        recommendations is already committed; the list catches up on the
+        next write to the product.
+        """
+        names = sorted({name for name in names if name is not None})
+        if not names:
+            return
+        logger.info("Refreshing the recommendation lists of %s", names)
+        try:
+            cls.refresh_in(db.session, names)
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            logger.error("Could not refresh the recommendation lists of %s: %s", names, error)
+        list_cache.invalidate(*names)
+
+    @classmethod
+    def refresh_in(cls, session, names: list):
+        """Recomputes the lists of the products with the given names in a session
+
+        The lists are rebuilt with one INSERT ... ON CONFLICT for all of the
+        names, and the lists of products without recommendations any more
+        are deleted. The caller commits. Names are locked in sorted order.
+        """
+        names = sorted(names)
+        if not names:
+            return
+        table = Recommendation.__table__
+        lists = cls.__table__
+        if session.bind.dialect.name == "postgresql":
+            # serialize the refreshes of a product so the last one to commit
+            # has seen every change committed before it, and lock its list
+            # so a like patched in meanwhile is applied on top of this one
+            given = select(db.func.unnest(postgresql.array(names)).label("name")).order_by("name").subquery()
+            session.execute(select(db.func.pg_advisory_xact_lock(db.func.hashtext(given.c.name))))
+            session.execute(select(lists.c.name).where(lists.c.name.in_(names)).order_by(lists.c.name).with_for_update())
+            session.execute(cls._upsert_from_select(names))
+        else:
+            rows = session.execute(cls.statement(names)).all()
+            refreshed = [
+                {"name": name, "recommendations": [dict(zip(Recommendation.FIELDS, row)) for row in group]}
+                for name, group in itertools.groupby(rows, operator.attrgetter("name"))
+            ]
+            if refreshed:
+                statement = sqlite.insert(lists).values(refreshed)
+                session.execute(statement.on_conflict_do_update(
+                    index_elements=[lists.c.name], set_={"recommendations": statement.excluded.recommendations}
+                ))
+        session.execute(
+            lists.delete()
+            .where(lists.c.name.in_(names))
+            .where(lists.c.name.not_in(select(table.c.name).where(table.c.name.in_(names))))
+        )
+
+    @classmethod
+    def _upsert_from_select(cls, names: list):
+        """Returns the INSERT ... SELECT json_agg(...) ON CONFLICT of the lists of the products"""
+        table = Recommendation.__table__
+        columns = cls.statement(names).selected_columns
+        entry = db.func.json_build_object(*itertools.chain.from_iterable(
+            (literal_column(f"'{field}'"), value) for field, value in zip(Recommendation.FIELDS, columns)
+        ))
+        serialized = (
+            select(table.c.name, db.func.json_agg(postgresql.aggregate_order_by(entry, *cls.list_order())))
+            .where(table.c.name.in_(names))
+            .group_by(table.c.name)
+        )
+        statement = postgresql.insert(cls.__table__).from_select(["name", "recommendations"], serialized)
+        return statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.name], set_={"recommendations": statement.excluded.recommendations}
+        )
+
+    @staticmethod
+    def patches_likes(session) -> bool:
+        """Returns whether the likes can be patched into the lists, on PostgreSQL"""
+        return session.bind.dialect.name == "postgresql"
+
+    @classmethod
+    def patch_likes(cls, statement):
+        """Returns an UPDATE ... RETURNING of the likes of recommendations that
+        also patches their likes and positions in the lists of their products
+
+        The lists are updated in the same statement from the entries they
+        already hold, without reading the recommendations again, and the
+        statement returns the rows of the UPDATE it is given.
+
+        :param statement: an UPDATE of recommendation RETURNING at least their
+            id, name and number_of_likes
+        """
+        liked = statement.cte("liked")
+        table = cls.__table__
+        entry = ", ".join(
+            f"'{field}', liked.number_of_likes" if field == "number_of_likes" else f"'{field}', old.value->'{field}'"
+            for field in Recommendation.FIELDS
+        )
+        recommendations = literal_column(f"""(
+            SELECT json_agg(entry ORDER BY (entry->>'type')::{Recommendation.type.type.name},
+                            (entry->>'number_of_likes')::int DESC NULLS LAST, (entry->>'id')::int)
+            FROM (
+                SELECT CASE WHEN liked.id IS NULL THEN old.value ELSE json_build_object({entry}) END AS entry
+                FROM json_array_elements({table.name}.recommendations) AS old
+                LEFT JOIN liked ON liked.id = (old.value->>'id')::int
+            ) AS entries
+        )""", db.JSON)
+        patched = (
+            table.update()
+            .where(table.c.name.in_(select(liked.c.name)))
+            .values(recommendations=recommendations)
+            .cte("patched")
+        )
+        return select(liked).add_cte(patched)
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes the lists of every product"""
+        logger.info("Rebuilding every recommendation list")
+        names = db.session.execute(select(Recommendation.name).distinct()).scalars().all()
+        db.session.query(cls).delete()
+        cls.refresh(*names)
+
+    @classmethod
+    def find_serialized(cls, name: str) -> list:
+        """Returns the recommendations for a product, reading through the cache
+
+        :param name: the name of the product
+        :return: the serialized recommendations ordered by type and likes,
+            which is empty if the product has none
+        :rtype: list
+        """
+        logger.info("Processing list lookup for name %s ...", name)
+
+        def load():
+            product_list = db.session.get(cls, name)
+            return product_list.recommendations if product_list else []
+
+        return list_cache.get_or_load(name, load)
@@ -4,20 +4,30 @@ My Service
 Describe what your service does here
 """
 
-from flask import jsonify, request
-from flask_restx import Resource, fields, reqparse
-from service.models import Recommendation, RecommendationType
+import json
+import hashlib
+from flask import Blueprint, Response, current_app as app, jsonify, request, stream_with_context
+from flask_restx import Resource, fields, marshal, reqparse
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+from service.models import Recommendation, RecommendationList, RecommendationType, DataValidationError, db, cache
+from service.likes import like_buffer
+from service.snapshot import snapshot_server
 from .common import status  # HTTP Status Codes
+from .common.metrics import export_metrics
 
 
-# Import Flask application
-from . import app, api
+# Import the Flask-RESTX Api, the app is created later by create_app()
+from . import api
+
+# The routes outside of the Api
+site = Blueprint("site", __name__)
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@site.route("/")
 def index():
     """ Root URL response """
     app.logger.info("Request for Root URL")
@@ -50,6 +60,34 @@ recommendation_model = api.inherit(
     }
 )
 
+bulk_result_model = api.model(
+    'BulkResult',
+    {
+        'index': fields.Integer(description='The position of the recommendation in the request'),
+        'status': fields.Integer(description='The HTTP status code for this recommendation'),
+        'id': fields.Integer(description='The id assigned to the recommendation if it was created'),
+        'message': fields.String(description='The reason the recommendation was not created'),
+    }
+)
+
+like_event_model = api.model(
+    'LikeEvent',
+    {
+        'id': fields.Integer(required=True, description='The id of the recommendation'),
+        'delta': fields.Integer(required=True, description='The number of likes to add, negative for dislikes'),
+    }
+)
+
+like_result_model = api.model(
+    'LikeResult',
+    {
+        'id': fields.Integer(description='The id of the recommendation'),
+        'status': fields.Integer(description='The HTTP status code for this recommendation'),
+        'number_of_likes': fields.Integer(description='The number of likes after the deltas were applied'),
+        'message': fields.String(description='The reason the deltas were not applied'),
+    }
+)
+
 # query string arguments
 recommendation_args = reqparse.RequestParser()
 recommendation_args.add_argument(
@@ -57,25 +95,98 @@ recommendation_args.add_argument(
 recommendation_args.add_argument(
     'name', type=str, location='args', required=False, help='List recommendations by name')
 recommendation_args.add_argument(
-    'type', type=int, location='args', required=False, help='List recommendations by type')
+    'type', type=str, location='args', required=False, help='List recommendations by type')
+recommendation_args.add_argument(
+    'number_of_likes', type=int, location='args', required=False, help='List recommendations by number_of_likes')
+recommendation_args.add_argument(
+    'min_likes', type=int, location='args', required=False, help='List recommendations with at least this many likes')
+recommendation_args.add_argument(
+    'max_likes', type=int, location='args', required=False, help='List recommendations with at most this many likes')
+recommendation_args.add_argument(
+    'recommendation_id', type=int, location='args', required=False, help='List recommendations by recommendation_id')
+recommendation_args.add_argument(
+    'recommendation_name', type=str, location='args', required=False,
+    help='List recommendations by recommendation_name')
+recommendation_args.add_argument(
+    'fields', type=str, location='args', required=False,
+    help='Comma separated list of the fields to return, e.g. recommendation_id,number_of_likes')
+recommendation_args.add_argument(
+    'limit', type=int, location='args', required=False, help='The maximum number of recommendations to return')
 recommendation_args.add_argument(
-    'number_of_likes', type=int, required=False, help='List recommendations by number_of_likes')
+    'cursor', type=str, location='args', required=False, help='The cursor of the page to return')
 recommendation_args.add_argument(
-    'recommendation_id', type=int, required=False, help='List recommendations by recommendation_id')
+    'ids', type=str, location='args', required=False,
+    help='Comma separated list of ids to get in one request, e.g. 1,2,3')
 recommendation_args.add_argument(
-    'recommendation_name', type=str, required=False, help='List recommendations by recommendation_name')
+    'sort', type=str, location='args', required=False,
+    help='The field to sort by, descending with a leading -, e.g. -number_of_likes')
+
+# query string arguments for a single recommendation
+fields_args = reqparse.RequestParser()
+fields_args.add_argument(
+    'fields', type=str, location='args', required=False,
+    help='Comma separated list of the fields to return, e.g. recommendation_id,number_of_likes')
+
+# query string arguments for exports, which are never paginated
+export_args = recommendation_args.copy()
+export_args.remove_argument('fields')
+export_args.remove_argument('limit')
+export_args.remove_argument('cursor')
+export_args.remove_argument('ids')
+export_args.remove_argument('sort')
+
+# query string arguments for the pages of the products that recommend a product
+recommended_by_args = reqparse.RequestParser()
+recommended_by_args.add_argument(
+    'fields', type=str, location='args', required=False,
+    help='Comma separated list of the fields to return, e.g. name,number_of_likes')
+recommended_by_args.add_argument(
+    'limit', type=int, location='args', required=False, help='The maximum number of recommendations to return')
+recommended_by_args.add_argument(
+    'cursor', type=str, location='args', required=False, help='The cursor of the page to return')
+recommended_by_args.add_argument(
+    'sort', type=str, location='args', required=False,
+    help='The field to sort by, descending with a leading -, -number_of_likes by default')
+
+# query string arguments for the most liked recommendations
+top_args = reqparse.RequestParser()
+top_args.add_argument(
+    'name', type=str, location='args', required=False, help='Only rank recommendations for this product name')
+top_args.add_argument(
+    'type', type=str, location='args', required=False, help='Only rank recommendations of this type')
+top_args.add_argument(
+    'n', type=int, location='args', required=False, help='The number of recommendations to return')
 
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
 
 
-@app.route("/health")
+@site.route("/health")
 def healthcheck():
     """Let them know our heart is still beating"""
     return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@site.route("/metrics")
+def metrics():
+    """Returns the service metrics in the Prometheus text format"""
+    data, content_type = export_metrics()
+    return Response(data, status=status.HTTP_200_OK, content_type=content_type)
+
+
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@site.route("/cache/stats")
+def cache_stats():
+    """Returns the hit and miss counters of the recommendation cache"""
+    return jsonify(cache.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /recommendations/{recommendation_id}
 ######################################################################
@@ -93,7 +204,10 @@ class RecommendationResource(Resource):
     """
     @api.doc('get_recommendations')
     @api.response(404, 'Recommendation not found')
-    @api.marshal_with(recommendation_model)
+    @api.response(304, 'Recommendation not modified')
+    @api.header('ETag', 'The entity tag of the recommendation')
+    @api.expect(fields_args)
+    @api.response(200, 'Success', recommendation_model)
     def get(self, recommendation_id):
         """
         Retrieve a single recommendation
@@ -101,18 +215,27 @@ class RecommendationResource(Resource):
         """
         app.logger.info(
             "Request for recommendations with id: %s", recommendation_id)
-        recommendation = Recommendation.find(recommendation_id)
+        fields_requested = get_fields()
+        snapshot = snapshot_server.serving()
+        if snapshot is not None:
+            recommendation = snapshot.get(recommendation_id)
+        else:
+            recommendation = Recommendation.find_serialized(recommendation_id)
         if not recommendation:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"recommendations with id '{recommendation_id}' was not found.")
-        app.logger.info("Returning recommendation: %s",
-                        recommendation.recommendation_name)
-        return recommendation.serialize(), status.HTTP_200_OK
+        if fields_requested:
+            recommendation = {field: recommendation[field] for field in fields_requested}
+        etag = compute_etag(recommendation)
+        check_not_modified(etag)
+        app.logger.info("Returning recommendation: %s", recommendation_id)
+        return recommendation, status.HTTP_200_OK, {"ETag": f'"{etag}"'}
 
     @api.doc('update_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted data was not valid')
+    @api.response(412, 'The recommendation was changed since it was read')
     @api.expect(recommendation_model)
     @api.marshal_with(recommendation_model)
     def put(self, recommendation_id):
@@ -124,10 +247,18 @@ class RecommendationResource(Resource):
         app.logger.info(
             "Request to update recommendation with id: %s", recommendation_id)
         check_content_type("application/json")
-        recommendation = Recommendation.find(recommendation_id)
+        if request.if_match:
+            # lock the row so it cannot change between the check and the update
+            recommendation = Recommendation.find_for_update(recommendation_id)
+        else:
+            recommendation = Recommendation.find(recommendation_id)
         if recommendation is None:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Recommendation id {recommendation_id} does not exist")
+        if request.if_match and not request.if_match.contains(compute_etag(recommendation.serialize())):
+            db.session.rollback()
+            abort(status.HTTP_412_PRECONDITION_FAILED,
+                  f"Recommendation id {recommendation_id} was changed by someone else")
         recommendation.deserialize(request.get_json())
         recommendation.update()
         message = recommendation.serialize()
@@ -136,7 +267,8 @@ class RecommendationResource(Resource):
         location_url = api.url_for(
             RecommendationResource,
             recommendation_id=recommendation.id, _external=True)
-        return message, status.HTTP_200_OK, {"Location": location_url}
+        headers = {"Location": location_url, "ETag": f'"{compute_etag(message)}"'}
+        return message, status.HTTP_200_OK, headers
 
     @api.doc('delete_recommendations')
     @api.response(204, 'Recommendation deleted')
@@ -167,28 +299,37 @@ class RecommendationCollection(Resource):
     POST /recommendations - creates a new Recommendation record in the database
     """
     @api.doc('list_recommendations')
+    @api.response(304, 'Recommendations not modified')
+    @api.header('ETag', 'The entity tag of this page of recommendations')
+    @api.header('X-Missing-Ids', 'The requested ids that were not found, when getting by ids')
     @api.expect(recommendation_args, validate=True)
-    @api.marshal_list_with(recommendation_model)
+    @api.response(200, 'Success', [recommendation_model])
     def get(self):
-        """Returns all of the Recommendations"""
+        """Returns all of the Recommendations, or the ones with the given ids"""
         app.logger.info("Request for Recommendations list")
-        recs = []
-        name = request.args.get("name")
-        type_string = request.args.get("type")
-        if name:
-            app.logger.info("Filtering recommendations by name=%s", name)
-            recs = Recommendation.find_by_name(name)
-        elif type_string:
-            app.logger.info(
-                "Filtering recommendations by type=%s", type_string)
-            recommendation_type = RecommendationType[type_string]
-            recs = Recommendation.find_by_type(recommendation_type)
+        ids = get_ids()
+        if ids:
+            return get_batch(ids)
+        filters = Recommendation.parse_filters(request.args)
+        app.logger.info("Filtering recommendations by %s", filters)
+        limit = get_page_limit()
+        fields_requested = get_fields() or Recommendation.FIELDS
+        sort = request.args.get("sort") or "id"
+        snapshot = snapshot_server.serving()
+        if snapshot is not None:
+            results, next_cursor = snapshot.page(fields_requested, request.args.get("cursor"), limit, sort, **filters)
         else:
-            recs = Recommendation.all()
-        results = [rec.serialize() for rec in recs]
+            # rows are serialized straight from the columns, without ORM objects
+            # or the marshaller, so they must match recommendation_model
+            results, next_cursor = Recommendation.paginate_fields(
+                fields_requested, Recommendation.find_by_filters(**filters), request.args.get("cursor"), limit, sort)
         app.logger.info("Returning %d recommendations", len(results))
-        app.logger.info(results)
-        return results, status.HTTP_200_OK
+        etag = compute_etag(results)
+        check_not_modified(etag)
+        headers = {"ETag": f'"{etag}"'}
+        if next_cursor:
+            headers["Link"] = next_page_link(next_cursor, limit, RecommendationCollection)
+        return results, status.HTTP_200_OK, headers
 
     @api.doc('create_recommendations')
     @api.response(201, 'Recommendation created successfully')
@@ -213,6 +354,434 @@ class RecommendationCollection(Resource):
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+def get_batch(ids: list):
+    """Returns the recommendations with the given ids in the order they were asked for"""
+    app.logger.info("Request for %d Recommendations by id", len(ids))
+    snapshot = snapshot_server.serving()
+    results, missing = (Recommendation if snapshot is None else snapshot).find_many(ids, get_fields())
+    app.logger.info("Returning %d recommendations, %d missing", len(results), len(missing))
+    etag = compute_etag(results)
+    check_not_modified(etag)
+    headers = {"ETag": f'"{etag}"'}
+    if missing:
+        headers["X-Missing-Ids"] = ",".join(str(reco_id) for reco_id in missing)
+    return results, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /products/{name}/recommendations
+######################################################################
+@api.route('/products/<string:name>/recommendations', strict_slashes=False)
+@api.param('name', "The name of the product")
+class ProductRecommendations(Resource):
+    """
+    ProductRecommendations class
+
+    Allows the recommendations for a product to be read in one lookup
+    GET /products/{name}/recommendations - Returns the precomputed list for the product
+    """
+
+    @api.doc('list_product_recommendations')
+    @api.response(304, 'Recommendations not modified')
+    @api.header('ETag', 'The entity tag of the list')
+    @api.response(200, 'Success', [recommendation_model])
+    def get(self, name):
+        """
+        Returns the Recommendations for a product
+
+        This endpoint will return the recommendations with the product name,
+        ordered by type and then by most likes, from a list that is kept up
+        to date as recommendations change
+        """
+        app.logger.info("Request for the recommendation list of %s", name)
+        snapshot = snapshot_server.serving()
+        results = snapshot.product_list(name) if snapshot is not None else RecommendationList.find_serialized(name)
+        app.logger.info("Returning %d recommendations", len(results))
+        etag = compute_etag(results)
+        check_not_modified(etag)
+        return results, status.HTTP_200_OK, {"ETag": f'"{etag}"'}
+
+
+######################################################################
+#  PATH: /products/{product_id}/recommended-by
+######################################################################
+@api.route('/products/<int:product_id>/recommended-by', strict_slashes=False)
+@api.param('product_id', "The id of the recommended product")
+class ProductRecommendedBy(Resource):
+    """
+    ProductRecommendedBy class
+
+    Allows the products that recommend a product to be found
+    GET /products/{product_id}/recommended-by - Returns the Recommendations of the product
+    """
+
+    @api.doc('list_product_recommended_by')
+    @api.response(304, 'Recommendations not modified')
+    @api.header('ETag', 'The entity tag of this page of recommendations')
+    @api.expect(recommended_by_args, validate=True)
+    @api.response(200, 'Success', [recommendation_model])
+    def get(self, product_id):
+        """
+        Returns the Recommendations of a product
+
+        This endpoint will return a page of the recommendations with the
+        recommendation_id, the name of each one is a product that recommends
+        it, most liked first by default
+        """
+        app.logger.info("Request for the products that recommend %s", product_id)
+        limit = get_page_limit()
+        fields_requested = get_fields() or Recommendation.FIELDS
+        sort = request.args.get("sort") or Recommendation.RECOMMENDED_BY_SORT
+        snapshot = snapshot_server.serving()
+        if snapshot is not None:
+            results, next_cursor = snapshot.page(
+                fields_requested, request.args.get("cursor"), limit, sort, recommendation_id=product_id)
+        else:
+            results, next_cursor = Recommendation.paginate_fields(
+                fields_requested, Recommendation.find_recommended_by(product_id), request.args.get("cursor"),
+                limit, sort)
+        app.logger.info("Returning %d recommendations", len(results))
+        etag = compute_etag(results)
+        check_not_modified(etag)
+        headers = {"ETag": f'"{etag}"'}
+        if next_cursor:
+            headers["Link"] = next_page_link(next_cursor, limit, ProductRecommendedBy, product_id=product_id)
+        return results, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /recommendations/top
+######################################################################
+@api.route('/recommendations/top', strict_slashes=False)
+class RecommendationTopCollection(Resource):
+    """
+    RecommendationTopCollection class
+
+    Allows the most liked Recommendations to be found
+    GET /recommendations/top - Returns the Recommendations with the most likes
+    """
+
+    @api.doc('list_top_recommendations')
+    @api.expect(top_args)
+    @api.marshal_list_with(recommendation_model)
+    def get(self):
+        """Returns the most liked Recommendations"""
+        app.logger.info("Request for the top Recommendations")
+        name = request.args.get("name")
+        type_string = request.args.get("type")
+        recommendation_type = None
+        if type_string:
+            if type_string not in RecommendationType.__members__:
+                abort(status.HTTP_400_BAD_REQUEST, f"Invalid type {type_string}")
+            recommendation_type = RecommendationType[type_string]
+        limit = get_int("n", app.config["DEFAULT_TOP_SIZE"])
+        if limit < 1:
+            abort(status.HTTP_400_BAD_REQUEST, "n must be a positive integer")
+        limit = min(limit, app.config["MAX_PAGE_SIZE"])
+        snapshot = snapshot_server.serving()
+        if snapshot is not None:
+            results = snapshot.top(limit, name, recommendation_type)
+        else:
+            results = [rec.serialize() for rec in Recommendation.find_top(limit, name, recommendation_type)]
+        app.logger.info("Returning %d recommendations", len(results))
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+@api.route('/recommendations/export', strict_slashes=False)
+class RecommendationExport(Resource):
+    """
+    RecommendationExport class
+
+    Allows all of the Recommendations to be downloaded at once
+    GET /recommendations/export - streams the Recommendations as newline delimited JSON
+    """
+
+    @api.doc('export_recommendations')
+    @api.expect(export_args)
+    @api.produces(['application/x-ndjson'])
+    @api.response(200, 'Newline delimited JSON with one recommendation per line')
+    def get(self):
+        """
+        Exports the Recommendations
+
+        This endpoint will stream every Recommendation that matches the
+        query arguments as newline delimited JSON
+        """
+        app.logger.info("Request to export recommendations")
+        filters = Recommendation.parse_filters(request.args)
+        snapshot = snapshot_server.serving()
+        chunks = (Recommendation if snapshot is None else snapshot).export(app.config["EXPORT_CHUNK_SIZE"], **filters)
+
+        def generate():
+            for chunk in chunks:
+                yield "".join(json.dumps(rec) + "\n" for rec in chunk)
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+######################################################################
+#  PATH: /recommendations/bulk
+######################################################################
+@api.route('/recommendations/bulk', strict_slashes=False)
+class RecommendationBulkCollection(Resource):
+    """
+    RecommendationBulkCollection class
+
+    Allows the creation of many Recommendations in one request
+    POST /recommendations/bulk - creates the Recommendations in a JSON array or NDJSON stream
+    """
+
+    @api.doc('create_recommendations_in_bulk')
+    @api.response(201, 'All of the recommendations were created')
+    @api.response(207, 'Some of the recommendations were not created')
+    @api.marshal_list_with(bulk_result_model)
+    def post(self):
+        """
+        Creates many Recommendations
+
+        This endpoint will create the Recommendations in the body that is posted,
+        either as a JSON array or as newline delimited JSON, and report the result
+        for each one of them
+        """
+        app.logger.info("Request to create recommendations in bulk")
+        items = read_items()
+        chunk_size = app.config["BULK_CHUNK_SIZE"]
+        results = []
+        chunk = []
+        for index, data in enumerate(items):
+            try:
+                chunk.append((index, Recommendation().deserialize(data)))
+            except DataValidationError as error:
+                results.append({"index": index, "status": status.HTTP_400_BAD_REQUEST, "message": str(error)})
+            if len(chunk) >= chunk_size:
+                results.extend(create_chunk(chunk))
+                chunk = []
+        results.extend(create_chunk(chunk))
+        results.sort(key=lambda result: result["index"])
+
+        created = sum(1 for result in results if result["status"] == status.HTTP_201_CREATED)
+        app.logger.info("Created %d of %d recommendations in bulk", created, len(results))
+        if created == len(results):
+            return results, status.HTTP_201_CREATED
+        return results, status.HTTP_207_MULTI_STATUS
+
+
+def read_items():
+    """Returns the documents in a JSON array or newline delimited JSON body"""
+    check_content_type("application/json", "application/x-ndjson")
+    if request.headers["Content-Type"] == "application/x-ndjson":
+        return read_ndjson(request.stream)
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON array")
+    return items
+
+
+def read_ndjson(stream):
+    """Yields one document per line of a newline delimited JSON stream
+
+    Lines that are not valid JSON are yielded as None so that they are
+    reported as bad data without stopping the rest of the stream
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def create_chunk(chunk):
+    """Inserts a chunk of (index, Recommendation) pairs and returns their results"""
+    if not chunk:
+        return []
+    try:
+        Recommendation.create_in_bulk([recommendation for _, recommendation in chunk])
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        app.logger.error("Could not create recommendations in bulk: %s", error)
+        return [
+            {"index": index, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "message": "Could not be saved"}
+            for index, _ in chunk
+        ]
+    return [
+        {"index": index, "status": status.HTTP_201_CREATED, "id": recommendation.id}
+        if recommendation.id is not None else
+        {"index": index, "status": status.HTTP_409_CONFLICT, "message": "Already exists"}
+        for index, recommendation in chunk
+    ]
+
+
+######################################################################
+#  PATH: /recommendations/upsert
+######################################################################
+@api.route('/recommendations/upsert', strict_slashes=False)
+class RecommendationUpsert(Resource):
+    """
+    RecommendationUpsert class
+
+    Allows Recommendations to be saved without checking if they exist first
+    PUT /recommendations/upsert - creates or updates the Recommendation, or the ones in a JSON array or NDJSON stream
+    """
+
+    @api.doc('upsert_recommendations')
+    @api.response(200, 'The recommendation was updated, or all of them were saved', recommendation_model)
+    @api.response(201, 'The recommendation was created', recommendation_model)
+    @api.response(207, 'Some of the recommendations were not saved', [bulk_result_model])
+    def put(self):
+        """
+        Creates or updates Recommendations
+
+        This endpoint will create the Recommendation in the body, or update the
+        one with the same name, recommendation_id and type. For a JSON array or
+        newline delimited JSON it reports the result for each one of them,
+        201 if it was created and 200 if it was updated.
+        """
+        app.logger.info("Request to upsert recommendations")
+        check_content_type("application/json", "application/x-ndjson")
+        if request.headers["Content-Type"] == "application/json" and isinstance(request.get_json(), dict):
+            return upsert_one(request.get_json())
+        chunk_size = app.config["BULK_CHUNK_SIZE"]
+        results = []
+        chunk = []
+        for index, data in enumerate(read_items()):
+            try:
+                recommendation = Recommendation().deserialize(data)
+                recommendation.check_natural_key()
+                chunk.append((index, recommendation))
+            except DataValidationError as error:
+                results.append({"index": index, "status": status.HTTP_400_BAD_REQUEST, "message": str(error)})
+            if len(chunk) >= chunk_size:
+                results.extend(upsert_chunk(chunk))
+                chunk = []
+        results.extend(upsert_chunk(chunk))
+        results.sort(key=lambda result: result["index"])
+
+        saved = sum(1 for result in results if result["status"] in (status.HTTP_200_OK, status.HTTP_201_CREATED))
+        app.logger.info("Upserted %d of %d recommendations", saved, len(results))
+        code = status.HTTP_200_OK if saved == len(results) else status.HTTP_207_MULTI_STATUS
+        return marshal(results, bulk_result_model), code
+
+
+def upsert_one(data: dict):
+    """Creates or updates a single Recommendation and returns it"""
+    recommendation = Recommendation().deserialize(data)
+    created = recommendation.upsert()
+    message = recommendation.serialize()
+    app.logger.info("Recommendation with ID [%s] %s.", recommendation.id, "created" if created else "updated")
+    location_url = api.url_for(RecommendationResource, recommendation_id=recommendation.id, _external=True)
+    code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+    return message, code, {"Location": location_url, "ETag": f'"{compute_etag(message)}"'}
+
+
+def upsert_chunk(chunk):
+    """Upserts a chunk of (index, Recommendation) pairs and returns their results"""
+    if not chunk:
+        return []
+    try:
+        created = Recommendation.upsert_in_bulk([recommendation for _, recommendation in chunk])
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        app.logger.error("Could not upsert recommendations: %s", error)
+        return [
+            {"index": index, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "message": "Could not be saved"}
+            for index, _ in chunk
+        ]
+    return [
+        {"index": index, "status": status.HTTP_201_CREATED if new else status.HTTP_200_OK, "id": recommendation.id}
+        for (index, recommendation), new in zip(chunk, created)
+    ]
+
+
+######################################################################
+#  PATH: /recommendations/likes
+######################################################################
+@api.route('/recommendations/likes', strict_slashes=False)
+class RecommendationLikesCollection(Resource):
+    """
+    RecommendationLikesCollection class
+
+    Allows many like and dislike events to be recorded in one request
+    POST /recommendations/likes - applies the like deltas in a JSON array or NDJSON stream
+    """
+
+    @api.doc('add_likes_in_bulk')
+    @api.expect([like_event_model])
+    @api.response(200, 'All of the deltas were applied')
+    @api.response(207, 'Some of the deltas were not applied')
+    @api.response(400, 'An event was not valid')
+    @api.marshal_list_with(like_result_model)
+    def post(self):
+        """
+        Adds likes to many Recommendations
+
+        This endpoint will add up the deltas of the like events that are posted,
+        either as a JSON array or as newline delimited JSON, apply them with one
+        update per chunk, and report the new number of likes of each recommendation.
+        A delta that would leave a recommendation with fewer than 0 likes, or more
+        than fit in the column, is not applied.
+        """
+        app.logger.info("Request to add likes in bulk")
+        deltas = {}
+        for index, event in enumerate(read_items()):
+            reco_id, delta = check_like_event(index, event)
+            deltas[reco_id] = deltas.get(reco_id, 0) + delta
+        # checked before the first chunk is committed, so that a rejected
+        # request has applied nothing and can be sent again
+        for reco_id, delta in deltas.items():
+            if delta not in Recommendation.INTEGER_RANGE:
+                abort(status.HTTP_400_BAD_REQUEST, f"The deltas of recommendation {reco_id} add up to {delta}, out of range")
+
+        chunk_size = app.config["BULK_CHUNK_SIZE"]
+        reco_ids = list(deltas)
+        results = []
+        for start in range(0, len(reco_ids), chunk_size):
+            chunk = {reco_id: deltas[reco_id] for reco_id in reco_ids[start:start + chunk_size]}
+            results.extend(add_likes_chunk(chunk))
+
+        applied = sum(1 for result in results if result["status"] == status.HTTP_200_OK)
+        app.logger.info("Applied like deltas to %d of %d recommendations", applied, len(results))
+        if applied == len(results):
+            return results, status.HTTP_200_OK
+        return results, status.HTTP_207_MULTI_STATUS
+
+
+def check_like_event(index: int, event) -> tuple:
+    """Returns the recommendation id and delta of a like event"""
+    if not isinstance(event, dict):
+        abort(status.HTTP_400_BAD_REQUEST, f"Like event {index} must be a JSON object")
+    reco_id = event.get("id")
+    delta = event.get("delta")
+    # bool is an int too, but True is not a meaningful delta
+    if not all(isinstance(value, int) and not isinstance(value, bool) for value in (reco_id, delta)):
+        abort(status.HTTP_400_BAD_REQUEST, f"Like event {index} must have an integer id and delta")
+    if reco_id not in Recommendation.INTEGER_RANGE:
+        abort(status.HTTP_400_BAD_REQUEST, f"Like event {index} has an id out of range")
+    return reco_id, delta
+
+
+def add_likes_chunk(deltas: dict) -> list:
+    """Applies a chunk of like deltas and returns the result for each recommendation"""
+    likes = Recommendation.add_likes_in_bulk(deltas, clamp=False)
+    # tell apart the recommendations that do not exist from the rejected deltas
+    unapplied = [reco_id for reco_id in deltas if reco_id not in likes]
+    missing = set(Recommendation.find_many(unapplied, ["id"])[1]) if unapplied else set()
+    results = []
+    for reco_id in deltas:
+        if reco_id in likes:
+            results.append({"id": reco_id, "status": status.HTTP_200_OK, "number_of_likes": likes[reco_id]})
+        elif reco_id in missing:
+            results.append({"id": reco_id, "status": status.HTTP_404_NOT_FOUND, "message": "Not found"})
+        else:
+            results.append({"id": reco_id, "status": status.HTTP_400_BAD_REQUEST,
+                            "message": "Recommendation would have fewer than 0 likes or too many"})
+    return results
+
+
 @api.route('/recommendations/<int:recommendation_id>/like', strict_slashes=True)
 @api.param('recommendation_id', "The recommendation id")
 class RecommendationLikeResource(Resource):
@@ -233,11 +802,13 @@ class RecommendationLikeResource(Resource):
         """
         app.logger.info(
             "Request to like recommendation with id: %s", recommendation_id)
-        recommendation = Recommendation.find(recommendation_id)
+        if like_buffer.enabled:
+            recommendation = like_buffer.like(recommendation_id)
+        else:
+            recommendation = Recommendation.like_by_id(recommendation_id)
         if recommendation is None:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Recommendation id {recommendation_id} does not exist")
-        recommendation.like()
         message = recommendation.serialize()
         app.logger.info(
             "Recommendation with ID [%s] liked.", recommendation_id)
@@ -263,11 +834,13 @@ class RecommendationDislikeResource(Resource):
         """
         app.logger.info(
             "Request to dislike recommendation with id: %s", recommendation_id)
-        recommendation = Recommendation.find(recommendation_id)
+        if like_buffer.enabled:
+            recommendation = like_buffer.dislike(recommendation_id)
+        else:
+            recommendation = Recommendation.dislike_by_id(recommendation_id)
         if recommendation is None:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Recommendation id {recommendation_id} does not exist")
-        recommendation.dislike()
         message = recommendation.serialize()
         app.logger.info(
             "Recommendation with ID [%s] disliked.", recommendation_id)
@@ -276,26 +849,110 @@ class RecommendationDislikeResource(Resource):
         return message, status.HTTP_200_OK, {"Location": location_url}
 
 
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of the correct ones"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s",
                      request.headers["Content-Type"])
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
     )
 
 
+class NotModified(HTTPException):
+    """Answers a conditional GET when the client already has the current version"""
+
+    code = status.HTTP_304_NOT_MODIFIED
+    description = "Not Modified"
+
+    def __init__(self, etag: str):
+        super().__init__()
+        self.etag = etag
+
+    def get_response(self, environ=None, scope=None):
+        response = Response(status=self.code)
+        response.set_etag(self.etag)
+        return response
+
+
+def compute_etag(data) -> str:
+    """Returns a strong entity tag for the serialized representation"""
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def check_not_modified(etag: str):
+    """Stops with 304 Not Modified if the client sent a matching If-None-Match"""
+    if request.if_none_match.contains(etag):
+        app.logger.info("Returning 304 for ETag %s", etag)
+        raise NotModified(etag)
+
+
+def get_fields():
+    """Returns the fields requested with the fields query argument, or None for all of them"""
+    fields_string = request.args.get("fields")
+    if not fields_string:
+        return None
+    return Recommendation.check_fields([field.strip() for field in fields_string.split(",")])
+
+
+def get_ids():
+    """Returns the distinct ids asked for with the ids query argument, or None"""
+    ids_string = request.args.get("ids")
+    if not ids_string:
+        return None
+    try:
+        ids = list(dict.fromkeys(int(reco_id) for reco_id in ids_string.split(",")))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid ids {ids_string}")
+    if len(ids) > app.config["MAX_BATCH_SIZE"]:
+        abort(status.HTTP_400_BAD_REQUEST, f"No more than {app.config['MAX_BATCH_SIZE']} ids can be requested at once")
+    return ids
+
+
+def next_page_link(next_cursor: str, limit: int, resource: type, **values) -> str:
+    """Returns a Link header pointing at the next page of the current query
+
+    :param resource: the Resource being paged through
+    :param values: the path parameters of the resource
+    """
+    args = request.args.to_dict()
+    args.update(cursor=next_cursor, limit=limit)
+    next_url = api.url_for(resource, _external=True, **values, **args)
+    return f'<{next_url}>; rel="next"'
+
+
+def get_int(name: str, default: int = None) -> int:
+    """Returns an integer query argument"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid {name} {value}")
+    return None
+
+
+def get_page_limit():
+    """Returns the requested page size capped at the server maximum"""
+    limit = get_int("limit", app.config["DEFAULT_PAGE_SIZE"])
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+    return min(limit, app.config["MAX_PAGE_SIZE"])
+
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
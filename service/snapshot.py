@@ -0,0 +1,418 @@
+"""
+Recommendation Snapshot
+
+An optional serving mode for the workers of read-only replicas of the
+service. With SNAPSHOT_ENABLED each worker loads the recommendation table
+into a columnar copy in memory and answers the GET requests from it instead
+of the database.
+
+Every SNAPSHOT_REFRESH_INTERVAL seconds the snapshot reads the rows whose
+updated_at is past the latest one it has seen, less SNAPSHOT_REFRESH_OVERLAP
+seconds for the transactions that were still running, and only reads all
+of the ids when the row count shows that some were deleted. Reads can be
+up to SNAPSHOT_REFRESH_INTERVAL seconds behind the writes. Until the first
+load completes, and for GET requests sent with Cache-Control: no-cache,
+they go to the database.
+"""
+import os
+import heapq
+import atexit
+import bisect
+import logging
+import operator
+import sys
+import threading
+from array import array
+from datetime import timedelta
+from flask import Flask, has_request_context, request
+from sqlalchemy import func, select
+from service.models import Recommendation, RecommendationType, DataValidationError, db, replicas
+
+logger = logging.getLogger("flask.app")
+
+# The types are stored as their position, which is also the order the database sorts them in
+TYPES = list(RecommendationType)
+
+# Stands for NULL in the integer columns
+NULL = -2 ** 63
+
+# The filters answered from an index of the ids with each value
+INDEXED = ("name", "type", "recommendation_id")
+
+# Number of changed rows applied to the snapshot at once
+PARTITION_SIZE = 1000
+
+
+class RecommendationSnapshot:
+    """A columnar copy of the recommendation table
+
+    Each column is an array, or a list for the strings, ordered by id so
+    that a row is found by bisecting the ids. Names are interned so the
+    recommendations of a product share one string, and the ids of the rows
+    are indexed by name, type and recommendation_id. Strings sort by code
+    point, which can differ from the collation of the database, so a page
+    sorted by a name should be followed with the same serving mode.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.columns = {
+            "id": self.ids,
+            "name": [],
+            "recommendation_id": array("q"),
+            "recommendation_name": [],
+            "type": array("B"),
+            "number_of_likes": array("q"),
+        }
+        self.indexes = {name: {} for name in INDEXED}
+        self.high_water = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    ######################################################################
+    #  C H A N G E S
+    ######################################################################
+
+    def apply(self, rows) -> int:
+        """Inserts or replaces rows of the table
+
+        :param rows: rows with the Recommendation.FIELDS and updated_at
+        :return: the number of rows applied
+        """
+        count = 0
+        with self._lock:
+            for row in rows:
+                values = self._encode(row)
+                position = bisect.bisect_left(self.ids, row.id)
+                if position < len(self.ids) and self.ids[position] == row.id:
+                    self._unindex(position)
+                    for name, value in values.items():
+                        self.columns[name][position] = value
+                else:
+                    for name, value in values.items():
+                        self.columns[name].insert(position, value)
+                self._index(position)
+                if self.high_water is None or row.updated_at > self.high_water:
+                    self.high_water = row.updated_at
+                count += 1
+        return count
+
+    def retain(self, ids) -> int:
+        """Removes the rows whose id is not one of ids
+
+        :return: the number of rows removed
+        """
+        ids = set(ids)
+        with self._lock:
+            keep = [position for position, reco_id in enumerate(self.ids) if reco_id in ids]
+            removed = len(self.ids) - len(keep)
+            if removed:
+                for name, column in self.columns.items():
+                    kept = [column[position] for position in keep]
+                    column[:] = array(column.typecode, kept) if isinstance(column, array) else kept
+                self.indexes = {name: {} for name in INDEXED}
+                for position in range(len(self.ids)):
+                    self._index(position)
+        return removed
+
+    @staticmethod
+    def _encode(row) -> dict:
+        """Returns the stored value of each column of a row"""
+        return {
+            "id": row.id,
+            "name": sys.intern(row.name) if row.name is not None else None,
+            "recommendation_id": NULL if row.recommendation_id is None else row.recommendation_id,
+            "recommendation_name": (
+                sys.intern(row.recommendation_name) if row.recommendation_name is not None else None),
+            "type": TYPES.index(row.type),
+            "number_of_likes": NULL if row.number_of_likes is None else row.number_of_likes,
+        }
+
+    def _index(self, position: int):
+        reco_id = self.ids[position]
+        for name in INDEXED:
+            self.indexes[name].setdefault(self._value(name, position), set()).add(reco_id)
+
+    def _unindex(self, position: int):
+        reco_id = self.ids[position]
+        for name in INDEXED:
+            value = self._value(name, position)
+            ids = self.indexes[name][value]
+            ids.discard(reco_id)
+            if not ids:
+                del self.indexes[name][value]
+
+    ######################################################################
+    #  R E A D S
+    ######################################################################
+
+    def get(self, reco_id: int, fields: list = None):
+        """Returns the serialized recommendation with the id, or None if not found"""
+        with self._lock:
+            position = self._position(reco_id)
+            if position is None:
+                return None
+            return self._serialize(position, fields or Recommendation.FIELDS)
+
+    def find_many(self, ids: list, fields: list = None) -> tuple:
+        """Returns the serialized recommendations with the ids, like Recommendation.find_many"""
+        fields = Recommendation.check_fields(fields or Recommendation.FIELDS)
+        results = []
+        missing = []
+        with self._lock:
+            for reco_id in ids:
+                position = self._position(reco_id)
+                if position is None:
+                    missing.append(reco_id)
+                else:
+                    results.append(self._serialize(position, fields))
+        return results, missing
+
+    def page(self, fields: list, cursor: str = None, limit: int = 100, sort: str = "id", **filters) -> tuple:
+        """Returns a page of serialized recommendations, like Recommendation.paginate_fields
+
+        The rows are in the same order and the cursors are the same as the
+        ones of the database.
+
+        :raises DataValidationError: if a field, filter, sort or the cursor is invalid
+        """
+        name, descending = Recommendation.check_sort(sort)
+        Recommendation.check_fields(fields)
+        after = Recommendation.decode_cursor(cursor, sort) if cursor else None
+        with self._lock:
+            positions = self._positions(filters)
+            if name == "id":
+                if after:
+                    # the positions are in id order, so the page starts where the id would be
+                    if descending:
+                        positions = positions[:bisect.bisect_left(positions, bisect.bisect_left(self.ids, after[0]))]
+                    else:
+                        positions = positions[bisect.bisect_left(positions, bisect.bisect_right(self.ids, after[0])):]
+                if descending:
+                    positions = positions[::-1]
+                rows = list(positions[:limit + 1])
+            else:
+                key = self._sort_key(name, descending)
+                if after:
+                    last_id, last_key = after
+                    bound = (last_key is not None, last_key, last_id) if descending else \
+                        (last_key is None, last_key, last_id)
+                    beyond = operator.lt if descending else operator.gt
+                    positions = (position for position in positions if beyond(key(position), bound))
+                pick = heapq.nlargest if descending else heapq.nsmallest
+                rows = pick(limit + 1, positions, key)
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last_key = None if name == "id" else self._value(name, rows[-1])
+                next_cursor = Recommendation.encode_cursor(self.ids[rows[-1]], sort, last_key)
+            return [self._serialize(position, fields) for position in rows], next_cursor
+
+    def product_list(self, name: str) -> list:
+        """Returns the recommendations for a product in the order of RecommendationList"""
+        with self._lock:
+            likes = self.columns["number_of_likes"]
+            types = self.columns["type"]
+            positions = sorted(self._positions({"name": name}), key=lambda position: (
+                types[position], likes[position] == NULL, -likes[position], self.ids[position]))
+            return [self._serialize(position, Recommendation.FIELDS) for position in positions]
+
+    def top(self, limit: int = 10, name: str = None, recommendation_type: RecommendationType = None) -> list:
+        """Returns the most liked recommendations, like Recommendation.find_top"""
+        filters = {}
+        if name is not None:
+            filters["name"] = name
+        if recommendation_type is not None:
+            filters["type"] = recommendation_type
+        with self._lock:
+            likes = self.columns["number_of_likes"]
+            positions = heapq.nsmallest(limit, self._positions(filters), key=lambda position: (
+                likes[position] == NULL, -likes[position], self.ids[position]))
+            return [self._serialize(position, Recommendation.FIELDS) for position in positions]
+
+    def export(self, chunk_size: int = 1000, **filters):
+        """Yields the matching recommendations ordered by id, one chunk at a time
+
+        The lock is only held while a chunk is built, so the snapshot keeps
+        being refreshed during a long export.
+        """
+        with self._lock:
+            ids = [self.ids[position] for position in self._positions(filters)]
+        for start in range(0, len(ids), chunk_size):
+            chunk, _ = self.find_many(ids[start:start + chunk_size])
+            if chunk:
+                yield chunk
+
+    def _position(self, reco_id: int):
+        """Returns the position of the row with the id, or None"""
+        position = bisect.bisect_left(self.ids, reco_id)
+        if position < len(self.ids) and self.ids[position] == reco_id:
+            return position
+        return None
+
+    def _positions(self, filters: dict):
+        """Returns the positions of the rows that match all of the filters, in id order
+
+        The rows are looked up in the smallest of the indexes that the filters
+        use, or scanned when none of them does, and then checked against
+        every filter. Without filters it is a range of every position.
+
+        :raises DataValidationError: if a filter is not one of the FILTERS
+        """
+        checks = []
+        for name, value in filters.items():
+            if name not in Recommendation.FILTERS:
+                raise DataValidationError("Invalid filter " + name)
+            column_name, compare, _ = Recommendation.FILTERS[name]
+            checks.append((column_name, compare, value))
+        candidates = None
+        if "id" in filters:
+            candidates = {filters["id"]}
+        for name in INDEXED:
+            if name in filters:
+                ids = self.indexes[name].get(filters[name], set())
+                if candidates is None or len(ids) < len(candidates):
+                    candidates = ids
+        if not checks:
+            return range(len(self.ids))
+        if candidates is None:
+            positions = range(len(self.ids))
+        else:
+            positions = sorted(
+                position for position in map(self._position, candidates) if position is not None)
+        return [position for position in positions if self._matches(position, checks)]
+
+    def _matches(self, position: int, checks: list) -> bool:
+        for column_name, compare, value in checks:
+            row_value = self._value(column_name, position)
+            # like SQL, a NULL never matches
+            if row_value is None or not compare(row_value, value):
+                return False
+        return True
+
+    def _sort_key(self, name: str, descending: bool):
+        """Returns the key that orders rows like keyset(), with NULLs last in both directions"""
+        if descending:
+            # reversed, so the rows with a value come first
+            return lambda position: (self._value(name, position) is not None, self._value(name, position),
+                                     self.ids[position])
+        return lambda position: (self._value(name, position) is None, self._value(name, position),
+                                 self.ids[position])
+
+    def _value(self, name: str, position: int):
+        """Returns the value of a column of a row as the model has it"""
+        value = self.columns[name][position]
+        if name == "type":
+            return TYPES[value]
+        if value == NULL and name in ("recommendation_id", "number_of_likes"):
+            return None
+        return value
+
+    def _serialize(self, position: int, fields) -> dict:
+        serialized = {field: self._value(field, position) for field in fields}
+        if "type" in serialized:
+            serialized["type"] = serialized["type"].name
+        return serialized
+
+
+class SnapshotServer:
+    """Keeps the snapshot of this worker up to date and hands it to the routes"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 10.0
+        self.overlap = 30.0
+        self.snapshot = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        """Configures the snapshot from the Flask app config"""
+        self.app = app
+        self.enabled = app.config["SNAPSHOT_ENABLED"]
+        self.interval = app.config["SNAPSHOT_REFRESH_INTERVAL"]
+        self.overlap = app.config["SNAPSHOT_REFRESH_OVERLAP"]
+        self.snapshot = None
+        if self.enabled:
+            atexit.register(self.stop)
+
+    def serving(self):
+        """Returns the snapshot to answer a read from, or None to use the database"""
+        if not self.enabled:
+            return None
+        self._start()
+        if has_request_context() and "no-cache" in request.headers.get("Cache-Control", ""):
+            return None
+        return self.snapshot
+
+    def refresh(self) -> RecommendationSnapshot:
+        """Loads the snapshot, or brings it up to date with the changes since the last refresh
+
+        The rows are read from a read replica when there is one. The changes
+        and the row count are read in one REPEATABLE READ transaction, so a
+        count that matches the snapshot means nothing was deleted.
+        """
+        snapshot = self.snapshot or RecommendationSnapshot()
+        table = Recommendation.__table__
+        rows = select(*[table.c[name] for name in Recommendation.FIELDS], table.c.updated_at).order_by(table.c.id)
+        changes = rows
+        if snapshot.high_water is not None:
+            changes = rows.where(table.c.updated_at > snapshot.high_water - timedelta(seconds=self.overlap))
+        engine = replicas.choose() or db.get_engine(self.app)
+        with engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                connection = connection.execution_options(isolation_level="REPEATABLE READ")
+            with connection.begin():
+                result = connection.execution_options(stream_results=True).execute(changes)
+                # applied a partition at a time so the reads are not held up by the fetches
+                changed = sum(snapshot.apply(partition) for partition in result.partitions(PARTITION_SIZE))
+                count = connection.execute(select(func.count()).select_from(table)).scalar()
+                removed = 0
+                if count != len(snapshot):
+                    ids = set(connection.execute(select(table.c.id)).scalars())
+                    removed = snapshot.retain(ids)
+                    # rows written by a transaction that ran for longer than the overlap
+                    missed = ids.difference(snapshot.ids)
+                    if missed:
+                        changed += snapshot.apply(connection.execute(rows.where(table.c.id.in_(missed))))
+        logger.info("Snapshot of %d recommendations refreshed, %d changed and %d removed",
+                    len(snapshot), changed, removed)
+        self.snapshot = snapshot
+        return snapshot
+
+    def stop(self):
+        """Stops the background refresh"""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+
+    def _start(self):
+        """Starts the background refresh in this process if needed"""
+        if self.interval <= 0:
+            return
+        # a thread does not survive a fork so each worker starts its own
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="snapshot-refresh", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Could not refresh the snapshot: %s", error)
+            self._stopped.wait(self.interval)
+
+
+# The snapshot used by the routes, configured from the app in service/__init__.py
+snapshot_server = SnapshotServer()
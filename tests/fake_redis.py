@@ -0,0 +1,72 @@
+"""
+A stand-in for the Redis client used by the tests
+
+Only the commands that the service uses are implemented.
+"""
+import fnmatch
+
+
+class FakeRedis:
+    """A stand-in for the few redis-py commands that the service uses"""
+
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+
+    def hlen(self, key):
+        """Returns the number of fields in a hash"""
+        return len(self.hashes.get(key, {}))
+
+    def hincrby(self, key, field, amount):
+        """Increments a field of a hash"""
+        fields = self.hashes.setdefault(key, {})
+        fields[str(field).encode()] = int(fields.get(str(field).encode(), 0)) + amount
+        return fields[str(field).encode()]
+
+    def hget(self, key, field):
+        """Returns a field of a hash"""
+        return self.hashes.get(key, {}).get(str(field).encode())
+
+    def get(self, key):
+        """Returns the value of a key"""
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        """Sets the value of a key"""
+        self.values[key] = value.encode() if isinstance(value, str) else value
+
+    def delete(self, *keys):
+        """Deletes keys of any kind"""
+        count = 0
+        for key in keys:
+            count += int(self.values.pop(key, None) is not None)
+            count += int(self.hashes.pop(key, None) is not None)
+        return count
+
+    def scan_iter(self, match="*"):
+        """Iterates over the keys that match a glob pattern"""
+        return [key for key in list(self.values) + list(self.hashes) if fnmatch.fnmatch(key, match)]
+
+    def pipeline(self):
+        """Returns a pipeline that queues the commands"""
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Queues commands and runs them on execute()"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def hgetall(self, key):
+        """Queues HGETALL"""
+        self.commands.append(lambda: dict(self.client.hashes.get(key, {})))
+
+    def delete(self, key):
+        """Queues DEL"""
+        self.commands.append(lambda: self.client.delete(key))
+
+    def execute(self):
+        """Runs the queued commands"""
+        return [command() for command in self.commands]
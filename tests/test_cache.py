@@ -0,0 +1,87 @@
+"""
+Test cases for the Cache
+
+"""
+import time
+import unittest
+from service.common.cache import Cache, LRUCache, RedisCache
+from tests.fake_redis import FakeRedis
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """ Test Cases for the Cache """
+
+    def test_lru_cache(self):
+        """It should store and remove values in memory"""
+        backend = LRUCache(max_size=2)
+        self.assertIsNone(backend.get(1))
+        backend.set(1, {"id": 1})
+        self.assertEqual(backend.get(1), {"id": 1})
+        backend.delete(1)
+        self.assertIsNone(backend.get(1))
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        """It should evict the least recently used value when full"""
+        backend = LRUCache(max_size=2)
+        backend.set(1, "one")
+        backend.set(2, "two")
+        backend.get(1)
+        backend.set(3, "three")
+        self.assertEqual(backend.get(1), "one")
+        self.assertIsNone(backend.get(2))
+        self.assertEqual(backend.get(3), "three")
+
+    def test_lru_cache_expires(self):
+        """It should not return values older than the ttl"""
+        backend = LRUCache(ttl=0.01)
+        backend.set(1, "one")
+        time.sleep(0.02)
+        self.assertIsNone(backend.get(1))
+
+    def test_redis_cache(self):
+        """It should store and remove values in Redis"""
+        client = FakeRedis()
+        backend = RedisCache(client, prefix="test:")
+        backend.set(1, {"id": 1})
+        self.assertEqual(client.get("test:1"), b'{"id": 1}')
+        self.assertEqual(backend.get(1), {"id": 1})
+        backend.delete(1)
+        self.assertIsNone(backend.get(1))
+        backend.set(2, "two")
+        backend.clear()
+        self.assertIsNone(backend.get(2))
+
+    def test_read_through(self):
+        """It should only call the loader on a miss and count hits and misses"""
+        cache = Cache(LRUCache())
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return {"id": 1}
+
+        self.assertEqual(cache.get_or_load(1, loader), {"id": 1})
+        self.assertEqual(cache.get_or_load(1, loader), {"id": 1})
+        self.assertEqual(len(loads), 1)
+        cache.invalidate(1)
+        cache.get_or_load(1, loader)
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.stats(), {"backend": "LRUCache", "hits": 1, "misses": 2})
+        cache.clear()
+        self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_read_through_does_not_cache_none(self):
+        """It should not cache a value that was not found"""
+        cache = Cache(LRUCache())
+        self.assertIsNone(cache.get_or_load(1, lambda: None))
+        self.assertEqual(cache.get_or_load(1, lambda: "found"), "found")
+
+    def test_no_backend(self):
+        """It should call the loader every time without a backend"""
+        cache = Cache()
+        self.assertEqual(cache.get_or_load(1, lambda: "one"), "one")
+        cache.invalidate(1)
+        self.assertEqual(cache.stats(), {"backend": None, "hits": 0, "misses": 0})
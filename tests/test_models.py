@@ -6,8 +6,11 @@ Test cases for Recommendations Model
 import os
 import logging
 import unittest
+import threading
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError
 from werkzeug.exceptions import NotFound
-from service.models import Recommendation, RecommendationType, DataValidationError, db
+from service.models import Recommendation, RecommendationList, RecommendationType, DataValidationError, db
 from service import app
 from tests.factories import RecommendationFactory
 
@@ -42,6 +45,7 @@ class TestRecommendationModel(unittest.TestCase):
     def setUp(self):
         """ This runs before each test """
         db.session.query(Recommendation).delete()  # clean up the last tests
+        db.session.query(RecommendationList).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -95,6 +99,80 @@ class TestRecommendationModel(unittest.TestCase):
         self.assertEqual(found_recommendation.name, recommendation.name)
         self.assertEqual(found_recommendation.recommendation_id, recommendation.recommendation_id)
 
+    def test_create_recommendations_in_bulk(self):
+        """It should Create many recommendations with one insert"""
+        recommendations = RecommendationFactory.create_batch(3)
+        for recommendation in recommendations:
+            recommendation.id = None
+        Recommendation.create_in_bulk(recommendations)
+        self.assertEqual(len(Recommendation.all()), 3)
+        for recommendation in recommendations:
+            found = Recommendation.find(recommendation.id)
+            self.assertEqual(found.name, recommendation.name)
+            self.assertEqual(found.recommendation_id, recommendation.recommendation_id)
+            self.assertEqual(found.number_of_likes, 0)
+        self.assertEqual(Recommendation.create_in_bulk([]), [])
+
+    def test_create_duplicates_in_bulk(self):
+        """It should not Create a recommendation with the natural key of another one"""
+        existing = RecommendationFactory()
+        existing.create()
+        recommendations = [RecommendationFactory() for _ in range(2)]
+        duplicate = RecommendationFactory(
+            name=existing.name, recommendation_id=existing.recommendation_id, type=existing.type)
+        created = Recommendation.create_in_bulk([recommendations[0], duplicate, recommendations[1]])
+        self.assertEqual(created, recommendations)
+        self.assertIsNone(duplicate.id)
+        self.assertEqual(len(Recommendation.all()), 3)
+
+    def test_duplicates_natural_key(self):
+        """It should tell a duplicate natural key from the other constraint violations"""
+        existing = RecommendationFactory()
+        existing.create()
+        duplicate = RecommendationFactory(
+            name=existing.name, recommendation_id=existing.recommendation_id, type=existing.type)
+        other = RecommendationFactory(id=existing.id)
+        for recommendation, expected in ((duplicate, True), (other, False)):
+            db.session.add(recommendation)
+            with self.assertRaises(IntegrityError) as context:
+                db.session.commit()
+            db.session.rollback()
+            self.assertEqual(Recommendation.duplicates_natural_key(context.exception), expected)
+
+    def test_upsert_recommendations(self):
+        """It should Create the new recommendations and Update the existing ones"""
+        existing = RecommendationFactory(number_of_likes=4)
+        existing.create()
+        RecommendationList.find_serialized(existing.name)
+        update = RecommendationFactory(
+            name=existing.name, recommendation_id=existing.recommendation_id, type=existing.type,
+            recommendation_name="renamed", number_of_likes=7)
+        new = RecommendationFactory()
+        again = RecommendationFactory(
+            name=new.name, recommendation_id=new.recommendation_id, type=new.type, number_of_likes=2)
+        self.assertEqual(Recommendation.upsert_in_bulk([update, new, again]), [False, True, False])
+        self.assertEqual(update.id, existing.id)
+        self.assertEqual(again.id, new.id)
+        self.assertEqual(len(Recommendation.all()), 2)
+        found = Recommendation.find(existing.id)
+        self.assertEqual(found.recommendation_name, "renamed")
+        self.assertEqual(found.number_of_likes, 7)
+        self.assertEqual(Recommendation.find(new.id).number_of_likes, 2)
+        self.assertEqual(RecommendationList.find_serialized(existing.name)[0]["number_of_likes"], 7)
+        self.assertEqual(Recommendation.upsert_in_bulk([]), [])
+
+    def test_upsert_a_recommendation(self):
+        """It should Create a recommendation, and Update it when it is upserted again"""
+        recommendation = RecommendationFactory()
+        self.assertTrue(recommendation.upsert())
+        reco_id = recommendation.id
+        recommendation.number_of_likes = 3
+        self.assertFalse(recommendation.upsert())
+        self.assertEqual(recommendation.id, reco_id)
+        self.assertEqual(Recommendation.find(reco_id).number_of_likes, 3)
+        recommendation.recommendation_id = None
+        self.assertRaises(DataValidationError, recommendation.upsert)
+
     def test_update_a_recommendation(self):
         """It should Update a recommendation"""
         recommendation = RecommendationFactory()
@@ -149,6 +227,63 @@ class TestRecommendationModel(unittest.TestCase):
         self.assertEqual(len(Recommendation.all()), 1)
         self.assertRaises(DataValidationError, recommendation.dislike)
 
+    def test_like_and_dislike_by_id(self):
+        """It should like and dislike a recommendation by its id"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        liked = Recommendation.like_by_id(recommendation.id)
+        self.assertEqual(liked.id, recommendation.id)
+        self.assertEqual(liked.name, recommendation.name)
+        self.assertEqual(liked.number_of_likes, 1)
+        disliked = Recommendation.dislike_by_id(recommendation.id)
+        self.assertEqual(disliked.number_of_likes, 0)
+        self.assertEqual(Recommendation.find(recommendation.id).number_of_likes, 0)
+        self.assertRaises(DataValidationError, Recommendation.dislike_by_id, recommendation.id)
+
+    def test_like_and_dislike_by_id_not_found(self):
+        """It should not like or dislike a recommendation that does not exist"""
+        self.assertIsNone(Recommendation.like_by_id(0))
+        self.assertIsNone(Recommendation.dislike_by_id(0))
+
+    def test_add_likes_in_bulk(self):
+        """It should clamp, or reject, like deltas that go below 0"""
+        recommendations = RecommendationFactory.create_batch(2, number_of_likes=1)
+        for recommendation in recommendations:
+            recommendation.create()
+        first, second = (recommendation.id for recommendation in recommendations)
+        likes = Recommendation.add_likes_in_bulk({first: 2, second: -3, 0: 1}, clamp=False)
+        self.assertEqual(likes, {first: 3})
+        likes = Recommendation.add_likes_in_bulk({first: 2, second: -3})
+        self.assertEqual(likes, {first: 5, second: 0})
+
+    def test_add_likes_in_bulk_past_the_column(self):
+        """It should clamp, or reject, like deltas that go past the Integer column"""
+        recommendation = RecommendationFactory(number_of_likes=2**31 - 2)
+        recommendation.create()
+        most = 2**31 - 1
+        self.assertEqual(Recommendation.add_likes_in_bulk({recommendation.id: 5}, clamp=False), {})
+        self.assertEqual(Recommendation.add_likes_in_bulk({recommendation.id: most}), {recommendation.id: most})
+
+    def test_like_concurrently(self):
+        """It should not lose likes that happen at the same time"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        reco_id = recommendation.id
+
+        def like_many():
+            with app.app_context():
+                for _ in range(10):
+                    Recommendation.like_by_id(reco_id)
+                db.session.remove()
+
+        threads = [threading.Thread(target=like_many) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.refresh(recommendation)
+        self.assertEqual(recommendation.number_of_likes, 50)
+
     def test_delete_a_recommendation(self):
         """It should Delete a recommendation"""
         recommendation = RecommendationFactory()
@@ -235,6 +370,27 @@ class TestRecommendationModel(unittest.TestCase):
         recommendation = Recommendation()
         self.assertRaises(DataValidationError, recommendation.deserialize, data)
 
+    def test_deserialize_bad_values(self):
+        """It should not deserialize values that do not fit in their columns"""
+        bad_values = {
+            "name": ["x" * 64, 5],
+            "recommendation_id": ["x", 1.5, True, 2**31, [1]],
+            "recommendation_name": [{"name": "prodB"}],
+            "number_of_likes": ["many", -2**31 - 1],
+        }
+        for name, values in bad_values.items():
+            for value in values:
+                with self.subTest(name=name, value=value):
+                    data = dict(RecommendationFactory().serialize(), **{name: value})
+                    self.assertRaises(DataValidationError, Recommendation().deserialize, data)
+
+    def test_deserialize_integer_strings(self):
+        """It should de-serialize integers sent as strings"""
+        data = dict(RecommendationFactory().serialize(), recommendation_id="12", number_of_likes="3")
+        recommendation = Recommendation().deserialize(data)
+        self.assertEqual(recommendation.recommendation_id, 12)
+        self.assertEqual(recommendation.number_of_likes, 3)
+
     def test_find_recommendation(self):
         """It should Find a recommendation by ID"""
         recommendations = RecommendationFactory.create_batch(5)
@@ -298,3 +454,282 @@ class TestRecommendationModel(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """It should return 404 not found"""
         self.assertRaises(NotFound, Recommendation.find_or_404, 0)
+
+    def test_export_recommendations(self):
+        """It should export recommendations in chunks"""
+        recommendations = RecommendationFactory.create_batch(5)
+        for recommendation in recommendations:
+            recommendation.create()
+        chunks = list(Recommendation.export(chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        exported = [rec for chunk in chunks for rec in chunk]
+        self.assertEqual(exported[0], Recommendation.find(exported[0]["id"]).serialize())
+        name = recommendations[2].name
+        exported = [rec for chunk in Recommendation.export(name=name) for rec in chunk]
+        self.assertEqual([rec["name"] for rec in exported], [name])
+        self.assertRaises(DataValidationError, list, Recommendation.export(colour="red"))
+
+    def test_paginate_recommendations(self):
+        """It should return recommendations one page at a time"""
+        recommendations = RecommendationFactory.create_batch(5)
+        for recommendation in recommendations:
+            recommendation.create()
+        ids = sorted(recommendation.id for recommendation in recommendations)
+        page, cursor = Recommendation.paginate(limit=2)
+        self.assertEqual([rec.id for rec in page], ids[:2])
+        self.assertIsNotNone(cursor)
+        page, cursor = Recommendation.paginate(cursor=cursor, limit=2)
+        self.assertEqual([rec.id for rec in page], ids[2:4])
+        page, cursor = Recommendation.paginate(cursor=cursor, limit=2)
+        self.assertEqual([rec.id for rec in page], ids[4:])
+        self.assertIsNone(cursor)
+
+    def test_paginate_a_query(self):
+        """It should paginate the results of a find query"""
+        recommendations = RecommendationFactory.create_batch(3, name="prodA")
+        recommendations.append(RecommendationFactory(name="prodB"))
+        for recommendation in recommendations:
+            recommendation.create()
+        page, cursor = Recommendation.paginate(Recommendation.find_by_name("prodA"), limit=3)
+        self.assertEqual(len(page), 3)
+        self.assertIsNone(cursor)
+        for recommendation in page:
+            self.assertEqual(recommendation.name, "prodA")
+
+    def test_paginate_fields(self):
+        """It should return pages with only the requested fields"""
+        recommendations = RecommendationFactory.create_batch(3, name="prodA")
+        for recommendation in recommendations:
+            recommendation.create()
+        query = Recommendation.find_by_name("prodA")
+        page, cursor = Recommendation.paginate_fields(["name", "type"], query, limit=2)
+        self.assertEqual(page, [{"name": "prodA", "type": rec.type.name} for rec in recommendations[:2]])
+        page, cursor = Recommendation.paginate_fields(["name", "type"], query, cursor, limit=2)
+        self.assertEqual(len(page), 1)
+        self.assertIsNone(cursor)
+        self.assertRaises(DataValidationError, Recommendation.paginate_fields, ["colour"])
+
+    def test_find_recommended_by(self):
+        """It should find the products that recommend a product, most liked first"""
+        likes = [3, 9, 3, 0]
+        recommendations = [RecommendationFactory(recommendation_id=7, number_of_likes=count) for count in likes]
+        recommendations.append(RecommendationFactory(recommendation_id=8, number_of_likes=20))
+        for recommendation in recommendations:
+            recommendation.create()
+        query = Recommendation.find_recommended_by(7)
+        page, cursor = Recommendation.paginate_fields(
+            ["id", "name"], query, limit=3, sort=Recommendation.RECOMMENDED_BY_SORT)
+        expected = [recommendations[1], recommendations[2], recommendations[0], recommendations[3]]
+        self.assertEqual(page, [{"id": rec.id, "name": rec.name} for rec in expected[:3]])
+        page, cursor = Recommendation.paginate_fields(
+            ["id", "name"], query, cursor, limit=3, sort=Recommendation.RECOMMENDED_BY_SORT)
+        self.assertEqual(page, [{"id": expected[3].id, "name": expected[3].name}])
+        self.assertIsNone(cursor)
+        self.assertEqual(Recommendation.find_recommended_by(0).count(), 0)
+
+    def test_find_many(self):
+        """It should find Recommendations by ids with one query"""
+        recommendations = RecommendationFactory.create_batch(3)
+        for recommendation in recommendations:
+            recommendation.create()
+        ids = [recommendations[2].id, 0, recommendations[0].id]
+        found, missing = Recommendation.find_many(ids)
+        self.assertEqual(found, [recommendations[2].serialize(), recommendations[0].serialize()])
+        self.assertEqual(missing, [0])
+        found, missing = Recommendation.find_many([recommendations[1].id], ["type"])
+        self.assertEqual(found, [{"type": recommendations[1].type.name}])
+        self.assertEqual(missing, [])
+        self.assertRaises(DataValidationError, Recommendation.find_many, [1], ["colour"])
+
+    def test_recommendation_list(self):
+        """It should keep the list of a product up to date as recommendations change"""
+        first = RecommendationFactory(name="prodA", type=RecommendationType.UPSELL, number_of_likes=1)
+        second = RecommendationFactory(name="prodA", type=RecommendationType.UPSELL, number_of_likes=5)
+        accessory = RecommendationFactory(name="prodA", type=RecommendationType.ACCESSORY, number_of_likes=9)
+        for recommendation in (accessory, first, second):
+            recommendation.create()
+
+        def listed():
+            return [(rec["id"], rec["number_of_likes"]) for rec in RecommendationList.find_serialized("prodA")]
+
+        self.assertEqual(listed(), [(second.id, 5), (first.id, 1), (accessory.id, 9)])
+        for _ in range(5):
+            Recommendation.like_by_id(first.id)
+        self.assertEqual(listed(), [(first.id, 6), (second.id, 5), (accessory.id, 9)])
+        Recommendation.add_likes_in_bulk({second.id: 2})
+        self.assertEqual(listed(), [(second.id, 7), (first.id, 6), (accessory.id, 9)])
+        accessory.delete()
+        first.name = "prodB"
+        first.update()
+        self.assertEqual(listed(), [(second.id, 7)])
+        self.assertEqual(RecommendationList.find_serialized("prodB"), [first.serialize()])
+        second.delete()
+        self.assertEqual(RecommendationList.find_serialized("prodA"), [])
+        self.assertIsNone(db.session.get(RecommendationList, "prodA"))
+
+    def test_likes_patch_recommendation_lists(self):
+        """It should patch the likes into the list of a product in the statement that updates them"""
+        recommendations = RecommendationFactory.create_batch(6, name="prodA", number_of_likes=2)
+        Recommendation.create_in_bulk(recommendations)
+        statements = []
+
+        def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            Recommendation.like_by_id(recommendations[3].id)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(len(statements), 1)
+        Recommendation.dislike_by_id(recommendations[0].id)
+        Recommendation.add_likes_in_bulk({recommendations[1].id: 4, recommendations[5].id: -2})
+        patched = RecommendationList.find_serialized("prodA")
+        RecommendationList.refresh("prodA")
+        self.assertEqual(patched, RecommendationList.find_serialized("prodA"))
+
+    def test_rebuild_recommendation_lists(self):
+        """It should rebuild the lists of every product"""
+        recommendations = RecommendationFactory.create_batch(3, name="prodA")
+        Recommendation.create_in_bulk(recommendations)
+        db.session.query(RecommendationList).delete()
+        db.session.commit()
+        RecommendationList.rebuild()
+        self.assertEqual(len(RecommendationList.find_serialized("prodA")), 3)
+
+    def test_create_in_bulk_statements(self):
+        """It should refresh the lists of every product of a bulk insert in a fixed number of statements"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        for products in (1, 20):
+            recommendations = [RecommendationFactory(name=f"prod{index % products}") for index in range(40)]
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                Recommendation.create_in_bulk(recommendations)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertEqual(len(RecommendationList.find_serialized(recommendations[-1].name)), 40 // products)
+        # an INSERT, the locks of the lists, their INSERT ... SELECT and the DELETE of the empty ones
+        self.assertEqual(len(statements), 2 * 5)
+        db.session.query(Recommendation).filter(Recommendation.name == "prod1").delete()
+        db.session.commit()
+        RecommendationList.refresh("prod1", "prod2")
+        self.assertIsNone(db.session.get(RecommendationList, "prod1"))
+        self.assertEqual(len(RecommendationList.find_serialized("prod2")), 2)
+
+    def test_paginate_bad_cursor(self):
+        """It should not paginate with a cursor it did not issue"""
+        self.assertRaises(DataValidationError, Recommendation.paginate, cursor="not-a-cursor")
+        cursor = Recommendation.encode_cursor("abc")
+        self.assertRaises(DataValidationError, Recommendation.paginate, cursor=cursor)
+        cursor = Recommendation.encode_cursor(1, "name", "prodA")
+        self.assertRaises(DataValidationError, Recommendation.paginate, cursor=cursor)
+        self.assertRaises(DataValidationError, Recommendation.paginate, sort="type")
+
+    def test_find_by_filters(self):
+        """It should find Recommendations that match every one of the filters"""
+        for likes in (1, 5, 9):
+            RecommendationFactory(name="prodA", type=RecommendationType.UPSELL, number_of_likes=likes).create()
+        RecommendationFactory(name="prodA", type=RecommendationType.ACCESSORY, number_of_likes=5).create()
+        RecommendationFactory(name="prodB", type=RecommendationType.UPSELL, number_of_likes=5).create()
+        found = Recommendation.find_by_filters(
+            name="prodA", type=RecommendationType.UPSELL, min_likes=2, max_likes=9).all()
+        self.assertEqual(sorted(rec.number_of_likes for rec in found), [5, 9])
+        self.assertEqual(Recommendation.find_by_filters(number_of_likes=5).count(), 3)
+        self.assertEqual(Recommendation.find_by_filters().count(), 5)
+        self.assertRaises(DataValidationError, Recommendation.find_by_filters, colour="red")
+
+    def test_parse_filters(self):
+        """It should convert the filters in query string arguments"""
+        filters = Recommendation.parse_filters({"name": "prodA", "type": "UPSELL", "min_likes": "3", "limit": "2"})
+        self.assertEqual(filters, {"name": "prodA", "type": RecommendationType.UPSELL, "min_likes": 3})
+        self.assertEqual(Recommendation.parse_filters({"name": ""}), {})
+        self.assertRaises(DataValidationError, Recommendation.parse_filters, {"type": "sell"})
+        self.assertRaises(DataValidationError, Recommendation.parse_filters, {"max_likes": "many"})
+
+    def test_paginate_sorted(self):
+        """It should paginate in the sort order with the rows without a value last"""
+        recommendations = [RecommendationFactory(number_of_likes=likes) for likes in (3, -1, 7, 3, -1, 1)]
+        for recommendation in recommendations:
+            recommendation.create()
+        # the column defaults to 0, so set the missing values afterwards
+        db.session.query(Recommendation).filter(Recommendation.number_of_likes < 0).update({"number_of_likes": None})
+        db.session.commit()
+        for sort, expected in (
+            ("number_of_likes", [1, 3, 3, 7, None, None]),
+            ("-number_of_likes", [7, 3, 3, 1, None, None]),
+        ):
+            pages, cursor = [], None
+            while True:
+                page, cursor = Recommendation.paginate(cursor=cursor, limit=2, sort=sort)
+                pages.extend(page)
+                if cursor is None:
+                    break
+            self.assertEqual([rec.number_of_likes for rec in pages], expected)
+            self.assertEqual(len({rec.id for rec in pages}), 6)
+        newest = sorted(recommendations, key=lambda rec: rec.id, reverse=True)
+        page, cursor = Recommendation.paginate_fields(["name"], limit=2, sort="-id")
+        self.assertEqual(page, [{"name": rec.name} for rec in newest[:2]])
+        page, cursor = Recommendation.paginate_fields(["name"], cursor=cursor, limit=2, sort="-id")
+        self.assertEqual(page, [{"name": rec.name} for rec in newest[2:4]])
+
+    def test_queries_use_indexes(self):
+        """It should use an index for each of the find queries"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("EXPLAIN output is PostgreSQL specific")
+        # seed enough rows with realistic skew for the planner to prefer indexes
+        types = [RecommendationType.UPSELL] * 18 + [RecommendationType.CROSSSELL, RecommendationType.ACCESSORY]
+        rows = [
+            {
+                "name": "popular" if i % 10 == 0 else f"prod{i % 500}",
+                "recommendation_id": i,
+                "recommendation_name": f"prod{i}",
+                "type": types[i % len(types)],
+                "number_of_likes": i % 97,
+            }
+            for i in range(5000)
+        ]
+        db.session.execute(Recommendation.__table__.insert(), rows)
+        db.session.commit()
+        db.session.execute(db.text("ANALYZE recommendation"))
+
+        def explain(query):
+            sql = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+            plan = db.session.execute(db.text(f"EXPLAIN {sql}")).scalars().all()
+            return "\n".join(plan)
+
+        # the natural key index leads with the name too
+        name_index = r"ix_recommendation_name_|uq_recommendation_natural_key"
+        self.assertRegex(explain(Recommendation.find_by_name("prod7")), name_index)
+        self.assertRegex(explain(
+            Recommendation.find_by_name("prod7").filter(Recommendation.type == RecommendationType.UPSELL)), name_index)
+        self.assertIn("ix_recommendation_type", explain(Recommendation.find_by_type(RecommendationType.ACCESSORY)))
+        self.assertIn("ix_recommendation_recommendation_id", explain(
+            Recommendation.query.filter(Recommendation.recommendation_id == 42)))
+        self.assertIn("ix_recommendation_number_of_likes", explain(Recommendation.find_top(10)))
+        self.assertIn("ix_recommendation_name_likes", explain(Recommendation.find_top(10, name="popular")))
+        self.assertIn("ix_recommendation_name_type_likes", explain(
+            Recommendation.find_top(10, name="popular", recommendation_type=RecommendationType.UPSELL)))
+
+    def test_engine_pool_settings(self):
+        """It should configure the connection pool and statement timeout"""
+        if not DATABASE_URI.startswith("postgres"):
+            self.skipTest("Pool settings only apply to PostgreSQL")
+        pool = db.engine.pool
+        self.assertEqual(pool.size(), app.config["DB_POOL_SIZE"])
+        self.assertEqual(pool._max_overflow, app.config["DB_MAX_OVERFLOW"])  # pylint: disable=protected-access
+        self.assertEqual(pool._timeout, app.config["DB_POOL_TIMEOUT"])  # pylint: disable=protected-access
+        self.assertEqual(pool._recycle, app.config["DB_POOL_RECYCLE"])  # pylint: disable=protected-access
+        timeout = db.session.execute(db.text("SHOW statement_timeout")).scalar()
+        self.assertEqual(timeout, f"{app.config['DB_STATEMENT_TIMEOUT'] // 1000}s")
+
+    def test_statement_timeout(self):
+        """It should cancel statements that run past the statement timeout"""
+        if not DATABASE_URI.startswith("postgres"):
+            self.skipTest("Statement timeouts are PostgreSQL specific")
+        db.session.execute(db.text("SET LOCAL statement_timeout = 10"))
+        self.assertRaises(OperationalError, db.session.execute, db.text("SELECT pg_sleep(1)"))
+        db.session.rollback()
@@ -6,11 +6,17 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
-from urllib.parse import quote_plus
+from unittest.mock import patch
+from urllib.parse import quote, quote_plus
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
 from service import app
-from service.models import db, init_db, Recommendation
+from service.models import db, init_db, cache, Recommendation, RecommendationList, RecommendationType
+from service.common.cache import LRUCache
+from service.likes import like_buffer
 from service.common import status  # HTTP Status Codes
 from tests.factories import RecommendationFactory
 
@@ -49,6 +55,7 @@ class TestRecommendationServer(TestCase):
         """ This runs before each test """
         self.client = app.test_client()
         db.session.query(Recommendation).delete()  # clean up the last tests
+        db.session.query(RecommendationList).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -137,6 +144,24 @@ class TestRecommendationServer(TestCase):
         update_recommendation = response.get_json()
         self.assertEqual(update_recommendation["number_of_likes"], 0)
 
+    def test_like_dislike_recommendation_buffered(self):
+        """Liking a recommendation should work when likes are buffered"""
+        test_recommendation = self._create_recommendation(1)[0]
+        like_buffer.enabled = True
+        try:
+            response = self.client.put(f"{BASE_URL}/{test_recommendation.id}/like")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["number_of_likes"], 1)
+            response = self.client.put(f"{BASE_URL}/{test_recommendation.id}/like")
+            self.assertEqual(response.get_json()["number_of_likes"], 2)
+            response = self.client.put(f"{BASE_URL}/{test_recommendation.id}/dislike")
+            self.assertEqual(response.get_json()["number_of_likes"], 1)
+        finally:
+            like_buffer.enabled = False
+            like_buffer.stop()
+        response = self.client.get(f"{BASE_URL}/{test_recommendation.id}")
+        self.assertEqual(response.get_json()["number_of_likes"], 1)
+
     def test_get_rec_list(self):
         """It should Get a list of Recommendations"""
         self._create_recommendation(5)
@@ -154,6 +179,75 @@ class TestRecommendationServer(TestCase):
         data = response.get_json()
         self.assertEqual(data["name"], test_recommendations.name)
 
+    def test_get_recommendation_cached(self):
+        """It should serve a cached recommendation until it changes"""
+        test_recommendation = self._create_recommendation(1)[0]
+        cache.backend = LRUCache()
+        try:
+            url = f"{BASE_URL}/{test_recommendation.id}"
+            self.assertEqual(self.client.get(url).get_json()["number_of_likes"], 0)
+            self.assertEqual(self.client.get(url).get_json()["number_of_likes"], 0)
+            self.client.put(f"{url}/like")
+            self.assertEqual(self.client.get(url).get_json()["number_of_likes"], 1)
+            data = self.client.get(url).get_json()
+            data["name"] = "changed"
+            self.client.put(url, json=data)
+            self.assertEqual(self.client.get(url).get_json()["name"], "changed")
+            response = self.client.get("/cache/stats")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json(), {"backend": "LRUCache", "hits": 2, "misses": 3})
+            self.client.delete(url)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            cache.backend = None
+            cache.clear()
+
+    def test_get_recommendation_not_modified(self):
+        """It should answer a conditional GET with 304 until the recommendation changes"""
+        test_recommendation = self._create_recommendation(1)[0]
+        url = f"{BASE_URL}/{test_recommendation.id}"
+        response = self.client.get(url)
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers.get("ETag"), etag)
+        self.assertEqual(len(response.data), 0)
+        self.client.put(f"{url}/like")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+
+    def test_get_rec_list_not_modified(self):
+        """It should answer a conditional list query with 304 until the list changes"""
+        self._create_recommendation(2)
+        response = self.client.get(BASE_URL)
+        etag = response.headers.get("ETag")
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._create_recommendation(1)
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_update_recommendation_if_match(self):
+        """It should only Update a recommendation that has not changed since it was read"""
+        test_recommendation = self._create_recommendation(1)[0]
+        url = f"{BASE_URL}/{test_recommendation.id}"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        data = response.get_json()
+        data["name"] = "first"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_etag = response.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(self.client.get(url).headers["ETag"], new_etag)
+        data["name"] = "second"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(url).get_json()["name"], "first")
+
     def test_delete_recommendation(self):
         """It should Delete a Recommendation"""
         test_recommendation = self._create_recommendation(1)[0]
@@ -198,6 +292,252 @@ class TestRecommendationServer(TestCase):
         for rec in data:
             self.assertEqual(rec["type"], test_type.name)
 
+    def test_query_rec_list_combined_filters(self):
+        """It should Query Recommendations by several filters at once, sorted"""
+        recs = [
+            RecommendationFactory(name="prodA", type=RecommendationType.UPSELL, number_of_likes=likes)
+            for likes in (2, 8, 5, 11)
+        ]
+        recs.append(RecommendationFactory(name="prodA", type=RecommendationType.ACCESSORY, number_of_likes=5))
+        recs.append(RecommendationFactory(name="prodB", type=RecommendationType.UPSELL, number_of_likes=5))
+        for rec in recs:
+            rec.create()
+        response = self.client.get(
+            BASE_URL, query_string="name=prodA&type=UPSELL&min_likes=3&max_likes=10&sort=-number_of_likes&limit=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec["id"] for rec in response.get_json()], [recs[1].id])
+        link = response.headers["Link"]
+        response = self.client.get(link[link.index("<") + 1:link.index(">")])
+        self.assertEqual([rec["id"] for rec in response.get_json()], [recs[2].id])
+        self.assertNotIn("Link", response.headers)
+        response = self.client.get(BASE_URL, query_string=f"recommendation_id={recs[5].recommendation_id}")
+        self.assertIn(recs[5].id, [rec["id"] for rec in response.get_json()])
+
+    def test_get_rec_list_bad_filters(self):
+        """It should not Get a list of Recommendations with bad filters or sort"""
+        for query_string in ("type=sell", "min_likes=many", "sort=colour", "sort=type"):
+            response = self.client.get(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_get_rec_list_paginated(self):
+        """It should Get a list of Recommendations one page at a time"""
+        recs = self._create_recommendation(5)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = []
+        while True:
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(rec["id"] for rec in data)
+            link = response.headers.get("Link")
+            if link is None:
+                break
+            self.assertTrue(link.endswith('; rel="next"'))
+            next_url = link[link.index("<") + 1:link.index(">")]
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(seen, sorted(rec.id for rec in recs))
+
+    def test_get_rec_list_sparse_fields(self):
+        """It should Get a list of Recommendations with only the requested fields"""
+        recs = self._create_recommendation(3)
+        response = self.client.get(
+            BASE_URL, query_string="fields=recommendation_id,number_of_likes&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data, [
+            {"recommendation_id": rec.recommendation_id, "number_of_likes": 0} for rec in recs[:2]
+        ])
+        link = response.headers["Link"]
+        response = self.client.get(link[link.index("<") + 1:link.index(">")])
+        self.assertEqual(response.get_json(), [{"recommendation_id": recs[2].recommendation_id, "number_of_likes": 0}])
+
+    def test_get_recommendation_sparse_fields(self):
+        """It should Get a single Recommendation with only the requested fields"""
+        test_recommendation = self._create_recommendation(1)[0]
+        response = self.client.get(
+            f"{BASE_URL}/{test_recommendation.id}", query_string="fields=id,type")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"id": test_recommendation.id, "type": test_recommendation.type.name})
+
+    def test_get_rec_list_page_size_capped(self):
+        """It should not return more than the maximum page size"""
+        self._create_recommendation(3)
+        max_page_size = app.config["MAX_PAGE_SIZE"]
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            response = self.client.get(BASE_URL, query_string="limit=100")
+        finally:
+            app.config["MAX_PAGE_SIZE"] = max_page_size
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("limit=2", response.headers.get("Link"))
+
+    def test_create_recommendations_in_bulk(self):
+        """It should Create many Recommendations from a JSON array"""
+        test_recommendations = [RecommendationFactory().serialize() for _ in range(5)]
+        response = self.client.post(f"{BASE_URL}/bulk", json=test_recommendations)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.get_json()
+        self.assertEqual([result["index"] for result in results], list(range(5)))
+        for result, test_recommendation in zip(results, test_recommendations):
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            response = self.client.get(f"{BASE_URL}/{result['id']}")
+            self.assertEqual(response.get_json()["name"], test_recommendation["name"])
+
+    def test_create_recommendations_in_bulk_ndjson(self):
+        """It should Create many Recommendations from an NDJSON stream in chunks"""
+        test_recommendations = [RecommendationFactory().serialize() for _ in range(5)]
+        body = "\n".join(json.dumps(rec) for rec in test_recommendations) + "\n"
+        chunk_size = app.config["BULK_CHUNK_SIZE"]
+        app.config["BULK_CHUNK_SIZE"] = 2
+        try:
+            response = self.client.post(
+                f"{BASE_URL}/bulk", data=body, headers={"Content-Type": "application/x-ndjson"})
+        finally:
+            app.config["BULK_CHUNK_SIZE"] = chunk_size
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.get_json()), 5)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 5)
+
+    def test_create_recommendations_in_bulk_partial(self):
+        """It should report which Recommendations of a bulk create were not valid"""
+        test_recommendations = [RecommendationFactory().serialize() for _ in range(3)]
+        del test_recommendations[1]["name"]
+        body = "\n".join(json.dumps(rec) for rec in test_recommendations) + "\nnot json\n"
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data=body, headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual([result["status"] for result in results], [201, 400, 201, 400])
+        self.assertIn("missing name", results[1]["message"])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_create_recommendations_in_bulk_bad_values(self):
+        """It should only reject the Recommendations of a bulk create with values that do not fit"""
+        test_recommendations = [RecommendationFactory().serialize() for _ in range(4)]
+        test_recommendations[1]["recommendation_id"] = "x"
+        test_recommendations[2]["name"] = "x" * 64
+        response = self.client.post(f"{BASE_URL}/bulk", json=test_recommendations)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual([result["status"] for result in results], [201, 400, 400, 201])
+        self.assertIn("recommendation_id", results[1]["message"])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_create_duplicate_recommendations(self):
+        """It should not Create a Recommendation with the name, recommendation_id and type of another"""
+        test_recommendation = self._create_recommendation(1)[0].serialize()
+        response = self.client.post(BASE_URL, json=test_recommendation)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("already exists", response.get_json()["message"])
+        response = self.client.post(f"{BASE_URL}/bulk", json=[RecommendationFactory().serialize(), test_recommendation])
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result["status"] for result in response.get_json()], [201, 409])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_create_recommendation_other_conflict(self):
+        """It should not report other constraint violations as a duplicate Recommendation"""
+        orig = Exception('duplicate key value violates unique constraint "recommendation_pkey"')
+        error = IntegrityError("INSERT", {}, orig)
+        with patch.object(Recommendation, "create", side_effect=error):
+            response = self.client.post(BASE_URL, json=RecommendationFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertNotIn("already exists", response.get_json()["message"])
+
+    def test_upsert_a_recommendation(self):
+        """It should Create a Recommendation, and Update it when it is upserted again"""
+        test_recommendation = RecommendationFactory().serialize()
+        response = self.client.put(f"{BASE_URL}/upsert", json=test_recommendation)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.get_json()
+        self.assertEqual(response.headers["Location"], f"http://localhost{BASE_URL}/{created['id']}")
+        test_recommendation.update(recommendation_name="renamed", number_of_likes=5)
+        response = self.client.put(f"{BASE_URL}/upsert", json=test_recommendation)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), dict(test_recommendation, id=created["id"]))
+        response = self.client.get(f"{BASE_URL}/{created['id']}")
+        self.assertEqual(response.get_json()["recommendation_name"], "renamed")
+        self.assertEqual(response.get_json()["number_of_likes"], 5)
+        response = self.client.put(f"{BASE_URL}/upsert", json=dict(test_recommendation, name=None))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(f"{BASE_URL}/upsert", json=dict(test_recommendation, recommendation_id="x"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(
+            f"{BASE_URL}/upsert", json=[dict(test_recommendation, recommendation_id="x"), test_recommendation])
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result["status"] for result in response.get_json()], [400, 200])
+
+    def test_upsert_recommendations_in_bulk(self):
+        """It should Create or Update many Recommendations and report which"""
+        existing = self._create_recommendation(1)[0].serialize()
+        new = RecommendationFactory().serialize()
+        items = [dict(existing, number_of_likes=3), new, {"name": "missing the rest"}, dict(new, number_of_likes=1)]
+        body = "\n".join(json.dumps(item) for item in items) + "\n"
+        response = self.client.put(
+            f"{BASE_URL}/upsert", data=body, headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual([result["status"] for result in results], [200, 201, 400, 200])
+        self.assertEqual(results[0]["id"], existing["id"])
+        self.assertEqual(results[1]["id"], results[3]["id"])
+        response = self.client.put(f"{BASE_URL}/upsert", json=[existing, new])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["status"] for result in response.get_json()], [200, 200])
+        data = {rec["id"]: rec for rec in self.client.get(BASE_URL).get_json()}
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[results[1]["id"]]["number_of_likes"], 0)
+        response = self.client.put(f"{BASE_URL}/upsert", headers={"Content-Type": "application/xml"})
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_get_top_recommendations(self):
+        """It should Get the most liked Recommendations"""
+        recs = self._create_recommendation(5)
+        for count, rec in enumerate(recs):
+            for _ in range(count):
+                self.client.put(f"{BASE_URL}/{rec.id}/like")
+        response = self.client.get(f"{BASE_URL}/top", query_string="n=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([rec["id"] for rec in data], [rec.id for rec in reversed(recs[2:])])
+        self.assertEqual([rec["number_of_likes"] for rec in data], [4, 3, 2])
+
+    def test_get_top_recommendations_filtered(self):
+        """It should Get the most liked Recommendations for a product and type"""
+        recs = self._create_recommendation(5)
+        test_type = recs[0].type
+        response = self.client.get(
+            f"{BASE_URL}/top", query_string=f"name={quote_plus(recs[0].name)}&type={test_type.name}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([rec["id"] for rec in data], [recs[0].id])
+        response = self.client.get(f"{BASE_URL}/top", query_string=f"type={test_type.name}")
+        data = response.get_json()
+        self.assertEqual(len(data), len([rec for rec in recs if rec.type == test_type]))
+
+    def test_export_recommendations(self):
+        """It should Export all of the Recommendations as NDJSON"""
+        recs = self._create_recommendation(5)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([rec["id"] for rec in data], sorted(rec.id for rec in recs))
+
+    def test_export_recommendations_filtered(self):
+        """It should Export the Recommendations that match the query"""
+        recs = self._create_recommendation(10)
+        test_type = recs[0].type
+        response = self.client.get(f"{BASE_URL}/export", query_string=f"type={test_type.name}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(data), len([rec for rec in recs if rec.type == test_type]))
+        for rec in data:
+            self.assertEqual(rec["type"], test_type.name)
+        response = self.client.get(f"{BASE_URL}/export", query_string=f"name={quote_plus(recs[0].name)}")
+        data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(data[0]["id"], recs[0].id)
+
     ######################################################################
     #  T E S T   S A D   P A T H S
     ######################################################################
@@ -217,6 +557,32 @@ class TestRecommendationServer(TestCase):
         response = self.client.post(BASE_URL, headers={'Content-Type': 'application/xml'})
         self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_recommendations_in_bulk_not_a_list(self):
+        """It should not Create Recommendations in bulk from a single object"""
+        response = self.client.post(f"{BASE_URL}/bulk", json=RecommendationFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_recommendations_in_bulk_bad_content_type(self):
+        """It should not Create Recommendations in bulk with bad content type"""
+        response = self.client.post(f"{BASE_URL}/bulk", headers={'Content-Type': 'application/xml'})
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_get_top_recommendations_bad_args(self):
+        """It should not Get the most liked Recommendations with bad arguments"""
+        response = self.client.get(f"{BASE_URL}/top", query_string="n=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/top", query_string="n=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/top", query_string="type=sell")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_recommendations_bad_filter(self):
+        """It should not Export Recommendations with a bad filter"""
+        response = self.client.get(f"{BASE_URL}/export", query_string="type=sell")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/export", query_string="number_of_likes=many")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_rec_not_found(self):
         """It should not Get a recommendation thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -253,6 +619,27 @@ class TestRecommendationServer(TestCase):
         response = self.client.put(f"{BASE_URL}/{0}/dislike")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_rec_list_bad_limit(self):
+        """It should not Get a list of Recommendations with a bad limit"""
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/api/products/1/recommended-by", query_string="limit=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_rec_list_bad_fields(self):
+        """It should not Get Recommendations with fields that do not exist"""
+        response = self.client.get(BASE_URL, query_string="fields=id,colour")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/1", query_string="fields=colour")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_rec_list_bad_cursor(self):
+        """It should not Get a list of Recommendations with a bad cursor"""
+        response = self.client.get(BASE_URL, query_string="cursor=bogus")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_health(self):
         """It should be healthy"""
         response = self.client.get("/health")
@@ -260,3 +647,165 @@ class TestRecommendationServer(TestCase):
         data = response.get_json()
         self.assertEqual(data["status"], 200)
         self.assertEqual(data["message"], "Healthy")
+
+    def test_metrics(self):
+        """It should expose request and SQL metrics"""
+        self._create_recommendation(1)
+        self.client.get(BASE_URL)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn('http_requests_total{endpoint="/api/recommendations",method="GET",status="200"}', text)
+        self.assertIn("http_request_duration_seconds_bucket", text)
+        self.assertIn("http_requests_in_flight", text)
+        self.assertIn('sql_statement_duration_seconds_count{statement="SELECT"}', text)
+        self.assertIn('sql_statement_duration_seconds_count{statement="INSERT"}', text)
+
+    def test_metrics_after_failed_statement(self):
+        """It should time the statements that follow one that failed"""
+        with db.engine.connect() as conn:
+            self.assertRaises(DBAPIError, conn.exec_driver_sql, "SELECT * FROM no_such_table")
+            before = REGISTRY.get_sample_value("sql_statement_duration_seconds_count", {"statement": "SELECT"})
+            conn.exec_driver_sql("SELECT 1")
+            after = REGISTRY.get_sample_value("sql_statement_duration_seconds_count", {"statement": "SELECT"})
+            self.assertEqual(after, before + 1)
+            self.assertNotIn("metrics_start", conn.info)
+
+    def test_pool_exhausted(self):
+        """It should return 503 when no database connection is available"""
+        error = PoolTimeoutError("QueuePool limit of size 5 overflow 10 reached")
+        with patch.object(Recommendation, "find_serialized", side_effect=error):
+            response = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    def test_statement_timed_out(self):
+        """It should return 503 when a query hits the statement timeout"""
+        error = OperationalError("SELECT", {}, Exception("canceling statement due to statement timeout"))
+        with patch.object(Recommendation, "find_serialized", side_effect=error):
+            response = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_get_rec_batch(self):
+        """It should Get Recommendations by ids in the order asked for"""
+        recommendations = self._create_recommendation(3)
+        ids = [recommendations[2].id, 0, recommendations[0].id, recommendations[2].id]
+        response = self.client.get(BASE_URL, query_string=f"ids={','.join(map(str, ids))}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([rec["id"] for rec in data], [recommendations[2].id, recommendations[0].id])
+        self.assertEqual(data[0]["name"], recommendations[2].name)
+        self.assertEqual(response.headers["X-Missing-Ids"], "0")
+        response = self.client.get(
+            BASE_URL, query_string=f"ids={recommendations[1].id}&fields=name", headers={"Cache-Control": "no-cache"})
+        self.assertEqual(response.get_json(), [{"name": recommendations[1].name}])
+        self.assertNotIn("X-Missing-Ids", response.headers)
+
+    def test_get_rec_batch_bad_ids(self):
+        """It should not Get Recommendations with bad or too many ids"""
+        response = self.client.get(BASE_URL, query_string="ids=1,two")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = ",".join(str(i) for i in range(app.config["MAX_BATCH_SIZE"] + 1))
+        response = self.client.get(BASE_URL, query_string=f"ids={too_many}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_likes_in_bulk(self):
+        """It should apply many like events in one request"""
+        recommendations = self._create_recommendation(2)
+        for recommendation in recommendations:
+            recommendation.number_of_likes = 1
+            self.client.put(f"{BASE_URL}/{recommendation.id}", json=recommendation.serialize())
+        events = [
+            {"id": recommendations[0].id, "delta": 3},
+            {"id": recommendations[1].id, "delta": -1},
+            {"id": recommendations[0].id, "delta": -1},
+        ]
+        response = self.client.post(f"{BASE_URL}/likes", json=events)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()
+        self.assertEqual([(result["id"], result["number_of_likes"]) for result in results],
+                         [(recommendations[0].id, 3), (recommendations[1].id, 0)])
+        response = self.client.get(f"{BASE_URL}/{recommendations[0].id}")
+        self.assertEqual(response.get_json()["number_of_likes"], 3)
+
+    def test_add_likes_in_bulk_partial(self):
+        """It should report the like deltas that could not be applied"""
+        recommendation = self._create_recommendation(1)[0]
+        body = "\n".join(json.dumps(event) for event in [
+            {"id": recommendation.id, "delta": -5},
+            {"id": 0, "delta": 1},
+        ])
+        response = self.client.post(f"{BASE_URL}/likes", data=body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(results[0]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(results[1]["status"], status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/{recommendation.id}")
+        self.assertEqual(response.get_json()["number_of_likes"], recommendation.number_of_likes or 0)
+
+    def test_add_likes_in_bulk_bad_events(self):
+        """It should not apply like events that are not valid"""
+        response = self.client.post(f"{BASE_URL}/likes", json={"id": 1, "delta": 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for event in (["id", 1], {"id": 1}, {"id": "1", "delta": 1}, {"id": 1, "delta": True}):
+            response = self.client.post(f"{BASE_URL}/likes", json=[event])
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/likes", data="id=1", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_add_likes_in_bulk_out_of_range(self):
+        """It should not apply any like events when an id or a sum of deltas is out of range"""
+        recommendation = self._create_recommendation(1)[0]
+        for events in (
+            [{"id": recommendation.id, "delta": 1}, {"id": 2**31, "delta": 1}],
+            [{"id": recommendation.id, "delta": 1}, {"id": 1, "delta": 2**40}],
+            [{"id": recommendation.id, "delta": 2**31 - 1}, {"id": recommendation.id, "delta": 1}],
+        ):
+            response = self.client.post(f"{BASE_URL}/likes", json=events)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/{recommendation.id}")
+        self.assertEqual(response.get_json()["number_of_likes"], recommendation.number_of_likes or 0)
+
+    def test_get_product_recommendations(self):
+        """It should Get the precomputed Recommendations for a product"""
+        recommendations = self._create_recommendation(2)
+        name = recommendations[0].name
+        response = self.client.get(f"/api/products/{quote(name)}/recommendations")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec["id"] for rec in response.get_json()], [recommendations[0].id])
+        etag = response.headers["ETag"]
+        self.client.put(f"{BASE_URL}/{recommendations[0].id}/like")
+        response = self.client.get(
+            f"/api/products/{quote(name)}/recommendations", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()[0]["number_of_likes"], (recommendations[0].number_of_likes or 0) + 1)
+        response = self.client.get("/api/products/nothing/recommendations")
+        self.assertEqual(response.get_json(), [])
+
+    def test_get_product_recommended_by(self):
+        """It should Get the Recommendations of the products that recommend a product"""
+        recommendations = self._create_recommendation(3)
+        for recommendation in recommendations:
+            self.client.put(f"{BASE_URL}/{recommendation.id}",
+                            json=dict(recommendation.serialize(), recommendation_id=7))
+        self.client.put(f"{BASE_URL}/{recommendations[1].id}/like")
+        response = self.client.get("/api/products/7/recommended-by", query_string={"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data[0]["id"], recommendations[1].id)
+        self.assertEqual(data[0]["name"], recommendations[1].name)
+        self.assertEqual(len(data), 2)
+        self.assertIn("/api/products/7/recommended-by?", response.headers["Link"])
+        next_url = response.headers["Link"].split(">")[0].lstrip("<")
+        response = self.client.get(next_url)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertNotIn("Link", response.headers)
+        ids = {rec["id"] for rec in data} | {response.get_json()[0]["id"]}
+        self.assertEqual(ids, {rec.id for rec in recommendations})
+        response = self.client.get("/api/products/7/recommended-by", query_string={"fields": "name", "sort": "id"})
+        self.assertEqual(response.get_json(), [{"name": rec.name} for rec in recommendations])
+        response = self.client.get("/api/products/0/recommended-by")
+        self.assertEqual(response.get_json(), [])
+        response = self.client.get("/api/products/7/recommended-by", query_string={"sort": "colour"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)